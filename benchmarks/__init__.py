@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+""" eepy のコンパイルとレンダリングのベンチマーク。
+
+    $ python -m benchmarks [-n ITERATIONS] [-w WORKLOAD] [-o OUTPUT]
+    $ python -m benchmarks --compare BASE.json NEW.json
+
+ワークロードごとに別プロセスで計測し、結果を JSON で出力します。
+    compile: Template.compile の所要時間（秒）の min と median
+    render: １回のレンダリングの所要時間（秒）の p50, p90, p99, max
+    throughput: １秒あたりのレンダリング回数
+    peak_memory_kb: ワークロードを実行したプロセスの最大 RSS（resource が使えない時は null）
+コミット間で比較する時は、それぞれの結果を保存して --compare で比較します。
+"""
+from __future__ import with_statement
+import sys, os, time, json, shutil, tempfile, codecs, subprocess, collections
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import eepy
+
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+WORKLOADS = collections.OrderedDict()
+
+
+def workload(name):
+    """ ワークロードを登録するデコレータ。
+    ワークロードは、作業ディレクトリを受け取り、(compile, render) を返す関数です。
+    compile は、コンパイルだけを行う関数か None です。render は、１回のレンダリングを行う関数です。
+    """
+    def decorator(func):
+        WORKLOADS[name] = func
+        return func
+    return decorator
+
+
+def _read(path):
+    with codecs.open(path, encoding="utf8") as f:
+        return f.read()
+
+
+def _template_workload(workdir, name, vars, filter=eepy.helper.escape_xml):
+    source = _read(os.path.join(workdir, name))
+    t = eepy.Template(source)
+    t.compile()
+    return (lambda: eepy.Template(source).compile()), (lambda: t.render(vars, filter))
+
+
+def _page_vars():
+    return {
+        "page_title": u"Benchmark",
+        "section": u"rows",
+        "menu": [u"item%d" % i for i in xrange(20)],
+        "rows": [(u"name%d" % i, u"value <%d> & co" % i) for i in xrange(200)],
+    }
+
+
+@workload("times_table")
+def times_table(workdir):
+    """ モジュールの docstring の Example 1（九九の表）を 30 x 30 で。"""
+    return _template_workload(workdir, "times.html", {"title": u"The times table", "max": 30})
+
+
+@workload("escape_heavy")
+def escape_heavy(workdir):
+    """ helper.escape_xml で特殊文字を含む値と Markup を大量に出力。"""
+    items = [{
+        "title": u"\"quoted\" & <tagged> #%d" % i,
+        "body": u"<script>alert('%d')</script>" % i,
+        "safe": eepy.helper.Markup(u"<b>%d</b>" % i),
+        "count": i,
+    } for i in xrange(2000)]
+    return _template_workload(workdir, "escape.html", {"items": items})
+
+
+@workload("concat_loop")
+def concat_loop(workdir):
+    """ 複数行コードパートのループ内で、concat を大量に呼び出す。"""
+    vars = dict(eepy.helper.__dict__, count=20000)
+    return _template_workload(workdir, "concat.html", vars)
+
+
+def _page_workload(workdir, inline=False):
+    r = eepy.Renderer(base=workdir, vars=eepy.helper.__dict__, filter=eepy.helper.escape_xml, encoding="utf8", inline=inline)
+    vars = _page_vars()
+    r.render("page.html", vars)
+    # inline の時は、page.html のコンパイルに親テンプレートと row.html の展開が含まれる
+    names = ("page.html",) if inline else ("page.html", "section.html", "base.html", "row.html")
+    def compile():
+        for name in names:
+            r._load(os.path.join(workdir, name)).compile()
+    return compile, (lambda: r.render("page.html", vars))
+
+
+@workload("deep_page")
+def deep_page(workdir):
+    """ ３階層の extends と block、ループ内の include を含むページ。"""
+    return _page_workload(workdir)
+
+
+@workload("deep_page_inline")
+def deep_page_inline(workdir):
+    """ deep_page を Renderer(inline=True) で。"""
+    return _page_workload(workdir, inline=True)
+
+
+def _filecache_render(workdir, cold, storage=lambda workdir: eepy.cache.FileCacheStorage()):
+    vars = _page_vars()
+    def render():
+        if cold:
+            for name in os.listdir(workdir):
+                if name.endswith(".cache"):
+                    os.remove(os.path.join(workdir, name))
+        r = eepy.Renderer(base=workdir, cache=storage(workdir), vars=eepy.helper.__dict__, filter=eepy.helper.escape_xml, encoding="utf8")
+        r.render("page.html", vars)
+    render()
+    return None, render
+
+
+@workload("filecache_cold")
+def filecache_cold(workdir):
+    """ FileCacheStorage が空の状態から、新しい Renderer で deep_page をレンダリング。"""
+    return _filecache_render(workdir, True)
+
+
+@workload("filecache_warm")
+def filecache_warm(workdir):
+    """ FileCacheStorage にキャッシュがある状態で、新しい Renderer で deep_page をレンダリング。"""
+    return _filecache_render(workdir, False)
+
+
+@workload("sharedcache_warm")
+def sharedcache_warm(workdir):
+    """ filecache_warm を cache.SharedCacheStorage で。"""
+    return _filecache_render(workdir, False, lambda workdir: eepy.cache.SharedCacheStorage(os.path.join(workdir, "shared.cache")))
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def _peak_memory_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024
+    return rss
+
+
+def measure(name, iterations):
+    """ name のワークロードを、このプロセスで計測して結果を返します。"""
+    workdir = tempfile.mkdtemp(prefix="eepy-bench-")
+    try:
+        for filename in os.listdir(TEMPLATES):
+            shutil.copy(os.path.join(TEMPLATES, filename), workdir)
+        compile, render = WORKLOADS[name](workdir)
+        result = collections.OrderedDict()
+        if compile:
+            timings = []
+            for i in xrange(max(1, iterations // 10)):
+                start = time.time()
+                compile()
+                timings.append(time.time() - start)
+            result["compile"] = collections.OrderedDict([("min", min(timings)), ("median", _percentile(timings, 50))])
+        else:
+            result["compile"] = None
+        timings = []
+        for i in xrange(iterations):
+            start = time.time()
+            render()
+            timings.append(time.time() - start)
+        result["render"] = collections.OrderedDict((key, _percentile(timings, p)) for key, p in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100)))
+        result["throughput"] = len(timings) / sum(timings) if sum(timings) else None
+        result["iterations"] = iterations
+        result["peak_memory_kb"] = _peak_memory_kb()
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(names=None, iterations=200):
+    """ ワークロードを、それぞれ別のプロセスで計測して結果を返します。
+    peak_memory_kb が、他のワークロードの影響を受けないようにする為です。
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+    results = collections.OrderedDict()
+    for name in names or WORKLOADS:
+        if name not in WORKLOADS:
+            raise KeyError("Unknown workload: %s" % name)
+        output = subprocess.check_output([sys.executable, "-m", "benchmarks", "--child", name, "-n", str(iterations)], env=env, cwd=root)
+        results[name] = json.loads(output, object_pairs_hook=collections.OrderedDict)
+    report = collections.OrderedDict()
+    report["eepy"] = eepy.__doc__.split()[1]
+    report["python"] = sys.version.split()[0]
+    report["platform"] = sys.platform
+    report["revision"] = _revision(root)
+    report["results"] = results
+    return report
+
+
+def _revision(root):
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=root, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(base, new):
+    """ ２つの結果を比較し、ワークロードごとの比（new / base）を行のリストで返します。"""
+    lines = ["%-20s %10s %10s %10s %10s" % ("workload", "compile", "p50", "p99", "memory")]
+    def ratio(a, b):
+        return "%9.2fx" % (float(b) / a) if a and b else "%10s" % "-"
+    for name, b in base["results"].iteritems():
+        n = new["results"].get(name)
+        if not n:
+            continue
+        lines.append("%-20s %s %s %s %s" % (name,
+            ratio((b["compile"] or {}).get("median"), (n["compile"] or {}).get("median")),
+            ratio(b["render"]["p50"], n["render"]["p50"]),
+            ratio(b["render"]["p99"], n["render"]["p99"]),
+            ratio(b["peak_memory_kb"], n["peak_memory_kb"])))
+    return lines
+
+
+def main(argv=None):
+    """ コマンドラインのエントリポイント。"""
+    import optparse
+    parser = optparse.OptionParser(usage="%prog [-n ITERATIONS] [-w WORKLOAD ...] [-o OUTPUT] | --compare BASE NEW")
+    parser.add_option("-n", "--iterations", type="int", default=200, help="renders per workload")
+    parser.add_option("-w", "--workload", action="append", help="run only this workload (repeatable): " + ", ".join(WORKLOADS))
+    parser.add_option("-o", "--output", help="write the JSON report to this file")
+    parser.add_option("--compare", action="store_true", default=False, help="compare two JSON reports")
+    parser.add_option("--child", help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args(argv)
+
+    if options.child:
+        json.dump(measure(options.child, options.iterations), sys.stdout)
+        return
+    if options.compare:
+        if len(args) != 2:
+            parser.error("usage: --compare BASE NEW")
+        base, new = [json.load(open(path), object_pairs_hook=collections.OrderedDict) for path in args]
+        for line in compare(base, new):
+            print line
+        return
+
+    report = json.dumps(run(options.workload, options.iterations), indent=2)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print report
@@ -32,6 +32,9 @@ Description:
             <% hoge = "<b>" -%>
             <%= hoge %>          --->        &lt;b&gt;
             <%=r hoge %>         --->        <b>
+
+        helper.Markup の値は、エスケープ済みとして filter を経由せずに出力されます。
+        capture や include(capture_as=...) で保存された値は Markup です。
         
         ----
         "<%-" と "-%>" と書くと、トリムモードになります。
@@ -163,6 +166,116 @@ Description:
                                 encoding = "utf8")
                 result = r.render("template.html", vars)
 
+        ストリーム:
+            render_iter を使用すると、レンダリング結果をチャンクで順次受け取れます。
+            テンプレート中の "<%- flush() -%>" の位置で、それまでの出力がチャンクとして返されます。
+            extends されている時や、block、capture の範囲内では、フラッシュせずにバッファリングします。
+
+                <head> ... </head>
+                <%- flush() -%>
+
+                for chunk in r.render_iter("template.html", vars):
+                    out.write(chunk.encode("utf-8"))
+
+            render_to を使用すると、出力をエンコードしながら、ファイルや WSGI の write に直接書き込みます。
+            レンダリング結果の全体をメモリに持たないので、大きなページでもメモリ使用量が増えません。
+
+                r.render_to(sys.stdout, "template.html", vars, encoding="utf-8")
+
+        バンドル:
+            テンプレートを事前にコンパイルし、ひとつのバンドルファイルにまとめることができます。
+            Renderer はバンドルを起動時に読み込み、テンプレートの読み込みやコンパイルをせずにレンダリングします。
+
+                $ python -m eepy compile /application/templates -o templates.bundle -e utf8
+
+                r = Renderer(base = "/application/templates", bundle = "templates.bundle")
+
+            --inline, --minify などを指定して作成したバンドルは、同じオプションの Renderer でだけ読み込めます。
+
+            Renderer(compact = True) の時、オンメモリキャッシュのテンプレートは、コンパイル後に
+            テンプレートを捨て、srccode を圧縮して持ちます。多数のワーカープロセスで、
+            多数のテンプレートを持つ時のメモリ使用量が減ります。
+
+            pre-fork のワーカープロセスでは、cache.SharedCacheStorage を使うと、あるプロセスが
+            コンパイルしたテンプレートを、他のプロセスもキャッシュファイルを開かずに利用できます。
+
+                r = Renderer(base = "/application/templates",
+                             cache = eepy.cache.SharedCacheStorage("/var/tmp/templates.cache"))
+
+            複数のホストでは、cache.MemcachedCacheStorage で memcached サーバを共有できます。
+            Renderer.warm は、テンプレートを２次キャッシュから１回の往復でまとめて読み込みます。
+
+                r = Renderer(base = "/application/templates",
+                             cache = eepy.cache.MemcachedCacheStorage("cache.local:11211"))
+                r.warm()
+
+            Renderer(check_interval = 秒数) の時、最短でその間隔ごとに、読み込んだテンプレートファイルを stat し、
+            変更されたテンプレートと、それを inline で展開したテンプレートだけを、オンメモリキャッシュから取り除きます。
+            レンダリングごとの stat は行いません。Renderer.invalidate で、明示的に取り除くこともできます。
+
+        インライン展開:
+            Renderer(inline = True) の時、path が文字列リテラルの include は、コンパイル時に
+            子テンプレートを関数として展開し、レンダリング時にテンプレートを探しません。
+            path が文字列リテラルの extends も、親テンプレートをひとつの関数に展開し、
+            子テンプレートのブロックの出力は、親テンプレートのブロックの位置にそのまま移されます。
+            子テンプレートや親テンプレートを変更した時は、２次キャッシュも無効になります。
+
+                <%- include("row.html", name = "age", value = 36) -%>
+                <%- extends("layout.html", title = u"Top") -%>
+
+        コンポーネント:
+            component で、子テンプレートを引数を宣言した関数として取得できます。
+            関数は Renderer ごとに一度だけコンパイルされ、呼び出しでは、テンプレート変数のコピーや
+            テンプレートの検索を行わずに、渡した引数だけでレンダリングして出力します。
+            ループの中で何度も呼ぶ部分テンプレートに使用します。
+
+                <%- row = component("row.html", "name", "value") -%>
+                <%- for name, value in items: -%>
+                <%- row(name, value) -%>
+                <%- end -%>
+
+        フラグメントキャッシュ:
+            "with cached(key, ttl=秒数):" で囲んだ範囲の出力は、テンプレートのファイル名と key をキーとしてキャッシュされます。
+            キャッシュがある時は、範囲のコードは実行されません。
+            保存先は Renderer(fragments = ...) で指定でき、cache.MemoryFragmentStorage（LRU）と
+            cache.FileFragmentStorage が用意されています。未指定の時は、Renderer ごとの MemoryFragmentStorage です。
+
+                <%- with cached("menu", ttl = 300): -%>
+                    <%- for item in load_menu(): -%> ... <%- end -%>
+                <%- end -%>
+
+        バッチレンダリング:
+            render_many を使用すると、同じテンプレートを多数のテンプレート変数で、複数のプロセスで並列にレンダリングできます。
+            ワーカープロセスには、コンパイル済みのテンプレートが渡されます。
+            テンプレート変数とレンダリング結果は pickle できる必要があります。
+
+                for result in r.render_many("mail.html", customers, workers=4):
+                    send(result)
+
+        非同期レンダリング:
+            helper.defer で別のスレッドで計算し始めた値（helper.Deferred）は、テンプレート変数として渡せます。
+            render_async を使用すると、<%= で出力される計算中の値を待たずにレンダリングを続け、
+            最後にまとめて待ちます。include や block の中で defer した値も、並行して計算されます。
+            出力の順序は変わりません。
+
+                vars = {"news": defer(fetch_news), "weather": defer(fetch_weather, city)}
+                result = r.render_async("template.html", vars).result()
+
+        プロファイル:
+            Profiler を使用すると、レンダリングの所要時間をテンプレートのファイルと行ごとに計測できます。
+            include と extends の入れ子も、所要時間と共に記録されます。
+            計測していない時のレンダリングには、何のコストもかかりません。
+
+                profiler = eepy.Profiler()
+                with profiler:
+                    r.render("template.html", vars)
+                print profiler.format_table()
+                print profiler.format_trace()
+                profiler.write_collapsed(open("template.folded", "w"))
+
+        *** テンプレートのコードは関数としてコンパイルされます。
+            コードパートで代入した変数は、その関数のローカル変数になります ***
+
 
     --------------------------------
     ABOUT A CHARACTER CODE:
@@ -316,17 +429,23 @@ Description:
 
 """
 from __future__ import with_statement
-import sys, re, types, os.path, codecs, traceback
+import sys, re, types, os.path, codecs, symtable, ast, hashlib, contextlib, marshal, collections, imp, threading, copy, json, bisect, linecache, timeit, time, zlib, functools, __builtin__
 
 
 logger = None
-""" ログを残したい場合、logging または logging 互換のオブジェクトを指定します。"""
+""" ログを残したい場合、logging または logging 互換のオブジェクトを指定します。
+メッセージは logger.info(msg, *args) の形で渡され、フォーマットはログを出力する時にだけ行われます。
+"""
+
+
+_builtin_locals = locals
 
 
 def _module(func):
     """ 関数定義をモジュールに変換するデコレータ。
     関数内での定義が、モジュールのコンテンツになります。
     関数内の最後で、return locals() を書いてください。
+    関数内で定義した関数とクラスは、モジュールに属するものとして pickle できます。
     """
     modname = "%s.%s" % (
          sys._getframe(1).f_locals["__name__"], 
@@ -334,26 +453,165 @@ def _module(func):
     mod = types.ModuleType(modname)
     setattr(mod, "__file__", __file__)
     for n, c in func().items():
+        if isinstance(c, (types.FunctionType, type)) and c.__module__ == __name__:
+            c.__module__ = modname
         setattr(mod, n, c)
     sys.modules[modname] = mod
     return mod
 
 
+def _through(s):
+    """ 何もしないフィルタ """
+    return s
+_through.markup_safe = True
+
+
+def _output_filter(filter):
+    """ <%= の出力に使う関数を返します。値の unicode への変換も、この関数で行います。
+    filter が _through の時は helper.tostr を、filter.tostr_safe が真の時は filter をそのまま返します。
+    """
+    if filter is _through:
+        return helper.tostr
+    if getattr(filter, "tostr_safe", False):
+        return filter
+    filter, tostr = helper.markup_safe(filter), helper.tostr
+    output_filter = lambda value: filter(tostr(value))
+    output_filter.markup_safe = output_filter.tostr_safe = True
+    return output_filter
+
+
+def _compile_options(fastlocals, inline, minify):
+    """ srccode に影響するコンパイルオプションを、ビットの組み合わせで返します。
+    ２次キャッシュとバンドルで、異なるオプションでコンパイルしたものを区別する為に使います。
+    """
+    return (1 if fastlocals else 0) | (2 if inline else 0) | (4 if minify else 0) | (8 if minify == "comments" else 0)
+
+
+class _Line(unicode):
+    """ 生成したソースコードの行。origin に、テンプレート上の位置 (ファイル名, 行番号) を持ちます。"""
+    __slots__ = ("origin",)
+
+    def __new__(cls, line, origin):
+        self = unicode.__new__(cls, line)
+        self.origin = origin
+        return self
+
+
+class _Parts(list):
+    """ render_async のレンダリング中の、出力待ちの値（_Pending）を含む出力。
+    要素は unicode、_Pending、_Parts のいずれかで、resolve で unicode にします。
+    """
+    __slots__ = ()
+
+    def resolve(self):
+        return u"".join(part if isinstance(part, unicode) else part.resolve() for part in self)
+
+
+class _Pending(object):
+    """ render_async のレンダリング中に出力された、計算中の値。resolve で値を待ち、出力の関数を通して返します。"""
+    __slots__ = ("value", "output")
+
+    def __init__(self, value, output):
+        self.value = value
+        self.output = output
+
+    def resolve(self):
+        value = self.value
+        if not isinstance(value, _Parts):
+            value = self.output(value.result())
+        return value.resolve() if isinstance(value, _Parts) else value
+
+
+def _resolve(value):
+    """ value が _Parts の時、出力待ちの値を待って unicode にして返します。"""
+    return value.resolve() if isinstance(value, _Parts) else value
+
+
+def _deferred_output(output):
+    """ render_async の <%= の出力に使う関数を返します。
+    値が計算中（helper.Deferred または concurrent.futures.Future 互換）の時は、待たずに _Pending を返します。
+    """
+    def deferred_output(value):
+        if isinstance(value, _Parts):
+            return value
+        if isinstance(value, helper.Deferred) or hasattr(value, "add_done_callback") and hasattr(value, "result"):
+            return _Pending(value, output)
+        return output(value)
+    deferred_output.markup_safe = deferred_output.tostr_safe = True
+    return deferred_output
+
+
 class Template(object):
     """ テンプレートのコンパイルと、レンダリングを行います。
     """
 
-    def __init__(self, template=u"", srccode=None, bytecode=None):
+    __slots__ = ("filename", "template", "_srccode", "bytecode", "fastlocals", "inline", "loader", "depends", "compact",
+                 "minify", "_source_map", "_include_count")
+
+    def __init__(self, template=u"", srccode=None, bytecode=None, fastlocals=False, inline=False, loader=None, depends=None, filename=None, compact=False, minify=False):
         """ テンプレートデータを保存し、オブジェクトを初期化します。
         また、２次キャッシュの復元の為に、srccode や bytecode データを受理します。
         args:
             template: テンプレート。ファイルまたは unicode 文字列。
             srccode: コンパイル後のソースコード。この引数は通常は指定しません。
             bytecode: コンパイル後のバイトコード。この引数は通常は指定しません。
+            fastlocals: True の時、テンプレートで参照する変数を、関数の先頭で一度だけローカル変数に束縛します。
+                        ループ内での変数の参照が速くなります。
+                        但し、レンダリング中に capture などで動的に設定される変数を参照する場合、
+                        その変数名はテンプレート中に文字列リテラルで記述されている必要があります。
+            inline: True の時、path が文字列リテラルの include("child.html", name=value, ...) を、
+                        コンパイル時に子テンプレートの関数として展開します。
+                        extends を含む子テンプレートや、capture_as を指定した include は展開しません。
+                        capture などでテンプレート変数を読み書きする子テンプレートも、子テンプレートの変数が
+                        呼び出し元と分かれるよう、展開せずに実行時に include します。
+                        また、テンプレートの直下で一度だけ呼ばれる、path が文字列リテラルの extends を、
+                        親テンプレートと合わせてひとつの関数に展開します。
+            loader: inline で子テンプレートを読み込む関数。loader(path) -> (テンプレート, ファイル名)
+            depends: inline で展開した子テンプレートのファイル名のリスト。この引数は通常は指定しません。
+            filename: テンプレートのファイル名。未指定の時、template がファイルであればその name
+            compact: True の時、コンパイル後にテンプレートを捨て、srccode を圧縮して持ちます。
+                        多数のテンプレートをオンメモリキャッシュに持つ時に、メモリ使用量が減ります。
+                        srccode は、エラーの報告などで必要になった時に展開されます。
+            minify: True の時、コンパイル時にテキストパートの HTML の空白を詰めます。
+                        改行を含む空白の連続は改行ひとつに、それ以外の空白の連続は空白ひとつにします。
+                        pre, textarea, script, style 要素の内容はそのままにします。
+                        "comments" の時、HTML コメントも取り除きます（<!--[if ...] などの条件付きコメントは残します）。
+                        CSS の white-space で空白を表示している要素がある時は使用できません。
         """
+        self.filename = filename or getattr(template, "name", None)
         self.template = getattr(template, "read", lambda: template)()
-        self.srccode = srccode
+        self._srccode = srccode
         self.bytecode = bytecode
+        self.fastlocals = fastlocals
+        self.inline = inline
+        self.loader = loader
+        self.depends = depends or []
+        self.compact = compact
+        self.minify = minify
+        self._source_map = None
+
+
+    @property
+    def srccode(self):
+        """ コンパイル後のソースコード。compact の時は、圧縮されたものを展開して返します。"""
+        srccode = self._srccode
+        if isinstance(srccode, str):
+            return zlib.decompress(srccode).decode("utf-8")
+        return srccode
+
+
+    @srccode.setter
+    def srccode(self, srccode):
+        self._srccode = srccode
+
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name, None)) for name in self.__slots__)
+
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
 
 
     def compile(self):
@@ -362,149 +620,947 @@ class Template(object):
 
             #Compile to src code
             if not self.srccode:
-                s = self.template.replace("\r\n","\n").replace("\r","\n")
-                c = [u"__buffer= []\n"]
-                pos = 0
-                indent = 0
-                last_inline_block_row = -1
-                search = self._regexp_search_code_part.search
-                append = lambda s: c.append("%s%s\n" % ("    " * indent, s))
-                escape = lambda s: s.replace('"', '\\"').replace("<%%", "<%").replace("%%>", "%>")
-        
-                while True:
-                    last_inline_block_row -= 1
-                    code_part = search(s, pos=pos)
-        
-                    #Write text part
-                    text_part = s[pos:code_part.start()] if code_part else s[pos:]
-                    if text_part:
-                        append(u'__buffer.append(u"""%s""")' % escape(text_part))
-                    
-                    #End compile
-                    if not code_part:
-                        break
-        
-                    #Parse and write code part
-                    pos = code_part.end()
-                    code_part = code_part.groupdict()
-                    code = code_part.get("code").rstrip()
-                    code = self._regexp_search_multi_line.sub(" ", code)
-        
-                    if code_part.get("print_expr"):
-                        if code_part.get("raw_mode"):
-                            append(u"__buffer.append(__tostr(%s))" % code.lstrip())
-                        else:
-                            append(u"__buffer.append(__filter(__tostr(%s)))" % code.lstrip())
-        
-                    elif code:
-                        lines = code.lstrip(u" \t").splitlines()
-                        
-                        #When single line code part
-                        if len(lines) == 1:
-                            line = lines[0].lstrip()
-                            if not line: continue
-                            li = self._regexp_parse_line_information.match(line)
-                            if li:
-                                li = li.groupdict()
-                                if li.get("b_start"):
-                                    append(line)
-                                    if li.get("b_inline"):
-                                        last_inline_block_row = 0
-                                    else:
-                                        indent += 1
-                                elif li.get("b_restart"):
-                                    if not last_inline_block_row == -1:
-                                        indent -= 1
-                                    append(line)
-                                    if li.get("b_inline"):
-                                        last_inline_block_row = 0
-                                    else:
-                                        indent += 1
-                                elif li.get("b_end"):
-                                    indent -= 1
-                                else:
-                                    append(line)
-    
-                        #When multi line cord part
-                        else:
-                            if lines.pop(0).rstrip():
-                                raise SyntaxError("""Must be Empty at the block start line ("<%"), when write multi lines to code block""")
-                            for i, line in enumerate(lines):
-                                line = line.rstrip()
-                                if line:
-                                    base_indent = self._regexp_find_first_char_in_line.search(line).start()
-                                    break
-                            for line in lines[i:]:
-                                line = line.rstrip()
-                                if line:
-                                    append(line[base_indent:])
-
-                self.srccode = u"".join(c)
+                self.depends = []
+                self._include_count = 0
+                c = [u"def __render(__append, __filter, __tostr, __vars):\n"]
+                c.extend(self._inherit(self.template, ["__append", "__filter", "__tostr", "__vars"], [self.filename] if self.filename else [], True, {}))
+
+                #Export locals for after render hooks, and make sure to be a generator
+                c.append(_Line(u"    __vars.update(__locals())\n", (self.filename, 0)))
+                c.append(_Line(u"    if False: yield\n", (self.filename, 0)))
+                head, body = c[:1], c[1:]
+                prologue = self._declare_globals(u"".join(c))
+                prologue += self._bind_assigned(u"".join(head + prologue + body))
+                if self.fastlocals:
+                    prologue += self._bind_locals(u"".join(head + prologue + body))
+                prologue += self._bind_template_locals(u"".join(c))
+                c[1:1] = prologue
+                c.append(self._source_map_comment(c))
+                srccode = u"".join(c)
+                self._check_cached(srccode)
+                self.srccode = srccode
                 if logger:
                     logger.info("Compiled src code")
 
             #Compile to byte code
-            try:
-                self.bytecode = compile(self.srccode, u"<eepy>", u"exec")
-                if logger:
-                    logger.info("Compiled byte code")
-            except SyntaxError, e:
-                e.text = u"\n".join(self.srccode.splitlines()[0:e.lineno])
-                e.args = ("invalid syntax", ("<eepy>", e.lineno, e.offset, e.text))
-                raise e, None, sys.exc_info()[-1]
+            self._compile_bytecode()
+
+        #Drop template and compress src code
+        if self.compact and isinstance(self._srccode, unicode):
+            self._srccode = zlib.compress(self._srccode.encode("utf-8"))
+            self.template = None
+            if logger: logger.info("Compacted template (filename=%r)", self.filename)
         
         return self.bytecode
 
 
-    def render(self, vars={}, filter=lambda s: s):
+    def _compile_bytecode(self):
+        try:
+            self.bytecode = compile(self.srccode, u"<eepy>", u"exec")
+            if logger:
+                logger.info("Compiled byte code")
+        except SyntaxError, e:
+            e.text = u"\n".join(self.srccode.splitlines()[0:e.lineno])
+            e.args = ("invalid syntax", ("<eepy>", e.lineno, e.offset, e.text))
+            raise e, None, sys.exc_info()[-1]
+
+
+    def _check_cached(self, srccode):
+        """ with cached(...) の本体に、break と continue が無いことを確かめます。
+        cached は一度だけ繰り返す for 文にコンパイルされるので、本体の break と continue は、外側のループではなく
+        この for 文に作用し、途中までの出力がキャッシュされてしまう為です。本体の中のループの break と continue は使えます。
+        """
+        if u"__context.cached(" not in srccode:
+            return
+        try:
+            tree = ast.parse(srccode)
+        except SyntaxError:
+            return #_compile_bytecode で報告する
+        for node in ast.walk(tree):
+            if (isinstance(node, ast.For) and isinstance(node.iter, ast.Call) and isinstance(node.iter.func, ast.Attribute)
+                    and node.iter.func.attr == "cached" and getattr(node.iter.func.value, "id", None) == "__context"):
+                jumps, body = [], list(node.body)
+                while body:
+                    stmt = body.pop(0)
+                    if isinstance(stmt, (ast.Break, ast.Continue)):
+                        jumps.append(stmt)
+                    elif not isinstance(stmt, (ast.For, ast.While, ast.FunctionDef, ast.ClassDef)):
+                        body.extend(child for child in ast.iter_child_nodes(stmt) if isinstance(child, (ast.stmt, ast.excepthandler)))
+                if jumps:
+                    linenos, origins = self._parse_source_map(srccode)
+                    origin = origins[bisect.bisect_right(linenos, jumps[0].lineno) - 1]
+                    raise SyntaxError("'%s' can not be used in a cached block (line %d)"
+                                      % ("break" if isinstance(jumps[0], ast.Break) else "continue", origin[1]))
+
+
+    def compile_component(self, params, vars={}):
+        """ テンプレートを、params を引数とする関数（コンポーネント）にコンパイルして返します。
+        関数は、呼び出し元の出力に追加する為の引数に続けて、params を受け取ります。通常は helper.component で使用します。
+        関数の中で参照する params 以外の変数は、vars から探されます。呼び出し元のテンプレート変数は参照しません。
+        関数の中の include や capture も、呼び出しごとの Context で、コンポーネントの変数を使います。
+        extends を含むテンプレートは、コンポーネントにできません。
+        args:
+            params: 引数のリスト。"name" または、デフォルト値を持つ "name=value" の形式
+            vars: コンポーネントのグローバル変数。ヘルパなど
+        """
+        if self._regexp_extends_call.search(self.template):
+            raise ValueError("%s: component can not extends" % repr(self.filename))
+        names = [u"__context", u"__append", u"__filter", u"__tostr", u"__vars"] + [p.split(u"=", 1)[0].strip() for p in params]
+        self.depends = []
+        self._include_count = 0
+        c = [u"def __component(%s):\n" % u", ".join(names[:5] + list(params))]
+        c.extend(self._generate(self.template, 1, names, [self.filename] if self.filename else []))
+        c.append(_Line(u"    pass\n", (self.filename, 0)))
+        
+        #include などが、呼び出し元ではなくコンポーネントの変数を参照するよう、呼び出しごとの Context を使う
+        tables, names = symtable.symtable(u"".join(c), "<eepy>", "exec").get_children(), set()
+        while tables:
+            t = tables.pop()
+            tables.extend(t.get_children())
+            names.update(t.get_identifiers())
+        if names & set(self._component_scoped_names):
+            c[1:1] = [u"    __context = __context.enter_component(__builtin__.globals())\n", u"    __vars = __context.locals\n"]
+        c.append(self._source_map_comment(c))
+        srccode = u"".join(c)
+        self._check_cached(srccode)
+        self.srccode = srccode
+        self._compile_bytecode()
+        if logger: logger.info("Compiled component (filename=%r, params=%r)", self.filename, params)
+        
+        globals = dict(vars)
+        globals["__template"] = self
+        globals["__builtin__"] = __builtin__
+        exec self.bytecode in globals
+        return globals["__component"]
+
+
+    def _generate(self, template, indent, params, stack, flush=False, info=None):
+        """ テンプレートを、indent の深さの関数本体のソースコードの行のリストに変換します。
+        args:
+            template: テンプレート
+            indent: インデントの深さ
+            params: 生成するコードを本体とする関数の引数名のリスト
+            stack: inline で展開中のテンプレートのファイル名のリスト。最後の要素が template のファイル名
+            flush: True の時、フラッシュポイントを yield に、False の時は pass に変換します
+            info: 指定された時、extends と block の呼び出し、直下のテキストの行の位置を記録します
+        生成した行は、テンプレート上の位置を持つ _Line です。
+        """
+        s = template.replace("\r\n","\n").replace("\r","\n")
+        filename = stack[-1] if stack else None
+        row = [1, 0]
+        c = []
+        includes = []
+        opened = []
+        pos = 0
+        base = indent
+        last_inline_block_row = -1
+        memo = {}
+        search = lambda s, pos: self._search_code_part(s, pos, memo)
+        escape = lambda s: s.replace('"', '\\"').replace("<%%", "<%").replace("%%>", "%>")
+        outputs = []
+        minify = {} #pre などの要素の中にいる時、"raw" にその要素名
+        functions = [] #テンプレートで定義中の def と class の本体のインデント
+
+        def origin(p):
+            #p までの改行を数えて、p のテンプレート上の位置を返す（p は単調に増加する）
+            row[0] += s.count(u"\n", row[1], p)
+            row[1] = p
+            return (filename, row[0])
+
+        def emit():
+            #コードの行の間の出力を最適化して、__append の行にする
+            if not outputs:
+                return
+            for op in self._optimize(outputs):
+                if op[0] == "text" and info is not None and indent == base:
+                    info["texts"].append(len(c))
+                c.append(_Line(u"%s%s\n" % ("    " * indent, self._output_code(op)), op[2]))
+            del outputs[:]
+
+        def append(line, at):
+            emit()
+            c.append(_Line(u"%s%s\n" % ("    " * indent, line), at))
+
+        while True:
+            last_inline_block_row -= 1
+            code_part = search(s, pos)
+
+            #Write text part
+            text_part = s[pos:code_part[0]] if code_part else s[pos:]
+            if text_part and self.minify:
+                text_part = self._minify(text_part, minify)
+            if text_part:
+                outputs.append(("text", escape(text_part), origin(pos)))
+            
+            #End compile
+            if not code_part:
+                emit()
+                break
+
+            #Parse and write code part
+            start, pos, code, print_expr, raw_mode = code_part
+            code = self._regexp_search_multi_line.sub(" ", code.rstrip())
+            at = origin(start)
+
+            if print_expr:
+                outputs.append(("raw" if raw_mode else "filter", code.lstrip(), at))
+
+            elif code:
+                emit()
+                lines = code.lstrip(u" \t").splitlines()
+                
+                #When single line code part
+                if len(lines) == 1:
+                    line = lines[0].lstrip()
+                    if not line: continue
+                    line = self._regexp_flush_point.sub(ur"\g<head>yield" if flush and not functions else ur"\g<head>pass", line)
+                    cached = self._regexp_cached_block.match(line)
+                    if cached:
+                        #キャッシュがある時に本体を実行しないよう、一度だけ繰り返す for 文にする
+                        #ファイル名の無いテンプレートは、内容のハッシュで区別する
+                        name = filename or u"<string:%s>" % hashlib.sha1(template.encode("utf-8")).hexdigest()
+                        line = u"for __cached in __context.cached(%r, %s):%s" % (name, cached.group("args"), cached.group("inline"))
+                    li = self._regexp_parse_line_information.match(line)
+                    if li:
+                        li = li.groupdict()
+                        if li.get("b_start"):
+                            block = info is not None and self._regexp_block_literal.match(line)
+                            if block:
+                                block = {"name": block.group("name"), "inline": block.group("inline"), 
+                                         "start": len(c), "end": len(c) + 1, "indent": indent}
+                                info["blocks"].append(block)
+                                if not li.get("b_inline"):
+                                    opened.append(block)
+                            append(line, at)
+                            if li.get("b_inline"):
+                                last_inline_block_row = 0
+                            else:
+                                indent += 1
+                                if self._regexp_function_start.match(line):
+                                    functions.append(indent)
+                        elif li.get("b_restart"):
+                            if not last_inline_block_row == -1:
+                                indent -= 1
+                            append(line, at)
+                            if li.get("b_inline"):
+                                last_inline_block_row = 0
+                            else:
+                                indent += 1
+                        elif li.get("b_end"):
+                            indent -= 1
+                            if functions and functions[-1] > indent:
+                                functions.pop()
+                            if opened and opened[-1]["indent"] == indent:
+                                opened.pop()["end"] = len(c)
+                        else:
+                            if info is not None and indent == base and self._regexp_extends_literal.match(line):
+                                info["extends"].append((len(c), line))
+                            include = self.inline and self._inline_include(line, base, stack)
+                            if include:
+                                includes.append(include + (len(c), indent))
+                                append(u"pass", at)
+                            else:
+                                append(line, at)
+
+                #When multi line cord part
+                else:
+                    if lines.pop(0).rstrip():
+                        raise SyntaxError("""Must be Empty at the block start line ("<%%"), when write multi lines to code block (line %d)"""
+                                          % at[1])
+                    for i, line in enumerate(lines):
+                        line = line.rstrip()
+                        if line:
+                            base_indent = self._regexp_find_first_char_in_line.search(line).start()
+                            break
+                    for n, line in enumerate(lines[i:], at[1] + i + 1):
+                        line = line.rstrip()
+                        if line:
+                            append(line[base_indent:], (filename, n))
+
+        if includes:
+            #呼び出し元のローカル変数が確定してから、子テンプレートの関数と呼び出しを生成する
+            #子テンプレートが読むだけの呼び出し元のローカル変数は、クロージャで参照する。代入の前や代入されない分岐でも、
+            #__render の先頭で同名のテンプレート変数に束縛されているので（_bind_assigned）、実行時の include と同じ値になる
+            defs = []
+            local_names = self._local_names(c, base, params)
+            for name, names, kwargs, body, child_locals, index, indent in includes:
+                args = [kwargs] if kwargs else []
+                prologue = []
+                for n in sorted(child_locals):
+                    if n in local_names:
+                        args.append(u"%s=%s" % (n, n))
+                        names.append(n)
+                    else:
+                        prologue.append(u'%sif "%s" in __vars: %s = __vars["%s"]\n' % ("    " * (base + 1), n, n, n))
+                defs.append(u"%sdef %s(%s):\n" % ("    " * base, name, u", ".join(names)))
+                defs.extend(prologue)
+                defs.extend(body)
+                defs.append(u"%spass\n" % ("    " * (base + 1)))
+                c[index] = _Line(u"%s%s(%s)\n" % ("    " * indent, name, u", ".join(args)), c[index].origin)
+            c[0:0] = defs
+            if info is not None:
+                for i, text in enumerate(info["texts"]):
+                    info["texts"][i] = text + len(defs)
+                for i, (index, line) in enumerate(info["extends"]):
+                    info["extends"][i] = (index + len(defs), line)
+                for block in info["blocks"]:
+                    block["start"] += len(defs)
+                    block["end"] += len(defs)
+        return c
+
+
+    def _search_code_part(self, s, pos, memo):
+        """ s の pos 以降で、最初のコードパートを探します。
+        見つかった時は (開始位置, 終了位置, コード, print_expr, raw_mode) を、見つからない時は None を返します。
+        コードパートの開始は、次のいずれかです。同じ位置では、この順に試します。
+            * "<%=" と "<%=r "（print_expr）
+            * 行頭から空白だけが続く "<%-"（行頭の空白も、コードパートに含めます）
+            * "<%%" ではない "<%" と "<%-"
+        コードは、文字列リテラルの外の最初の "%>" の直前の１文字の前までです。
+        "-%>" の後に空白と改行だけが続く時は、最初の改行までをコードパートに含めます。
+        memo は _scan_code を参照。
+        """
+        find, scan = s.find, self._scan_code
+        line_start, last = (pos if pos == 0 or s[pos - 1] == u"\n" else -1), pos
+        j = find(u"<%", pos)
+        while j != -1:
+            c = s[j + 2:j + 3]
+            if c == u"=":
+                if s[j + 3:j + 5] == u"r ":
+                    tries = ((j, j + 5, True, True), (j, j + 3, True, False), (j, j + 2, False, False))
+                else:
+                    tries = ((j, j + 3, True, False), (j, j + 2, False, False))
+            elif c == u"-":
+                newline = s.rfind(u"\n", last, j)
+                if newline != -1:
+                    line_start = newline + 1
+                last = j
+                if line_start != -1 and self._regexp_match_indent.match(s, line_start).end() == j:
+                    tries = ((line_start, j + 3, False, False), (j, j + 2, False, False))
+                else:
+                    tries = ((j, j + 3, False, False), (j, j + 2, False, False))
+            elif c == u"%":
+                tries = ()
+            else:
+                tries = ((j, j + 2, False, False),)
+            for start, begin, print_expr, raw_mode in tries:
+                stop = scan(s, begin, memo)
+                if stop:
+                    return (start, stop[1], s[begin:stop[0]], print_expr, raw_mode)
+            j = find(u"<%", j + 1)
+        return None
+
+
+    def _scan_code(self, s, begin, memo):
+        """ begin から始まるコードの終端を探し、(コードの終了位置, コードパートの終了位置) を返します。
+        終端が無い時は None を返します。
+        コードは、文字列リテラル、"%>" ではない１文字の順に読み進め、終端が無い時は読み戻します。
+        引用符や "%>" の無い範囲は、まとめて読み進めます。
+        memo は、テンプレートの走査中に共有する dict で、次の値を保持します。
+            failed: そこから終端に至らない位置の set
+            stop: 最後に探した、引用符か "%>" の位置。(探し始めの位置, 見つかった位置, 見つかった文字列)
+        """
+        #引用符の無いコードは、最初の "%>" が終端
+        start, stop, found = memo.get("stop", (-1, -1, None))
+        if not start <= begin <= stop:
+            m = self._regexp_search_code_stop.search(s, begin)
+            start, stop, found = memo["stop"] = (begin, m.start(), m.group()) if m else (begin, len(s), None)
+        if found == u"%>" and stop > begin and s[stop - 1] != u"%":
+            if s[stop - 1] == u"-":
+                newline = self._regexp_match_trim_newline.match(s, stop + 2)
+                return (stop - 1, newline.end() if newline else stop + 2)
+            return (stop - 1, stop + 2)
+        
+        strings, length = self._regexp_match_string, len(s)
+        failed = memo.setdefault("failed", set())
+        if begin in failed:
+            return None
+        
+        def search(i):
+            start, stop, found = memo["stop"]
+            if not start <= i <= stop:
+                m = self._regexp_search_code_stop.search(s, i)
+                start, stop, found = memo["stop"] = (i, m.start(), m.group()) if m else (i, length, None)
+            return stop, found
+        
+        stack = [[begin, 0, begin]]
+        while stack:
+            frame = stack[-1]
+            i, state = frame[0], frame[1]
+            if state == 0:
+                #文字列リテラル
+                frame[1] = 1
+                string = s[i:i + 1] in strings and strings[s[i]].match(s, i)
+                if string and string.end() not in failed:
+                    stack.append([string.end(), 0, string.end()])
+                    continue
+            if state <= 1:
+                #"%>" ではない１文字と、その後の引用符も "%>" も無い範囲
+                frame[1] = 2
+                if i < length and not s.startswith(u"%>", i):
+                    stop, found = search(i + 1)
+                    frame[2] = stop
+                    if found and found != u"%>" and stop not in failed:
+                        stack.append([stop, 0, stop])
+                        continue
+            #読み戻して、終端を探す
+            for j in (frame[2] - 1, i):
+                if j >= i and s.startswith(u"%>", j + 1):
+                    if s[j] == u"-":
+                        newline = self._regexp_match_trim_newline.match(s, j + 3)
+                        return (j, newline.end() if newline else j + 3)
+                    elif s[j] != u"%":
+                        return (j, j + 3)
+            failed.add(i)
+            stack.pop()
+        return None
+
+
+    def _minify(self, text, state):
+        """ テキストパート text の HTML の空白を詰め、self.minify が "comments" の時はコメントを取り除いて返します。
+        pre などの要素は、テキストパートをまたいで続くことがある為、要素の中にいるかどうかを state に保存します。
+        """
+        result, pos, lower = [], 0, None
+        while pos < len(text):
+            if state.get("raw"):
+                lower = lower or text.lower()
+                end = lower.find(u"</%s" % state["raw"], pos)
+                if end == -1:
+                    result.append(text[pos:])
+                    break
+                result.append(text[pos:end])
+                state["raw"], pos = None, end
+            m = self._regexp_minify_raw_start.search(text, pos)
+            chunk = text[pos:m.start() if m else len(text)]
+            if self.minify == "comments":
+                chunk = self._regexp_minify_comment.sub(u"", chunk)
+            result.append(self._regexp_minify_space.sub(lambda space: u"\n" if u"\n" in space.group() else u" ", chunk))
+            if not m:
+                break
+            result.append(m.group())
+            state["raw"], pos = m.group(1).lower(), m.end()
+        return u"".join(result)
+
+
+    def _optimize(self, outputs):
+        """ コードの行の間の出力のリストを最適化して返します。
+        出力は ("text", 文字列リテラルのソースコード, 位置), ("filter", 式, 位置), ("raw", 式, 位置) のいずれかで、
+        ("unicode", 式, 位置) は、__tostr を通さずに出力できる式を表します。位置は、テンプレート上の位置です。
+            * リテラルの式は、コンパイル時に unicode に変換し、raw の時はテキストにします
+            * __tostr を通さなくても unicode になる式は、そのまま出力します
+            * 連続するテキストは、ひとつにまとめます
+        """
+        result = []
+        for op in outputs:
+            kind, code, at = op
+            if kind != "text":
+                try:
+                    if not self._regexp_match_literal.match(code):
+                        raise ValueError(code)
+                    value = ast.literal_eval(code)
+                except (SyntaxError, ValueError):
+                    if kind == "raw" and self._is_unicode_expr(code):
+                        op = ("unicode", code, at)
+                else:
+                    if value is None or isinstance(value, (basestring, int, long, float)) and \
+                            not self._regexp_search_control_char.search(helper.tostr(value)):
+                        value = helper.tostr(value)
+                        text = value.replace(u"\\", u"\\\\").replace(u'"', u'\\"')
+                        op = ("text", text, at) if kind == "raw" else (kind, u'u"""%s"""' % text, at)
+            if op[0] == "text" and result and result[-1][0] == "text":
+                result[-1] = ("text", result[-1][1] + op[1], result[-1][2])
+            elif op[:2] != ("text", u""):
+                result.append(op)
+        return result
+
+
+    def _is_unicode_expr(self, code):
+        """ 式 code の値が、常に unicode になる時に True を返します。
+        unicode のリテラルと、それに対する + や % の演算、join と format の呼び出しを判定します。
+        """
+        try:
+            node = ast.parse(code.strip(), mode="eval").body
+        except SyntaxError:
+            return False
+        while True:
+            if isinstance(node, ast.Str):
+                return isinstance(node.s, unicode)
+            elif isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Mod)):
+                node = node.left
+            elif isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr in ("join", "format"):
+                node = node.func.value
+            else:
+                return False
+
+
+    def _output_code(self, op):
+        """ 最適化された出力を、__append の呼び出しのソースコードにして返します。"""
+        kind, code = op[:2]
+        if kind == "text":
+            return u'__append(u"""%s""")' % code
+        elif kind == "unicode":
+            return u"__append(%s)" % code
+        elif kind == "raw":
+            return u"__append(__tostr(%s))" % code
+        else:
+            return u"__append(__filter(%s))" % code
+
+
+    def _inherit(self, template, params, stack, flush, overrides):
+        """ テンプレートを関数本体のソースコードの行のリストに変換します。
+        inline の時、path が文字列リテラルの extends は、親テンプレートを続けて展開し、ひとつの関数にします。
+        子テンプレートの直下の block の出力は、親テンプレートのブロックの位置にそのまま移されます。
+        args:
+            overrides: 子テンプレートで定義されたブロック名と、その出力を保存する変数名の dict
+        """
+        info = {"texts": [], "blocks": [], "extends": []}
+        c = self._generate(template, 1, params, stack, flush, info)
+        parent = self.inline and self._inline_extends(template, info, stack)
+        if parent and flush:
+            #子テンプレートの出力は捨てられるので、フラッシュポイントは親テンプレートのものだけを使う
+            info = {"texts": [], "blocks": [], "extends": []}
+            c = self._generate(template, 1, params, stack, False, info)
+        
+        #子テンプレートで定義されたブロックは、保存された出力に置き換える
+        sites, end = [], 0
+        for block in sorted(info["blocks"], key=lambda b: b["start"]):
+            if block["name"] in overrides and block["start"] >= end:
+                sites.append(block)
+                end = block["end"]
+        for block in sites:
+            c[block["start"]] = _Line(u"%s__context.buffer.extend(%s)\n" % ("    " * block["indent"], overrides[block["name"]]), c[block["start"]].origin)
+            c[block["start"] + 1:block["end"]] = [u""] * (block["end"] - block["start"] - 1)
+        if not parent:
+            return c
+        
+        index, source, filename, kwargs, names = parent
+        
+        #キーワード引数は、実行時の extends と同じく、extends の位置で評価する
+        assigns = []
+        if names:
+            self._include_count += 1
+            saved = u"__kwargs_%d" % self._include_count
+            c[index] = _Line(u"    %s = __builtin__.dict(%s)\n" % (saved, kwargs), getattr(c[index], "origin", None))
+            assigns.extend(u'    %s = %s["%s"]\n' % (n, saved, n) for n in names)
+        else:
+            c[index] = u""
+        for text in info["texts"]:
+            c[text] = u""
+        
+        #直下のブロックは、出力をリストで保存し、親テンプレートのブロックの位置でバッファに戻す
+        blocks = dict(overrides)
+        for block in info["blocks"]:
+            if block["indent"] == 1 and block["name"] not in blocks:
+                self._include_count += 1
+                name = blocks[block["name"]] = u"__block_%d" % self._include_count
+                c[block["start"]] = _Line(u"    %s = __builtin__.len(__context.buffer)\n    if True:%s\n" % (name, block["inline"]), c[block["start"]].origin)
+                c[block["end"] - 1] = _Line(c[block["end"] - 1] + u"    %s = __context.buffer[%s:]\n" % (name, name), getattr(c[block["end"] - 1], "origin", None))
+        lines = self._inherit(source, params, stack + [filename], flush, blocks)
+        
+        #子テンプレートの出力は、保存したブロックを除いて捨てる
+        self._include_count += 1
+        mark = u"__mark_%d" % self._include_count
+        if filename not in self.depends:
+            self.depends.append(filename)
+        return ([u"    %s = __context.begin_capture()\n" % mark] + c +
+                [u"    __context.discard_capture(%s)\n" % mark] + assigns + lines)
+
+
+    def _inline_extends(self, template, info, stack):
+        """ template が、直下でリテラルの path の extends をひとつだけ呼び出している時、親テンプレートを展開する為の情報を返します。
+        展開できない時は None を返します。
+        戻り値: (extends の行の位置, 親テンプレート, ファイル名, キーワード引数のソースコード, キーワード引数名のリスト)
+        """
+        if len(info["extends"]) != 1 or len(self._regexp_extends_call.findall(template)) != 1 or not self.loader:
+            return None
+        index, line = info["extends"][0]
+        m = self._regexp_extends_literal.match(line)
+        kwargs = m.group("kwargs") or u""
+        try:
+            call = ast.parse(u"f(%s)" % kwargs).body[0].value
+        except SyntaxError:
+            return None
+        if call.args or call.starargs or call.kwargs:
+            return None
+        source, filename = self.loader(m.group("path"))
+        if filename in stack:
+            return None
+        return index, source, filename, kwargs.strip(), [kw.arg for kw in call.keywords]
+
+
+    def _inline_include(self, line, indent, stack):
+        """ line がリテラルの path の include 呼び出しの時、子テンプレートを関数として展開する為の情報を返します。
+        展開できない時は None を返します。
+        戻り値: (関数名, キーワード引数名のリスト, キーワード引数のソースコード, 関数本体の行のリスト, 子テンプレートで代入される変数名の set)
+        """
+        m = self._regexp_include_literal.match(line)
+        if not m or not self.loader:
+            return None
+        kwargs = m.group("kwargs") or u""
+        try:
+            call = ast.parse(u"f(%s)" % kwargs).body[0].value
+        except SyntaxError:
+            return None
+        names = [kw.arg for kw in call.keywords]
+        if call.args or call.starargs or call.kwargs or "capture_as" in names:
+            return None
+        
+        source, filename = self.loader(m.group("path"))
+        if filename in stack or self._regexp_extends_call.search(source):
+            return None
+        body = self._generate(source, indent + 1, names, stack + [filename])
+        if self._uses_template_vars(body, indent + 1, names):
+            return None
+        child_locals = self._local_names(body, indent + 1, names) - set(names)
+        if filename not in self.depends:
+            self.depends.append(filename)
+        self._include_count += 1
+        return (u"__include_%d" % self._include_count, names, kwargs.strip(), body, 
+                set(n for n in child_locals if not n.startswith("__")))
+
+
+    def _local_names(self, lines, indent, params):
+        """ indent の深さの lines を本体とする関数の、ローカル変数名の set を返します。"""
+        src = self._function_source(lines, indent, params)
+        table = [t for t in symtable.symtable(src, "<eepy>", "exec").get_children() if t.get_name() == "__f"][0]
+        return set(table.get_locals())
+
+
+    def _uses_template_vars(self, lines, indent, params):
+        """ indent の深さの lines が、capture や locals() などで、テンプレート変数の dict を直接読み書きする時 True を返します。"""
+        for node in ast.walk(ast.parse(self._function_source(lines, indent, params).encode("utf-8"))):
+            if isinstance(node, ast.Name) and node.id in self._template_vars_names:
+                return True
+            if isinstance(node, ast.keyword) and node.arg == "capture_as":
+                return True
+        return False
+
+
+    def _function_source(self, lines, indent, params):
+        """ indent の深さの lines を本体とする関数 __f のソースコードを返します。"""
+        head = u"".join(u"%sif 1:\n" % (u"    " * i) for i in range(indent - 1))
+        return u"%s%sdef __f(%s):\n%s%s    pass\n" % (head, u"    " * (indent - 1), u", ".join(params), u"".join(lines), u"    " * (indent - 1))
+
+
+    def render(self, vars={}, filter=_through):
         """ テンプレートをレンダリングし、結果を返します。
         レンダー結果は、unicode オブジェクトです。
         args:
             vars: テンプレート変数
             filter: <%= の場合の出力フィルタ。html escape などの目的で使用。デフォルトは、何もしないフィルタ。
         """
+        locals = self._prepare(vars, filter)
+        context = locals["__context"]
+        for _ in self._execute(locals):
+            pass
+        
+        if context.deferred:
+            result = _Parts(context.buffer)
+        else:
+            result = u"".join(context.buffer)
+        
+        while context.after_render:
+            hook = context.after_render.pop(0)
+            if context.deferred and not getattr(hook, "deferred", False):
+                result = _resolve(result)
+            result = hook(result, locals)
+            
+        return result
+
+
+    def render_async(self, vars={}, filter=_through):
+        """ テンプレートを別のスレッドでレンダリングし、結果を helper.Deferred で返します。
+        テンプレート変数や <%= の式の値が、helper.Deferred（または concurrent.futures.Future 互換）の時、
+        <%= ではその値を待たずにレンダリングを続け、最後に全ての値を待って、出力の位置に埋め込みます。
+        include や block の中の値も同様なので、独立した値の計算は並行して行われます。
+        args:
+            vars: テンプレート変数
+            filter: <%= の場合の出力フィルタ。
+        """
+        vars = dict(vars, __deferred=True)
+        return helper.defer(lambda: _resolve(self.render(vars, filter)))
+
+
+    def render_iter(self, vars={}, filter=_through):
+        """ テンプレートをレンダリングし、結果を unicode のチャンクで順次返すジェネレータを返します。
+        テンプレート中の "<%- flush() -%>" の位置（フラッシュポイント）で、それまでの出力をチャンクとして返します。
+        但し、次の場合はフラッシュせずにバッファリングを続けます。
+            * extends されている時（親テンプレートのレンダリングは、最後にストリームで行われます）
+            * block や capture の範囲内の時
+        include された子テンプレート内のフラッシュポイントは無視されます。
+        args:
+            vars: テンプレート変数
+            filter: <%= の場合の出力フィルタ。
+        """
+        locals = self._prepare(vars, filter)
+        context = locals["__context"]
+        buffer = context.buffer
+        for _ in self._execute(locals):
+            if buffer and not context.after_render and not context.capturing:
+                chunk = u"".join(buffer)
+                del buffer[:]
+                yield chunk
+        
+        result = u"".join(buffer)
+        del buffer[:]
+        for chunk in self._after_render(result, locals):
+            yield chunk
+
+
+    def render_to(self, fileobj, vars={}, filter=_through, encoding="utf-8", bufsize=4096):
+        """ テンプレートをレンダリングし、結果を encoding でエンコードして、出力されるそばから fileobj に書き込みます。
+        出力は bufsize 個ずつまとめてエンコードして書き込まれ、レンダリング結果の全体をメモリに持ちません。
+        concat, include, block, cached などのヘルパの出力も、同じように bufsize 個ずつ書き込まれます。
+        render_iter と同様に、extends されている時や、block や capture の範囲内の時は、書き込まずにバッファリングを続けます。
+        args:
+            fileobj: write メソッドを持つオブジェクト、または WSGI の write のような、バイト列を受け取る関数
+            vars: テンプレート変数
+            filter: <%= の場合の出力フィルタ。
+            encoding: 出力のエンコーディング
+            bufsize: 書き込むまでにバッファする出力（テキストや <%= の値）の数
+        """
+        write = getattr(fileobj, "write", fileobj)
+        locals = self._prepare(vars, filter)
+        context = locals["__context"]
+        buffer = context.buffer
+
+        def drain():
+            if buffer:
+                write(u"".join(buffer).encode(encoding))
+                del buffer[:]
+
+        def append(s, append=buffer.append, len=len):
+            append(s)
+            if len(buffer) >= bufsize and not context.capturing and not context.after_render:
+                drain()
+
+        context.append = append
+        for _ in self._execute(locals):
+            if not context.after_render and not context.capturing:
+                drain()
+        
+        if not context.after_render:
+            drain()
+            return
+        result = u"".join(buffer)
+        del buffer[:]
+        for chunk in self._after_render(result, locals):
+            write(chunk.encode(encoding))
+
+
+    def _after_render(self, result, locals):
+        """ after render フックを順に適用し、結果を unicode のチャンクで順次返すジェネレータ。
+        最後のフックがストリームを持つ時（extends）は、そのチャンクを返します。
+        """
+        hooks = locals["__context"].after_render
+        while hooks:
+            hook = hooks.pop(0)
+            stream = getattr(hook, "stream", None)
+            if stream and not hooks:
+                for chunk in stream(result, locals):
+                    yield chunk
+                return
+            result = hook(result, locals)
+        
+        if result:
+            yield result
+
+
+    def _prepare(self, vars, filter):
+        """ レンダリングに使う locals を準備します。"""
         locals ={}
         locals.update(vars)
         locals["__template"] = self
         locals["__tostr"] = helper.tostr
-        locals["__filter"] = filter
-        locals["__after_render"] = []
+        locals["__filter"] = _output_filter(filter)
+        locals["__vars"] = locals
+        locals["__locals"] = _builtin_locals
+        locals["__builtin__"] = __builtin__
+        if locals.get("__deferred"):
+            locals["__filter"] = _deferred_output(locals["__filter"])
+            locals["__tostr"] = _deferred_output(helper.tostr)
+        context = Context(locals)
+        
+        #ヘルパを Context のメソッドに置き換え、フレームを辿らずに Context が渡るようにする
+        for name in self._context_helpers:
+            f = locals.get(name)
+            if f is getattr(helper, name) or getattr(f, "im_class", None) is Context:
+                locals[name] = getattr(context, name)
+        return locals
+
+
+    def _execute(self, locals):
+        """ コンパイルされたコードを locals で実行するジェネレータ。フラッシュポイント毎に yield します。
+        出力は、Context の append に渡されます。
+        """
         bytecode = self.compile()
 
         try:
             exec bytecode in locals
+            render = locals.get("__render")
+            if render: #古い形式の２次キャッシュは、exec で実行済み
+                context = locals["__context"]
+                context.generator = render(context.append, locals["__filter"], locals["__tostr"], locals)
+                for _ in context.generator:
+                    yield
         except Exception, e :
             if self.srccode and not isinstance(e, SyntaxError):
-                m = re.match(".*line (\d+).*", traceback.format_exc(2).splitlines()[-2])
-                if m:
-                    line = int(m.group(1))
-                    e.message = ("%s\n%s" % (e.message, "\n".join(self.srccode.splitlines()[0:line]))).encode("utf-8") #TODO: ここでの encode の文字コードは決めウチでなの？ でも入れないとエラー出力が…
+                tb = sys.exc_info()[-1]
+                while tb and tb.tb_frame.f_code.co_filename != "<eepy>":
+                    tb = tb.tb_next
+                
+                #コンポーネントの中で起きた時は、コンポーネントのソースコードを示す
+                srccode, inner = self.srccode, tb and tb.tb_next
+                while inner and inner.tb_frame.f_code.co_name != "__render":
+                    if inner.tb_frame.f_code.co_name == "__component" and inner.tb_frame.f_code.co_filename == "<eepy>":
+                        tb, srccode = inner, inner.tb_frame.f_globals["__template"].srccode
+                    inner = inner.tb_next
+                if tb:
+                    line = tb.tb_lineno
+                    e.message = ("%s\n%s" % (e.message, "\n".join(srccode.splitlines()[0:line]))).encode("utf-8") #TODO: ここでの encode の文字コードは決めウチでなの？ でも入れないとエラー出力が…
                     e.args = [e.message]
             raise e, None, sys.exc_info()[-1]
+
+
+    def _declare_globals(self, srccode):
+        """ capture や include(capture_as=...) の保存先、captured_as の参照先として、文字列リテラルで指定された変数のうち、
+        __render 関数で代入されるものを global と宣言するコードの行を返します。
+        これらの変数はテンプレート変数の dict で読み書きされるので、ローカル変数にすると、保存された値が見えなくなる為です。
+        """
+        table = [t for t in symtable.symtable(srccode, "<eepy>", "exec").get_children() if t.get_name() == "__render"][0]
+        assigned, names = set(table.get_locals()), set()
+        for node in ast.walk(ast.parse(srccode.encode("utf-8"))):
+            if not isinstance(node, ast.Call):
+                continue
+            if isinstance(node.func, ast.Name) and node.func.id in ("capture", "captured_as") and node.args:
+                names.add(node.args[0])
+            names.update(keyword.value for keyword in node.keywords if keyword.arg == "capture_as")
+        names = sorted(node.s for node in names if isinstance(node, ast.Str) and node.s in assigned)
+        return [u"    global %s\n" % u", ".join(names)] if names else []
+
+
+    def _bind_template_locals(self, srccode):
+        """ __render 関数で locals() を参照していれば、Context.export_locals に束縛するコードの行を返します。
+        テンプレートの locals() は、これまで通りテンプレート変数の dict を返すようにする為です。
+        関数定義などの内側で参照されている時は、その関数の locals() の意味が変わってしまうので、束縛しません。
+        """
+        table = [t for t in symtable.symtable(srccode, "<eepy>", "exec").get_children() if t.get_name() == "__render"][0]
+        tables = list(table.get_children())
+        while tables:
+            t = tables.pop()
+            if "locals" in t.get_identifiers():
+                return []
+            tables.extend(t.get_children())
+        if "locals" in table.get_identifiers():
+            sym = table.lookup("locals")
+            if sym.is_global() and not sym.is_declared_global():
+                return [u"    locals = __context.export_locals\n"]
+        return []
+
+
+    def _bind_assigned(self, srccode):
+        """ __render 関数で代入される変数を、同名のテンプレート変数があれば、その値に束縛するコードの行を返します。
+        代入より前や、代入されない分岐でも、テンプレート変数の値が参照できるようにする為です。
+        """
+        table = [t for t in symtable.symtable(srccode, "<eepy>", "exec").get_children() if t.get_name() == "__render"][0]
+        params = table.get_parameters()
+        return [u'    if "%s" in __vars: %s = __vars["%s"]\n' % (name, name, name)
+                for name in sorted(table.get_locals()) if not name.startswith("__") and name not in params]
+
+
+    def _bind_locals(self, srccode):
+        """ __render 関数が参照するグローバル変数を、ローカル変数に束縛するコードの行を返します。
+        テンプレート中の文字列リテラルと同名の変数は、capture などで動的に設定される可能性がある為、束縛しません。
+        __render 関数で代入される変数は、_bind_assigned で束縛されるので、ここでは除きます。
+        """
+        table = [t for t in symtable.symtable(srccode, "<eepy>", "exec").get_children() if t.get_name() == "__render"][0]
+        names, literals, tables, codes = set(), set(), [table], [compile(srccode, "<eepy>", "exec")]
+        while tables:
+            t = tables.pop()
+            tables.extend(t.get_children())
+            for sym in t.get_symbols():
+                if sym.is_global() and not sym.is_declared_global():
+                    names.add(sym.get_name())
+        while codes:
+            for const in codes.pop().co_consts:
+                if isinstance(const, types.CodeType):
+                    codes.append(const)
+                elif isinstance(const, basestring):
+                    literals.add(const)
+        names.difference_update(table.get_parameters(), literals, table.get_locals())
         
-        result = u"".join(locals["__buffer"])
-        
-        while locals["__after_render"]:
-            hook = locals["__after_render"].pop(0)
-            result = hook(result, locals)
-            
-        return result
+        lines = []
+        for name in sorted(names):
+            if name.startswith("__") or name in ("None", "True", "False"):
+                continue
+            elif hasattr(__builtin__, name):
+                lines.append(u'    %s = __vars.get("%s", __builtin__.%s)\n' % (name, name, name))
+            else:
+                lines.append(u'    if "%s" in __vars: %s = __vars["%s"]\n' % (name, name, name))
+        return lines
 
 
-    def get_cache_data(self):
-        """ ２次キャッシュで保存するテンプレートのデータを dict で返します。
-        ここでは、srccode と bytecode を返しています。
+    def origin(self, lineno):
+        """ srccode の行番号 lineno に対応する、テンプレート上の位置 (ファイル名, 行番号) を返します。
+        ソースマップの無い srccode（古い形式の２次キャッシュなど）の時は None を返します。
         """
-        return {"srccode": self.srccode, "bytecode": self.bytecode}
+        if self._source_map is None:
+            self._source_map = self._parse_source_map(self.srccode or u"")
+        linenos, origins = self._source_map
+        i = bisect.bisect_right(linenos, lineno) - 1
+        return origins[i] if i >= 0 else None
+
+
+    def _source_map_comment(self, lines):
+        """ 生成した行のリストから、ソースマップを記録するコメントの行を返します。
+        ソースマップは、テンプレート上の位置が変わる srccode の行番号と、その位置のリストです。
+        テンプレートの行に対応しない、関数の定義などの行は、テンプレートの 0 行目とします。
+        srccode の最後に置かれるので、２次キャッシュやバンドルにもそのまま保存されます。
+        """
+        files, entries, last, lineno = [self.filename], [[1, 0, 0]], (self.filename, 0), 1
+        for line in lines:
+            origin = getattr(line, "origin", None)
+            if origin and origin != last:
+                if origin[0] not in files:
+                    files.append(origin[0])
+                entries.append([lineno, files.index(origin[0]), origin[1]])
+                last = origin
+            lineno += line.count(u"\n")
+        self._source_map = None
+        return u"%s%s\n" % (self._source_map_prefix, json.dumps({"files": files, "lines": entries}))
+
 
+    def _parse_source_map(self, srccode):
+        """ srccode のソースマップのコメントを読み、(行番号のリスト, 位置のリスト) を返します。"""
+        i = srccode.rfind(self._source_map_prefix)
+        if i == -1:
+            return [], []
+        data = json.loads(srccode[i + len(self._source_map_prefix):])
+        return [e[0] for e in data["lines"]], [(data["files"][e[1]], e[2]) for e in data["lines"]]
 
-    _regexp_search_code_part = re.compile(ur"""("""
-                                    r"""(?P<print_expr><%=(?P<raw_mode>(r )?))"""
-                                    r"""|(^[ \t]*<%\-)"""
-                                    r"""|(<%(?!%)(?:\-?))"""
-                                r""")(?P<code>("([^\\"]|\\.)*"|'([^\\']|\\.)*'|(?:(?!(%>)).))*"""
-                                r""")((\-%>\s*?[\n])|([^%]%>))"""
-                                , re.M|re.S)
+
+    def get_compile_options(self):
+        """ このテンプレートの、srccode に影響するコンパイルオプションを返します。詳しくは _compile_options を参照 """
+        return _compile_options(self.fastlocals, self.inline, self.minify)
+
+
+    def get_cache_data(self):
+        """ ２次キャッシュで保存するテンプレートのデータを dict で返します。
+        ここでは、srccode と bytecode と、inline で展開した子テンプレートのファイル名を返しています。
+        """
+        return {"srccode": self.srccode, "bytecode": self.bytecode, "depends": self.depends}
+
+
+    _context_helpers = ("concat", "include", "extends", "block", "capture", "captured_as", "component")
+    _template_vars_names = ("capture", "captured_as", "locals", "context", "buffer_frame_locals")
+    _component_scoped_names = ("include", "capture", "captured_as", "context", "buffer_frame_locals", "__vars")
+    _source_map_prefix = u"#eepy-source-map: "
+    _regexp_search_code_stop = re.compile(ur"""%>|["']""")
+    _regexp_match_string = {u'"': re.compile(ur'"[^"\\]*(?:\\.[^"\\]*)*"', re.S),
+                            u"'": re.compile(ur"'[^'\\]*(?:\\.[^'\\]*)*'", re.S)}
+    _regexp_match_trim_newline = re.compile(ur"[^\S\n]*\n")
+    _regexp_match_indent = re.compile(ur"[ \t]*")
+    _regexp_match_literal = re.compile(ur"""\s*(?:[-+]?\s*[\d.]|[uUbB]?[rR]?["']|(?:None|True|False)\s*$)""")
     _regexp_parse_line_information = re.compile(ur"^("
                                        r"(("
                                            r"(?P<b_start>(if|for|try|with|def|class))|"
@@ -514,128 +1570,1458 @@ class Template(object):
                                        r"|(?P<other>.*)"
                                     r")$")
     _regexp_search_multi_line = re.compile(ur"\s*\\\n\s*")
+    _regexp_include_literal = re.compile(ur"""^include\(\s*u?(?P<q>["'])(?P<path>[^"'\\]+)(?P=q)\s*(,(?P<kwargs>.*))?\)$""")
+    _regexp_extends_call = re.compile(ur"\bextends\s*\(")
+    _regexp_extends_literal = re.compile(ur"""^extends\(\s*u?(?P<q>["'])(?P<path>[^"'\\]+)(?P=q)\s*(,(?P<kwargs>.*))?\)$""")
+    _regexp_block_literal = re.compile(ur"""^with\s+block\(\s*u?(?P<q>["'])(?P<name>[^"'\\]+)(?P=q)\s*\)\s*:(?P<inline>.*)$""")
+    _regexp_cached_block = re.compile(ur"^with\s+cached\((?P<args>.*)\)\s*:(?P<inline>.*)$")
+    _regexp_flush_point = re.compile(ur"(?P<head>^(.*:\s*)?)flush\(\)$")
+    _regexp_function_start = re.compile(ur"^(def|class)\b")
     _regexp_find_first_char_in_line = re.compile(ur"[^\s]")
+    _regexp_search_control_char = re.compile(ur"[\x00-\x08\x0b-\x1f\x7f]")
+    _regexp_minify_raw_start = re.compile(ur"<(pre|textarea|script|style)\b", re.I)
+    _regexp_minify_space = re.compile(ur"[ \t\n\r\f]+")
+    _regexp_minify_comment = re.compile(ur"<!--(?!\[if|<!)(?:(?!-->).)*-->", re.S)
 
 
-class Renderer(object):
-    """ ファイルベースでテンプレートを読み込み、処理します。
-    ファイルを読み込む、ベースディレクトリを指定できます。
-    オンメモリに Template インスタンスがキャッシュされます。
-    ファイルや、その他のストレージを利用した２次キャッシュを利用することが出来ます。
-    レンダリングの際に使われる共通のテンプレート変数を設定できます。
+class Context(object):
+    """ レンダリング中のテンプレートの状態を保持します。
+    出力バッファ、ブロック、after render フック、renderer を持ち、テンプレートのコードからは __context として参照できます。
+    concat や include などのヘルパは、このクラスのメソッドとして実装されています。
     """
-    def __init__(self, base=None, cache=None, filter=lambda s: s, vars={}, encoding=sys.getdefaultencoding()):
+
+    def __init__(self, locals):
         """
         args:
-            base: 読み込みファイルのベースディレクトリの指定
-            cache: ２次キャッシュの実装クラスの指定
-            filter: <%= で値の出力の前に通過するフィルタ。html escape などの目的に使用
-            vars: レンダリングに使われる共通のテンプレート変数。
-            encoding: 入力ファイルのエンコード指定。未指定の時、sys.getdefaultencoding() の値
+            locals: テンプレートのコードのグローバルとなる変数の dict
         """
-        self.vars = vars
-        self.base = base
-        self.cache = cache
-        self.filter = filter
-        self.encoding = encoding
-        self.fastcache = {}
+        self.locals = locals
+        self.buffer = []
+        self.append = self.buffer.append #出力を buffer に追加する関数。render_to では、追加の度に書き込みを判断するものに置き換えます
+        self.blocks = locals.setdefault("__blocks", {})
+        self.after_render = []
+        self.capturing = 0
+        self.redirects = [] #buffer_frame_locals の __buffer の差し替え先と、差し替えた時の buffer の長さ
+        self.generator = None
+        self.deferred = locals.get("__deferred", False)
+        locals["__context"] = self
+        locals["__buffer"] = self.buffer
+        locals["__after_render"] = self.after_render
+
+
+    @property
+    def renderer(self):
+        return self.locals.get("renderer")
+
+
+    def snapshot(self):
+        """ テンプレートのコードのローカル変数を含めた、現在のテンプレート変数のコピーを返します。"""
+        locals = self.locals.copy()
+        frame = self.generator and self.generator.gi_frame
+        if frame:
+            for name, value in frame.f_locals.iteritems():
+                if not name.startswith("__"):
+                    locals[name] = value
+        return locals
+
+
+    def export_locals(self):
+        """ 呼び出し元のテンプレートのローカル変数をテンプレート変数に書き出し、テンプレート変数の dict を返します。
+        テンプレートの locals() は、このメソッドに束縛されます（Template._bind_template_locals）。
+        """
+        frame = sys._getframe(1)
+        for name, value in frame.f_locals.iteritems():
+            if not name.startswith("__"):
+                self.locals[name] = value
+        return self.locals
 
 
-    def clear(self):
-        self.fastcache = {}
+    def render(self, path, locals):
+        """ renderer があれば renderer で、無ければ Template で path をレンダリングします。"""
+        if "renderer" in locals:
+            return locals["renderer"].render(path, locals)
+        else:
+            return Template(path).render(locals)
 
 
-    def render(self, path, vars={}, filter=None):
-        """ ファイルを指定し、レンダリング結果を返します。
-        args:
-            path: ファイルパス。フルパスまたは self.base からの相対パスで指定
-            vars: テンプレート変数。__init__ で設定した vars より優先
-        """
-        if self.base:
-            path = os.path.join(self.base, path)
-        
-        #Use fast cache
-        if path in self.fastcache:
-            if logger: logger.info("Use fast cache (path=%s)" % repr(path))
-            t = self.fastcache.get(path)
-        #Use 2nd cache
-        elif self.cache:
-            t = self.cache.get(path)
-            if not t:
-                #Load and compile template
-                if logger: logger.info("Load template file (path=%s)" % repr(path))
-                t = Template(codecs.open(path, encoding=self.encoding))
-                t.compile()
-                self.cache.set(path, t)
-            self.fastcache[path] = t
-        #Load and compile template
-        else:
-            if logger: logger.info("Load template file (path=%s)" % repr(path))
-            t = Template(codecs.open(path, encoding=self.encoding))
-            self.fastcache[path] = t
-        
-        locals = self.vars.copy()
+    def concat(self, text, _locals=None):
+        """ helper.concat を参照 """
+        self.append(helper.tostr(text))
+
+
+    def include(self, path, capture_as=None, **vars):
+        """ helper.include を参照 """
+        locals = self.snapshot()
         locals.update(vars)
-        locals["renderer"] = self
-        return t.render(locals, filter or self.filter)
+        result = self.render(path, locals)
+        if capture_as:
+            self.locals[capture_as] = helper.Markup(_resolve(result))
+        else:
+            self.append(result)
 
 
-@_module
-def cache():
-    """ ２次キャッシュ関連のモジュール
-    """
-    import marshal
+    def component(self, path, *params):
+        """ helper.component を参照 """
+        renderer = self.locals.get("renderer")
+        if renderer:
+            func = renderer.component(path, *params)
+        else:
+            func = Template(path).compile_component(params, self.locals)
+        return functools.partial(func, self, self.append, self.locals["__filter"], self.locals["__tostr"], self.locals)
 
-    class CacheStorage(object):
-        """ ２次キャッシュの処理実装の為の抽象クラス。"""
-        def __init__(self, builder=Template):
-            self.builder = builder
-    
-        def get(self, path):
-            data = self._load(path)
-            if data:
-                if data.pop("__cache_timestamp__") == os.path.getmtime(path):
-                    return self.builder(**data)
-                if logger: logger.info("Cache is old (file=%s)"  % repr(path))
+
+    def extends(self, path, **vars):
+        """ helper.extends を参照 """
+        def do_extends(result, locals):
+            locals.update(vars)
+            return self.render(path, locals)
+
+        def do_extends_stream(result, locals):
+            locals.update(vars)
+            if "renderer" in locals:
+                return locals["renderer"].render_iter(path, locals)
+            else:
+                return Template(path).render_iter(locals)
+
+        do_extends.stream = do_extends_stream
+        do_extends.deferred = True #子テンプレートの出力は使わないので、出力待ちの値を待たない
+        self.after_render.insert(0, do_extends)
+
+
+    def enter_component(self, globals):
+        """ コンポーネントの呼び出しごとの Context を返します。
+        出力先などは self と共有し、テンプレート変数は、コンポーネントのグローバル変数と引数になります。
+        """
+        return _ComponentContext(self, globals)
+
+
+    def legacy_buffer(self):
+        """ buffer_frame_locals の __buffer の値を返します。
+        差し替えられている時は、差し替え以降の出力を buffer から差し替え先のリストに移して返します。
+        """
+        if not self.redirects:
+            return self.buffer
+        target, mark = self.redirects[-1]
+        target.extend(self.buffer[mark:])
+        del self.buffer[mark:]
+        return target
+
+
+    def redirect_buffer(self, target):
+        """ buffer_frame_locals の __buffer への代入。出力先を target に差し替えるか、差し替える前のリストに戻します。
+        テンプレートの __append は buffer に束縛されているので、出力は buffer に追加され、legacy_buffer で移されます。
+        差し替えている間は、キャプチャ中として扱います。
+        """
+        if target is self.legacy_buffer():
+            return
+        if target is self.buffer or any(target is t for t, mark in self.redirects):
+            while self.redirects and self.redirects[-1][0] is not target:
+                self.legacy_buffer()
+                self.redirects.pop()
+                self.capturing -= 1
+        else:
+            self.redirects.append((target, len(self.buffer)))
+            self.capturing += 1
+
+
+    def begin_capture(self):
+        """ キャプチャを開始し、end_capture に渡す開始位置を返します。
+        キャプチャ中は、render_iter のフラッシュは行われません。
+        """
+        self.capturing += 1
+        return len(self.buffer)
+
+
+    def discard_capture(self, mark):
+        """ begin_capture からの出力を buffer から取り除き、捨てます。"""
+        del self.buffer[mark:]
+        self.capturing -= 1
+
+
+    def end_capture(self, mark):
+        """ begin_capture からの出力を buffer から取り除き、unicode で返します。
+        render_async で、出力待ちの値を含む時は _Parts で返します。
+        """
+        captured = self.buffer[mark:]
+        del self.buffer[mark:]
+        self.capturing -= 1
+        if self.deferred and not all(isinstance(part, unicode) for part in captured):
+            return _Parts(captured)
+        return u"".join(captured)
+
+
+    @contextlib.contextmanager
+    def block(self, blockname="content"):
+        """ helper.block を参照 """
+        mark = self.begin_capture()
+        yield
+        captured = self.end_capture(mark)
+
+        #既に保存されたブロックがあれば、保存している内容を出力し、ここでのキャプチャ結果は破棄
+        if blockname in self.blocks:
+            self.append(self.blocks[blockname]) #仕様：利用後も削除せずに残しておく
+        
+        #保存されたブロックが無ければ、キャプチャ結果をブロックとして保存し、出力もする
+        else:
+            self.append(captured)
+            self.blocks[blockname] = captured if isinstance(captured, _Parts) else helper.Markup(captured)
+
+
+    @contextlib.contextmanager
+    def capture(self, name_or_callback, _locals=None):
+        """ helper.capture を参照 """
+        mark = self.begin_capture()
+        yield
+        captured = helper.Markup(_resolve(self.end_capture(mark)))
+        if isinstance(name_or_callback, types.FunctionType):
+            name_or_callback(captured, self.locals)
+        else:
+            if isinstance(name_or_callback, tuple):
+                container, name = name_or_callback
+            else:
+                container, name = self.locals, name_or_callback
+            container[name] = captured
+
+
+    def cached(self, template, key, ttl=None):
+        """ helper.cached を参照。
+        キャッシュが無い時だけ一度 yield するジェネレータで、with cached(...) はこの for 文にコンパイルされます。
+        """
+        renderer = self.renderer
+        storage = (renderer.fragments or renderer.get_fragments()) if renderer else cache.fragments
+        key = (template, key)
+        value = storage.get(key)
+        if value is None:
+            mark = self.begin_capture()
+            yield
+            value = _resolve(self.end_capture(mark))
+            storage.set(key, value, ttl)
+        self.append(value)
+
+
+    def captured_as(self, name):
+        """ helper.captured_as を参照 """
+        if isinstance(name, tuple):
+            container, name = name
+        else:
+            container = self.locals
+        if name in container:
+            self.concat(container[name])
+            return True
+        else:
+            return False
+
+
+class _ComponentContext(Context):
+    """ コンポーネントの呼び出しごとの Context。Context.enter_component で作られます。
+    出力バッファ、ブロック、after render フック、キャプチャの状態は、呼び出し元の Context と共有します。
+    """
+
+    def __init__(self, parent, globals):
+        self.parent = parent
+        self.locals = dict((name, value) for name, value in parent.locals.iteritems() if name.startswith("__"))
+        self.locals.update(globals)
+        self.locals["__context"] = self
+        self.locals["__vars"] = self.locals
+        self.buffer = parent.buffer
+        self.append = parent.append
+        self.blocks = parent.blocks
+        self.after_render = parent.after_render
+        self.redirects = parent.redirects
+        self.generator = None
+        self.deferred = parent.deferred
+
+
+    capturing = property(lambda self: self.parent.capturing, lambda self, value: setattr(self.parent, "capturing", value))
+
+
+    def snapshot(self):
+        """ コンポーネントのグローバル変数に、実行中のコンポーネントの引数とローカル変数を加えたコピーを返します。"""
+        locals = self.locals.copy()
+        frame = sys._getframe(1)
+        while frame and not (frame.f_code.co_name == "__component" and frame.f_locals.get("__context") is self):
+            frame = frame.f_back
+        if frame:
+            for name, value in frame.f_locals.iteritems():
+                if not name.startswith("__"):
+                    locals[name] = value
+        return locals
+
+
+class _FrameLocals(dict):
+    """ helper.buffer_frame_locals が返す dict。
+    テンプレート変数と、テンプレートのローカル変数を含み、__buffer の読み書きは Context の出力に対応します。
+    """
+
+    def __init__(self, context):
+        dict.__init__(self, context.snapshot())
+        self.context = context
+
+
+    def __getitem__(self, name):
+        if name == "__buffer":
+            return self.context.legacy_buffer()
+        return dict.__getitem__(self, name)
+
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+
+    def __setitem__(self, name, value):
+        if name == "__buffer":
+            self.context.redirect_buffer(value)
+        else:
+            self.context.locals[name] = value
+            dict.__setitem__(self, name, value)
+
+
+class FastCache(object):
+    """ Renderer のオンメモリキャッシュ。
+    エントリ数と、おおよそのバイト数の上限を指定でき、上限を超えると LRU で追い出します。
+    追い出されたテンプレートは、Renderer の２次キャッシュから再コンパイルせずに復元されます。
+    （２次キャッシュが無い時は、再コンパイルされます）
+    """
+
+    def __init__(self, maxentries=None, maxbytes=None, sizeof=None):
+        """
+        args:
+            maxentries: エントリ数の上限。None の時、上限なし
+            maxbytes: おおよそのバイト数の上限。None の時、上限なし
+            sizeof: エントリのバイト数の見積もり関数。未指定の時、sizeof_template
+        """
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or sizeof_template
+        self.entries = collections.OrderedDict()
+        self.pinned = set()
+        self.size = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value) if self.maxbytes else 0
+        with self._lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            self._evict()
+
+
+    def __delitem__(self, key):
+        with self._lock:
+            self.size -= self.entries.pop(key)[1]
+
+
+    def discard(self, key):
+        """ key のエントリがあれば削除します。"""
+        with self._lock:
+            if key in self.entries:
+                del self[key]
+
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        if self.maxentries or self.maxbytes:
+            with self._lock:
+                if self.entries.pop(key, None):
+                    self.entries[key] = entry
+        return entry[0]
+
+
+    def pin(self, key):
+        """ key のエントリを追い出し対象から外します。"""
+        self.pinned.add(key)
+
+
+    def unpin(self, key):
+        self.pinned.discard(key)
+
+
+    def __getstate__(self):
+        """ 別のプロセスに渡す時は、上限の設定だけを渡します。"""
+        state = dict(self.__dict__, entries=collections.OrderedDict(), size=0)
+        del state["_lock"]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+
+    def clear(self):
+        """ 全てのエントリを削除します。pin の指定は残ります。"""
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+
+    def _evict(self):
+        for key in list(self.entries):
+            if not (self.maxentries and len(self.entries) > self.maxentries) \
+                    and not (self.maxbytes and self.size > self.maxbytes):
+                break
+            if key not in self.pinned:
+                if logger: logger.info("Evict fast cache (path=%r)", key)
+                del self[key]
+                self.evictions += 1
+
+
+class _Stats(object):
+    """ Renderer の統計。カウンタと、テンプレートごとのレンダリングの所要時間のヒストグラムを保持します。
+    複数のスレッドから同時に更新できます。
+    """
+
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+    """ ヒストグラムの各区間の上限（秒）。最後の区間は、これを超えるもの """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        with self._lock:
+            self.since = time.time()
+            self.counts = collections.defaultdict(int)
+            self.templates = {}
+
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+
+    def _template(self, path):
+        t = self.templates.get(path)
+        if t is None:
+            #レンダリングの回数、例外の回数、所要時間の合計、最大、ヒストグラム、準備した方法ごとの回数、準備の所要時間の合計
+            t = self.templates[path] = [0, 0, 0.0, 0.0, [0] * (len(self.buckets) + 1), {}, 0.0]
+        return t
+
+
+    def render(self, path, elapsed, error=False):
+        """ path のレンダリングの所要時間 elapsed を記録します。"""
+        i = bisect.bisect_left(self.buckets, elapsed)
+        self._lock.acquire()
+        try:
+            t = self.templates.get(path) or self._template(path)
+            t[0] += 1
+            t[1] += error
+            t[2] += elapsed
+            t[4][i] += 1
+            if elapsed > t[3]:
+                t[3] = elapsed
+        finally:
+            self._lock.release()
+
+
+    def build(self, path, source, elapsed):
+        """ path のテンプレートを source（"bundle", "cache", "compile"）から準備した所要時間 elapsed を記録します。"""
+        with self._lock:
+            self.counts["%s.builds" % source] += 1
+            t = self._template(path)
+            t[5][source] = t[5].get(source, 0) + 1
+            t[6] += elapsed
+
+
+    def export(self):
+        """ 統計を dict で返します。
+        fastcache.hits は、レンダリングごとにロックを取らないように、レンダリングの回数から fastcache.misses を引いて求めます。
+        """
+        with self._lock:
+            counts = dict(self.counts)
+            counts["fastcache.hits"] = max(0, sum(t[0] for t in self.templates.itervalues()) - counts.get("fastcache.misses", 0))
+            return {
+                "since": self.since,
+                "buckets": list(self.buckets),
+                "counts": counts,
+                "templates": dict((path, {"renders": t[0], "errors": t[1], "time": t[2], "max": t[3], "histogram": list(t[4]),
+                                          "builds": dict(t[5]), "build_time": t[6]})
+                                  for path, t in self.templates.iteritems()),
+            }
+
+
+def sizeof_template(template):
+    """ Template のおおよそのメモリ使用量をバイト数で返します。"""
+    size = sys.getsizeof(template)
+    for s in (template.template, template._srccode):
+        if s:
+            size += sys.getsizeof(s)
+    if template.bytecode:
+        size += len(marshal.dumps(template.bytecode))
+    return size
+
+
+class Renderer(object):
+    """ ファイルベースでテンプレートを読み込み、処理します。
+    ファイルを読み込む、ベースディレクトリを指定できます。
+    オンメモリに Template インスタンスがキャッシュされます。
+    ファイルや、その他のストレージを利用した２次キャッシュを利用することが出来ます。
+    レンダリングの際に使われる共通のテンプレート変数を設定できます。
+    複数のスレッドから同時に利用でき、同じテンプレートのコンパイルは１つのスレッドだけが行います。
+    """
+    def __init__(self, base=None, cache=None, filter=_through, vars={}, encoding=sys.getdefaultencoding(), fastlocals=False, inline=False, fastcache=None, bundle=None, fragments=None, compact=False, check_interval=None, minify=False):
+        """
+        args:
+            base: 読み込みファイルのベースディレクトリの指定
+            cache: ２次キャッシュの実装クラスの指定
+            filter: <%= で値の出力の前に通過するフィルタ。html escape などの目的に使用
+            vars: レンダリングに使われる共通のテンプレート変数。
+            encoding: 入力ファイルのエンコード指定。未指定の時、sys.getdefaultencoding() の値
+            fastlocals: テンプレートのコンパイルモード。詳しくは Template.__init__ を参照
+            inline: True の時、リテラルの path の include をコンパイル時に展開します。詳しくは Template.__init__ を参照
+            fastcache: オンメモリキャッシュ。未指定の時、上限なしの FastCache
+            bundle: compile コマンドで作成したバンドルファイル。指定された時、起動時に読み込みます
+            fragments: cached ヘルパの保存先の cache.FragmentStorage。未指定の時、この Renderer だけの MemoryFragmentStorage。
+                        フィルタや vars が異なる Renderer で共有すると、互いのフラグメントが使われます
+            compact: True の時、オンメモリキャッシュのテンプレートを compact にします。詳しくは Template.__init__ を参照
+            check_interval: 指定された時、最短でこの秒数ごとに、読み込んだテンプレートファイルの変更を調べます。
+                        変更されたテンプレートと、それを inline で展開したテンプレートを、オンメモリキャッシュから取り除きます。
+                        None の時、変更を調べません（clear や invalidate で取り除きます）
+            minify: テキストパートの HTML の空白を、コンパイル時に詰めます。詳しくは Template.__init__ を参照
+        """
+        self.vars = vars
+        self.base = base
+        self.cache = cache
+        self.filter = filter
+        self._output_filter = _output_filter(filter)
+        self.encoding = encoding
+        self.fastlocals = fastlocals
+        self.inline = inline
+        self.fastcache = fastcache if fastcache is not None else FastCache()
+        self.bundle = {}
+        self.fragments = fragments
+        self.compact = compact
+        self.check_interval = check_interval
+        self.minify = minify
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._stats = {}
+        self._dependents = {}
+        self._components = {}
+        self._next_check = 0
+        self._metrics = _Stats()
+        if bundle:
+            self.load_bundle(bundle)
+
+
+    def get_fragments(self):
+        """ cached ヘルパの保存先を返します。fragments が未指定の時は、この Renderer だけの MemoryFragmentStorage を作成します。"""
+        with self._lock:
+            if self.fragments is None:
+                self.fragments = cache.MemoryFragmentStorage()
+            return self.fragments
+
+
+    def clear(self):
+        self.fastcache.clear()
+
+
+    def stats(self):
+        """ キャッシュとレンダリングの統計を、メトリクスの収集にそのまま渡せる dict で返します。
+            since: 統計を取り始めた（reset_stats した）時刻
+            buckets: ヒストグラムの各区間の上限（秒）。histogram の最後の要素は、これを超えたものの数
+            counts: fastcache.hits, fastcache.misses, build.errors と、
+                    テンプレートを準備した方法ごとの回数 bundle.builds, cache.builds, compile.builds, component.builds
+            fastcache: オンメモリキャッシュのエントリ数、おおよそのバイト数、追い出した数
+            cache: ２次キャッシュの読み込みの結果ごとの回数。詳しくは cache.CacheStorage.stats を参照
+            templates: テンプレートのパスごとの、レンダリングの回数 renders、例外で終わった回数 errors、
+                    所要時間の合計 time と最大 max（秒）、所要時間のヒストグラム histogram、
+                    準備した方法ごとの回数 builds と、準備の所要時間の合計 build_time（秒）
+        レンダリングの所要時間には、include した子テンプレートの時間も含まれます。
+        render_iter の所要時間は、呼び出し元がチャンクを処理する時間を除いたものです。
+        """
+        stats = self._metrics.export()
+        stats["fastcache"] = {"entries": len(self.fastcache), "bytes": getattr(self.fastcache, "size", 0),
+                              "evictions": getattr(self.fastcache, "evictions", 0)}
+        stats["cache"] = self.cache.stats() if hasattr(self.cache, "stats") else {}
+        return stats
+
+
+    def reset_stats(self):
+        """ stats の統計を、全て 0 に戻します。"""
+        self._metrics.reset()
+        self.fastcache.evictions = 0
+        if hasattr(self.cache, "reset_stats"):
+            self.cache.reset_stats()
+
+
+    def invalidate(self, *paths):
+        """ path のテンプレートと、それを inline で展開したテンプレートを、オンメモリキャッシュから取り除きます。
+        取り除いたテンプレートは、次のレンダリングの時に、２次キャッシュまたはテンプレートファイルから準備されます。
+        args:
+            paths: ファイルパス。フルパスまたは self.base からの相対パスで指定
+        returns:
+            取り除いたテンプレートのパスのリスト
+        """
+        return self._invalidate([os.path.join(self.base, path) if self.base else path for path in paths])
+
+
+    def _invalidate(self, paths):
+        with self._lock:
+            paths, queue = set(), list(paths)
+            while queue:
+                path = queue.pop()
+                if path not in paths:
+                    paths.add(path)
+                    queue.extend(self._dependents.pop(path, ()))
+            for path in paths:
+                self._stats.pop(path, None)
+            for key in [key for key in self._components if key[0] in paths]:
+                del self._components[key]
+        removed = [path for path in paths if path in self.fastcache]
+        for path in removed:
+            self.fastcache.discard(path)
+        if logger: logger.info("Invalidate fast cache (paths=%r)", removed)
+        return sorted(removed)
+
+
+    def check(self):
+        """ 読み込んだテンプレートファイルと、inline で展開した子テンプレートのファイルを stat し、
+        変更されたものを invalidate します。check_interval を指定した時は、レンダリングの際に自動で呼ばれます。
+        returns:
+            取り除いたテンプレートのパスのリスト
+        """
+        changed = [path for path, stat in self._stats.items() if self._stat(path) != stat]
+        return self._invalidate(changed) if changed else []
+
+
+    def _stat(self, path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime, stat.st_size)
+        except OSError:
+            return None
+
+
+    def _record(self, path, t, stat):
+        """ path のテンプレートファイルと、inline で展開した子テンプレートのファイルの stat と、依存関係を記録します。
+        stat は、テンプレートファイルを読み込む前に取得した path の stat です。
+        """
+        stats = dict((dep, self._stat(dep)) for dep in t.depends)
+        stats[path] = stat
+        with self._lock:
+            for dep in t.depends:
+                self._dependents.setdefault(dep, set()).add(path)
+            for dep, stat in stats.iteritems():
+                self._stats.setdefault(dep, stat)
+
+
+    def pin(self, *paths):
+        """ path のテンプレートを、オンメモリキャッシュから追い出されないようにします。
+        レイアウトなど、頻繁に使われるテンプレートに使用します。
+        """
+        for path in paths:
+            self.fastcache.pin(os.path.join(self.base, path) if self.base else path)
+
+
+    def render(self, path, vars={}, filter=None):
+        """ ファイルを指定し、レンダリング結果を返します。
+        args:
+            path: ファイルパス。フルパスまたは self.base からの相対パスで指定
+            vars: テンプレート変数。__init__ で設定した vars より優先
+        """
+        start = time.time()
+        t, locals = self._prepare(path, vars)
+        try:
+            result = t.render(locals, _output_filter(filter) if filter else self._output_filter)
+        except:
+            self._metrics.render(t.filename, time.time() - start, True)
+            raise
+        self._metrics.render(t.filename, time.time() - start)
+        return result
+
+
+    def render_iter(self, path, vars={}, filter=None):
+        """ ファイルを指定し、レンダリング結果を unicode のチャンクで順次返すジェネレータを返します。
+        詳しくは Template.render_iter を参照してください。
+        args:
+            path: ファイルパス。フルパスまたは self.base からの相対パスで指定
+            vars: テンプレート変数。__init__ で設定した vars より優先
+        """
+        t, locals = self._prepare(path, vars)
+        return self._iter_stats(t.filename, t.render_iter(locals, _output_filter(filter) if filter else self._output_filter))
+
+
+    def _iter_stats(self, path, chunks):
+        """ chunks を順に返し、チャンクの生成に掛かった時間の合計を、path のレンダリングの所要時間として記録します。"""
+        elapsed, error = 0.0, False
+        try:
+            while True:
+                start = time.time()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    break
+                except:
+                    error = True
+                    raise
+                finally:
+                    elapsed += time.time() - start
+                yield chunk
+        finally:
+            self._metrics.render(path, elapsed, error)
+
+
+    def render_async(self, path, vars={}, filter=None):
+        """ ファイルを指定し、別のスレッドでレンダリングして、結果を helper.Deferred で返します。
+        詳しくは Template.render_async を参照してください。
+        args:
+            path: ファイルパス。フルパスまたは self.base からの相対パスで指定
+            vars: テンプレート変数。__init__ で設定した vars より優先
+        """
+        vars = dict(vars, __deferred=True)
+        return helper.defer(lambda: _resolve(self.render(path, vars, filter)))
+
+
+    def render_to(self, fileobj, path, vars={}, filter=None, encoding="utf-8", bufsize=4096):
+        """ ファイルを指定し、レンダリング結果を encoding でエンコードして fileobj に順次書き込みます。
+        詳しくは Template.render_to を参照してください。
+        args:
+            fileobj: write メソッドを持つオブジェクト、または WSGI の write のような、バイト列を受け取る関数
+            path: ファイルパス。フルパスまたは self.base からの相対パスで指定
+            vars: テンプレート変数。__init__ で設定した vars より優先
+        """
+        start = time.time()
+        t, locals = self._prepare(path, vars)
+        try:
+            t.render_to(fileobj, locals, _output_filter(filter) if filter else self._output_filter, encoding, bufsize)
+        except:
+            self._metrics.render(t.filename, time.time() - start, True)
+            raise
+        self._metrics.render(t.filename, time.time() - start)
+
+
+    def _prepare(self, path, vars):
+        """ path のテンプレートを取得し、テンプレートとテンプレート変数を返します。"""
+        if self.base:
+            path = os.path.join(self.base, path)
+        
+        #Check changes of template files
+        if self.check_interval is not None and self._next_check <= time.time():
+            self._next_check = time.time() + self.check_interval
+            self.check()
+        
+        #Use fast cache
+        t = self.fastcache.get(path)
+        if t:
+            if logger: logger.info("Use fast cache (path=%r)", path)
+        else:
+            t = self._single_flight(path)
+            self._metrics.count("fastcache.misses")
+        
+        locals = self.vars.copy()
+        locals.update(vars)
+        locals["renderer"] = self
+        return t, locals
+
+
+    def component(self, path, *params):
+        """ path のテンプレートを、params を引数とする関数（コンポーネント）にコンパイルして返します。
+        コンパイルした関数は、path と params ごとにキャッシュされます。詳しくは helper.component を参照してください。
+        args:
+            path: ファイルパス。フルパスまたは self.base からの相対パスで指定
+            *params: 引数名。デフォルト値を持つ引数は "name=value" の形式
+        """
+        if self.base:
+            path = os.path.join(self.base, path)
+        key = (path,) + params
+        func = self._components.get(key)
+        if func is None:
+            start, stat = time.time(), self._stat(path)
+            t = self._load(path)
+            func = t.compile_component(params, dict(self.vars, renderer=self))
+            self._record(path, t, stat)
+            self._metrics.build(path, "component", time.time() - start)
+            self._components[key] = func
+        return func
+
+
+    def warm(self, paths=None):
+        """ テンプレートを２次キャッシュからまとめて読み込み、オンメモリキャッシュに入れます。
+        ２次キャッシュの get_multi を使うので、MemcachedCacheStorage では１回の往復で読み込めます。
+        ２次キャッシュに無いテンプレートはコンパイルし、set_multi でまとめて保存します。
+        args:
+            paths: self.base からの相対パスのリスト。未指定の時、self.base 以下の全てのファイル
+        returns:
+            オンメモリキャッシュに入れたテンプレートのパスのリスト
+        """
+        if paths is None:
+            paths = self.walk()
+        paths = [os.path.join(self.base, path) if self.base else path for path in paths]
+        paths = [path for path in paths if path not in self.fastcache and path not in self.bundle]
+        templates = self.cache.get_multi(paths, self._compile_options()) if self.cache else {}
+        built = {}
+        for path in paths:
+            start, stat = time.time(), self._stat(path)
+            t = templates.get(path)
+            if not t:
+                t = built[path] = self._load(path)
+            t.filename = path
+            t.compact = self.compact
+            t.compile()
+            self._record(path, t, stat)
+            self.fastcache[path] = t
+            self._metrics.build(path, "compile" if path in built else "cache", time.time() - start)
+        if built and self.cache:
+            self.cache.set_multi(built)
+        if logger: logger.info("Warm fast cache (templates=%d, compiled=%d)", len(paths), len(built))
+        return paths
+
+
+    def _single_flight(self, path):
+        """ path のテンプレートを準備して fastcache に格納し、返します。
+        複数のスレッドが同時に同じ path を要求した時、最初のスレッドだけが準備を行い、
+        他のスレッドはその結果（または例外）を待って受け取ります。
+        """
+        with self._lock:
+            t = self.fastcache.get(path)
+            if t:
+                return t
+            flight = self._flights.get(path)
+            leader = flight is None
+            if leader:
+                flight = self._flights[path] = {"done": threading.Event()}
+        
+        if not leader:
+            if logger: logger.info("Wait for other thread (path=%r)", path)
+            flight["done"].wait()
+            if "error" in flight:
+                error = flight["error"]
+                raise error[0], error[1], error[2]
+            return flight["template"]
+        
+        try:
+            t = flight["template"] = self._build(path)
+            self.fastcache[path] = t
+            return t
+        except:
+            flight["error"] = sys.exc_info()
+            self._metrics.count("build.errors")
+            raise
+        finally:
+            with self._lock:
+                del self._flights[path]
+            flight["done"].set()
+
+
+    def _build(self, path):
+        """ path のテンプレートを、バンドル、２次キャッシュ、テンプレートファイルの順に探して準備します。"""
+        start = time.time()
+        #Use bundle
+        if path in self.bundle:
+            if logger: logger.info("Use bundle (path=%r)", path)
+            t = Template(**self.bundle[path])
+            t.compile()
+            stat, source = False, "bundle"
+        #Use 2nd cache
+        elif self.cache:
+            stat, source = self._stat(path), "cache"
+            t = self.cache.get(path, self._compile_options())
+            if not t:
+                #Load and compile template
+                t = self._load(path)
+                t.compile()
+                self.cache.set(path, t)
+                source = "compile"
+        #Load and compile template
+        else:
+            stat, source = self._stat(path), "compile"
+            t = self._load(path)
+        t.filename = path
+        t.compact = self.compact
+        t.compile()
+        if stat is not False:
+            self._record(path, t, stat)
+        self._metrics.build(path, source, time.time() - start)
+        return t
+
+
+    def render_many(self, path, varslist, workers=None, chunksize=16, ordered=True, filter=None):
+        """ path のテンプレートを、varslist のテンプレート変数ごとにレンダリングし、結果を順に返すイテレータを返します。
+        レンダリングは、workers 個のプロセスのプール（multiprocessing.Pool）で並列に行います。
+        最初のテンプレート変数はこのプロセスでレンダリングし、その時に準備したテンプレートの srccode と bytecode を
+        バンドルとしてワーカープロセスに渡すので、ワーカープロセスではテンプレートの読み込みやコンパイルは行われません。
+        テンプレート変数とレンダリング結果は、プロセス間で pickle されます。
+        args:
+            path: ファイルパス。フルパスまたは self.base からの相対パスで指定
+            varslist: テンプレート変数のイテラブル。ジェネレータでも構いません
+            workers: ワーカープロセスの数。未指定の時、CPU の数
+            chunksize: ワーカープロセスにまとめて渡すレンダリングの数。大きいほどプロセス間通信の回数が減ります
+            ordered: True の時、varslist の順に結果を返します。
+                     False の時、完了した順に (varslist での位置, 結果) を返します
+            filter: <%= の出力フィルタ。未指定の時、__init__ で指定したフィルタ
+        """
+        import multiprocessing
+        varslist = iter(varslist)
+        for vars in varslist:
+            result = self.render(path, vars, filter)
+            yield result if ordered else (0, result)
+            break
+        else:
+            return
+        
+        templates = marshal.dumps(dict((key, t.get_cache_data()) for key, (t, size) in self.fastcache.entries.items()))
+        pool = multiprocessing.Pool(workers, _render_many_init, (self, templates, filter))
+        try:
+            tasks = ((i, path, vars) for i, vars in enumerate(varslist, 1))
+            for i, result in (pool.imap if ordered else pool.imap_unordered)(_render_many_task, tasks, chunksize):
+                yield result if ordered else (i, result)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def __getstate__(self):
+        """ 別のプロセスに渡す時は、ロックとオンメモリキャッシュの内容を除きます。"""
+        state = dict(self.__dict__, _stats={}, _dependents={}, _components={})
+        del state["_lock"], state["_flights"], state["_metrics"]
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._metrics = _Stats()
+
+
+    def load_bundle(self, path):
+        """ save_bundle で作成したバンドルファイルを読み込みます。
+        バンドルに含まれるテンプレートは、テンプレートファイルを読み込まず、パースもせずにレンダリングされます。
+        バンドルを作成した Python とバイトコードの互換性が無い時は、srccode からコンパイルします。
+        バンドルを作成した時と、fastlocals, inline, minify が異なる時は ValueError になります。
+        args:
+            path: バンドルファイルの path
+        """
+        with open(path, "rb") as f:
+            data = marshal.load(f)
+        if data.get("format") != self._bundle_format:
+            raise ValueError("%s is not an eepy bundle" % repr(path))
+        if data["options"] != self._compile_options():
+            raise ValueError("%s is compiled with other options (fastlocals, inline or minify) than this renderer" % repr(path))
+        bytecode = data["magic"] == imp.get_magic()
+        for name, t in data["templates"].iteritems():
+            if not bytecode:
+                t.pop("bytecode", None)
+            self.bundle[os.path.join(self.base, name) if self.base else name] = t
+        if logger: logger.info("Load bundle (file=%r, templates=%d)", path, len(data["templates"]))
+
+
+    def save_bundle(self, path, names=None):
+        """ テンプレートをコンパイルし、ひとつのバンドルファイルに保存します。
+        args:
+            path: バンドルファイルの path
+            names: テンプレートの self.base からの相対パスのリスト。未指定の時、self.base 以下の全てのファイル
+        """
+        if names is None:
+            names = self.walk()
+        templates = {}
+        for name in sorted(names):
+            t = self._load(os.path.join(self.base, name) if self.base else name)
+            t.compile()
+            templates[name] = t.get_cache_data()
+        dump = marshal.dumps({"format": self._bundle_format, "magic": imp.get_magic(), "options": self._compile_options(), "templates": templates})
+        _tmp_ = "%s.tmp" % path
+        with open(_tmp_, "wb") as f:
+            f.write(dump)
+        os.rename(_tmp_, path)
+        return sorted(templates)
+
+
+    def walk(self, exts=None):
+        """ self.base 以下のファイルの、self.base からの相対パスのリストを返します。
+        exts が未指定の時、テンプレートの隣に作られる２次キャッシュ（.cache）とバンドル（.bundle）のファイルと、
+        それらの書き込み中の一時ファイルは除きます。
+        args:
+            exts: 拡張子のリスト。指定された時、その拡張子のファイルのみ
+        """
+        names = []
+        for dir, _, files in os.walk(self.base):
+            for file in files:
+                if os.path.splitext(file)[1] in exts if exts else not self._regexp_walk_skip.search(file):
+                    names.append(os.path.relpath(os.path.join(dir, file), self.base).replace(os.sep, "/"))
+        return names
+
+
+    _bundle_format = "eepy.bundle.3"
+    _regexp_walk_skip = re.compile(r"\.(cache|bundle)(\.\d+|\.tmp)?$")
+
+
+    def _compile_options(self):
+        return _compile_options(self.fastlocals, self.inline, self.minify)
+
+
+    def _load(self, path):
+        """ path のテンプレートファイルを読み込み、Template を返します。"""
+        if logger: logger.info("Load template file (path=%r)", path)
+        return Template(codecs.open(path, encoding=self.encoding), fastlocals=self.fastlocals, inline=self.inline, loader=self._loader, minify=self.minify)
+
+
+    def _loader(self, path):
+        """ inline で子テンプレートを読み込む為の Template の loader """
+        if self.base:
+            path = os.path.join(self.base, path)
+        if logger: logger.info("Load template file for inline (path=%r)", path)
+        with codecs.open(path, encoding=self.encoding) as f:
+            return f.read(), path
+
+
+_render_many_worker = None
+
+
+def _render_many_init(renderer, templates, filter):
+    """ Renderer.render_many のワーカープロセスを初期化します。
+    renderer の設定で、templates（marshal したバンドル）を読み込んだ Renderer を準備します。
+    """
+    global _render_many_worker
+    worker = Renderer(renderer.base, renderer.cache, renderer.filter, renderer.vars, renderer.encoding,
+                      renderer.fastlocals, renderer.inline, copy.copy(renderer.fastcache), fragments=renderer.fragments, compact=renderer.compact,
+                      check_interval=renderer.check_interval, minify=renderer.minify)
+    worker.bundle.update(renderer.bundle)
+    worker.bundle.update(marshal.loads(templates))
+    _render_many_worker = (worker, filter)
+
+
+def _render_many_task(task):
+    """ Renderer.render_many のワーカープロセスで、ひとつのテンプレート変数をレンダリングします。"""
+    i, path, vars = task
+    worker, filter = _render_many_worker
+    return i, worker.render(path, vars, filter)
+
+
+class Profiler(object):
+    """ レンダリングの所要時間を、テンプレートのファイルと行ごとに計測します。
+    生成されたコードの行は、Template.compile で作成したソースマップでテンプレート上の位置に変換されます。
+    また、include と extends によるレンダリングと、コンポーネントの呼び出しの入れ子を、所要時間と共に記録します。
+    sys.settrace を使うので、計測していない時のレンダリングには何のコストもかかりません。
+    計測は、start を呼び出したスレッドだけが対象です。
+    
+        profiler = eepy.Profiler()
+        with profiler:
+            r.render("index.html", vars)
+        print profiler.format_table()
+        print profiler.format_trace()
+        profiler.write_collapsed(open("index.folded", "w"))  # flamegraph.pl 形式
+    """
+    def __init__(self, timer=timeit.default_timer):
+        self.timer = timer
+        self.clear()
+
+
+    def clear(self):
+        """ 計測結果を破棄します。"""
+        self.lines = {}
+        self.root = self._node(u"<root>")
+        self._stack = [(self.root, None, None)]
+        self._last = None
+        self._last_time = None
+
+
+    def start(self):
+        self._saved_trace = sys.gettrace()
+        self._last, self._last_time = None, self.timer()
+        sys.settrace(self._trace_call)
+
+
+    def stop(self):
+        sys.settrace(self._saved_trace)
+        self._tick()
+        while len(self._stack) > 1:
+            self._leave(self.timer())
+
+
+    def __enter__(self):
+        self.start()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+    def stats(self):
+        """ 行ごとの計測結果を、所要時間の長い順に [(ファイル名, 行番号, 所要時間, 実行回数), ...] で返します。"""
+        result = [(filename, line, time, hits) for (filename, line), (time, hits) in self.lines.iteritems()]
+        result.sort(key=lambda r: -r[2])
+        return result
+
+
+    def format_table(self, limit=20):
+        """ 行ごとの計測結果を、所要時間の長い順に limit 行の表にして返します。"""
+        stats = self.stats()
+        total = sum(r[2] for r in stats) or 1.0
+        lines = [u"%10s %6s %8s  %s" % (u"msec", u"%", u"hits", u"location")]
+        for filename, line, time, hits in stats[:limit]:
+            source = linecache.getline(filename, line).strip().decode("utf-8", "replace") if filename else u""
+            lines.append(u"%10.3f %6.1f %8d  %s:%s  %s" % (time * 1000, time * 100 / total, hits, filename, line, source))
+        return u"\n".join(lines)
+
+
+    def format_trace(self):
+        """ include, extends, コンポーネントの入れ子を、所要時間（msec）と呼び出し回数のツリーにして返します。"""
+        lines = []
+        def walk(node, depth):
+            for child in node["children"].itervalues():
+                lines.append(u"%s%s  %.3f msec (%d)" % (u"  " * depth, child["label"], child["time"] * 1000, child["calls"]))
+                walk(child, depth + 1)
+        walk(self.root, 0)
+        return u"\n".join(lines)
+
+
+    def write_collapsed(self, file):
+        """ 計測結果を、flamegraph.pl などで読める collapsed stack 形式（値はマイクロ秒）で file に書き出します。"""
+        def walk(node, path):
+            spent = sum(node["lines"].itervalues()) + sum(c["time"] for c in node["children"].itervalues())
+            if node is not self.root and node["time"] > spent:
+                write(path, node["time"] - spent)
+            for location, time in node["lines"].iteritems():
+                write(path + [u"%s:%s" % location], time)
+            for child in node["children"].itervalues():
+                walk(child, path + [child["label"]])
+        def write(path, time):
+            if path and int(time * 1000000):
+                file.write((u"%s %d\n" % (u";".join(p.replace(u";", u":") for p in path), time * 1000000)).encode("utf-8"))
+        walk(self.root, [])
+
+
+    def _node(self, label):
+        return {"label": label, "time": 0.0, "calls": 0, "lines": {}, "children": collections.OrderedDict()}
+
+
+    def _tick(self):
+        """ 前のイベントからの経過時間を、実行中の行に加算します。"""
+        now = self.timer()
+        if self._last:
+            node, location = self._last
+            elapsed = now - self._last_time
+            stat = self.lines.get(location)
+            if stat:
+                stat[0] += elapsed
+            else:
+                self.lines[location] = [elapsed, 0]
+            node["lines"][location] = node["lines"].get(location, 0.0) + elapsed
+        self._last_time = now
+        return now
+
+
+    def _trace_call(self, frame, event, arg):
+        """ sys.settrace に設定するトレース関数。テンプレートのコードと、Template.render の呼び出しだけを追跡します。"""
+        code = frame.f_code
+        if code.co_filename == "<eepy>":
+            if code.co_name == "__component":
+                template = frame.f_globals.get("__template")
+                self._enter(u"component %s" % (getattr(template, "filename", None) or u"<string>"), True)
+                return self._trace_component
+            return self._trace_line
+        elif code in self._render_codes:
+            template = frame.f_locals.get("self")
+            #ジェネレータの再開は、呼び出しに数えない
+            self._enter(u"%s %s" % (self._render_kind(frame), getattr(template, "filename", None) or u"<string>"), frame.f_lasti == -1)
+            return self._trace_render
+        return None
+
+
+    def _enter(self, label, call):
+        """ label の入れ子を開きます。call が True の時、呼び出し回数に数えます。"""
+        now = self._tick()
+        parent = self._stack[-1][0]
+        node = parent["children"].get(label)
+        if node is None:
+            node = parent["children"][label] = self._node(label)
+        if call:
+            node["calls"] += 1
+        self._stack.append((node, now, self._last))
+        self._last = None
+
+
+    def _trace_line(self, frame, event, arg):
+        """ テンプレートのコードのフレームのトレース関数。行ごとの所要時間を記録します。"""
+        if event == "line":
+            self._tick()
+            location = self._locate(frame)
+            self._last = (self._stack[-1][0], location)
+            stat = self.lines.get(location)
+            if stat is None:
+                stat = self.lines[location] = [0.0, 0]
+            stat[1] += 1
+        elif event == "return":
+            #テンプレート内で定義された関数から戻った時は、呼び出し元の行に戻す
+            self._tick()
+            caller = frame.f_back
+            self._last = (self._stack[-1][0], self._locate(caller)) if caller and caller.f_code.co_filename == "<eepy>" else None
+        return self._trace_line
+
+
+    def _trace_component(self, frame, event, arg):
+        """ コンポーネントのフレームのトレース関数。行ごとの所要時間を記録し、戻った時に入れ子を閉じます。"""
+        if event == "return":
+            self._leave(self._tick())
             return None
+        self._trace_line(frame, event, arg)
+        return self._trace_component
+
+
+    def _locate(self, frame):
+        """ テンプレートのコードのフレームの、テンプレート上の位置を返します。"""
+        template = frame.f_globals.get("__template")
+        return template and template.origin(frame.f_lineno) or (u"<eepy>", frame.f_lineno)
+
+
+    def _trace_render(self, frame, event, arg):
+        """ Template.render, render_iter, render_to のフレームのトレース関数。戻った時に、入れ子を閉じます。"""
+        if event == "return":
+            self._leave(self._tick())
+        return self._trace_render
+
+
+    def _leave(self, now):
+        node, start, self._last = self._stack.pop()
+        node["time"] += now - start
+
+
+    def _render_kind(self, frame):
+        """ Template.render の呼び出し元を辿り、include か extends か、それ以外の render かを返します。
+        render_iter と render_to の extends は、do_extends_stream が返したジェネレータを _after_render で読み出すので、
+        _after_render から呼ばれた時も extends とします。
+        """
+        frame = frame.f_back
+        for i in range(4):
+            if frame is None:
+                break
+            name = frame.f_code.co_name
+            if frame.f_code.co_filename == self._filename:
+                if name == "include":
+                    return u"include"
+                elif name in ("do_extends", "do_extends_stream", "_after_render"):
+                    return u"extends"
+            frame = frame.f_back
+        return u"render"
+
+
+    _render_codes = (Template.render.im_func.func_code, Template.render_iter.im_func.func_code, Template.render_to.im_func.func_code)
+    _filename = Template.render.im_func.func_code.co_filename
+
+
+@_module
+def cache():
+    """ ２次キャッシュ関連のモジュール
+    """
+    import marshal, struct, hashlib, time, mmap
+
+    class CacheStorage(object):
+        """ ２次キャッシュの処理実装の為の抽象クラス。
+        キャッシュデータは、ヘッダと、marshal した srccode、bytecode、depends を連結したバイト列です。
+        ヘッダには、フォーマットのバージョン、バイトコードを作成した Python のマジックナンバー、
+        テンプレートファイルの mtime、サイズ、内容の SHA-1 が含まれ、本体を unmarshal する前に検証されます。
+            * mtime とサイズが一致すれば、有効とします（テンプレートファイルの stat のみ）
+            * 一致しない時は、テンプレートファイルの内容のハッシュが一致すれば有効とし、ヘッダを更新します
+            * マジックナンバーが異なる時は、bytecode を使わずに srccode からコンパイルします
+            * inline で展開した子テンプレート（depends）の mtime かサイズが異なる時は、無効とします
+            * コンパイルオプション（fastlocals, inline, minify）が異なる時は、無効とします
+        コンパイルオプションごとに別のキー（cachekey）で保存するので、オプションの異なる Renderer で同じストレージを共有できます。
+        サブクラスは、バイト列を保存する _load, _store, _delete を実装します。
+        まとめて読み書きできるストレージでは、get_multi, set_multi の為に _load_multi, _store_multi も実装します。
+        """
+        header = struct.Struct("<4sH4sdQ20sIIIB")
+        signature = "EEPY"
+        version = 4
+        option_names = ("fastlocals", "inline", "minify", "comments")
+
+        def __init__(self, builder=Template):
+            self.builder = builder
+    
+        def get(self, path, options=0):
+            """ path のテンプレートを読み込みます。無効な時は None を返します。
+            args:
+                options: コンパイルオプション。Template.get_compile_options を参照
+            """
+            key = self.cachekey(path, options)
+            return self._restore(path, self._load(key), key, options)
+
+        def get_multi(self, paths, options=0):
+            """ paths のテンプレートをまとめて読み込み、{path: Template} で返します。無効なものは含みません。"""
+            keys = dict((self.cachekey(path, options), path) for path in paths)
+            dumps = self._load_multi(list(keys))
+            templates = {}
+            for key, path in keys.iteritems():
+                t = self._restore(path, dumps.get(key), key, options)
+                if t:
+                    templates[path] = t
+            return templates
+
+        def _restore(self, path, dump, key, options):
+            """ キャッシュデータを検証し、有効であれば Template を返します。"""
+            if not dump or len(dump) < self.header.size:
+                self._count("misses")
+                return None
+            signature, version, magic, mtime, size, digest, srclen, codelen, deplen, flags = self.header.unpack_from(dump)
+            if signature != self.signature or version != self.version:
+                if logger: logger.info("Cache format is unknown (file=%r)", path)
+                self._count("unknown")
+                return None
+            if flags != options:
+                if logger: logger.info("Cache is compiled with other options (file=%r, options=%r)", path, flags)
+                self._count("mismatched")
+                return None
+            stat = os.stat(path)
+            if stat.st_mtime != mtime or stat.st_size != size:
+                if stat.st_size != size or self.digest(path) != digest:
+                    if logger: logger.info("Cache is old (file=%r)", path)
+                    self._count("stale")
+                    return None
+                self._count("refreshed")
+                
+                #ヘッダの更新は読み込みのついでなので、書き込めないストレージ（読み込み専用の NFS など）でも失敗させない
+                try:
+                    self._store(key, self.header.pack(signature, version, magic, stat.st_mtime, size, digest, srclen, codelen, deplen, flags) + dump[self.header.size:])
+                except (IOError, OSError), e:
+                    if logger: logger.info("Failed to refresh cache (file=%r, error=%r)", path, e)
+            pos = self.header.size + srclen + codelen
+            depends = marshal.loads(dump[pos:pos + deplen]) if deplen else []
+            for dep, mtime, size in depends:
+                try:
+                    stat = os.stat(dep)
+                except OSError:
+                    stat = None
+                if not stat or stat.st_mtime != mtime or stat.st_size != size:
+                    if logger: logger.info("Cache is old (file=%r, depends=%r)", path, dep)
+                    self._count("stale")
+                    return None
+            pos = self.header.size
+            data = {"srccode": marshal.loads(dump[pos:pos + srclen]), "depends": [dep for dep, _, _ in depends],
+                    "fastlocals": bool(flags & 1), "inline": bool(flags & 2), "minify": "comments" if flags & 8 else bool(flags & 4)}
+            if magic == imp.get_magic():
+                if codelen:
+                    data["bytecode"] = marshal.loads(dump[pos + srclen:pos + srclen + codelen])
+            else:
+                if logger: logger.info("Cache bytecode is for another interpreter (file=%r)", path)
+                self._count("foreign")
+            self._count("hits")
+            return self.builder(**data)
     
         def set(self, path, template):
+            self._count("stores")
+            return self._store(self.cachekey(path, template.get_compile_options()), self._dump(path, template))
+
+        def set_multi(self, templates):
+            """ {path: Template} のテンプレートをまとめて保存します。"""
+            for path in templates:
+                self._count("stores")
+            self._store_multi(dict((self.cachekey(path, t.get_compile_options()), self._dump(path, t)) for path, t in templates.iteritems()))
+
+        _counts_lock = threading.Lock()
+
+        def _count(self, name):
+            with self._counts_lock:
+                counts = self.__dict__.setdefault("counts", {})
+                counts[name] = counts.get(name, 0) + 1
+
+        def stats(self):
+            """ 読み込みの結果ごとの回数を dict で返します。
+                hits: 有効なキャッシュを読み込んだ（refreshed と foreign を含みます）
+                misses: キャッシュが無かった
+                stale: テンプレートファイルか、inline で展開した子テンプレートが変更されていた
+                unknown: フォーマットのバージョンが異なっていた
+                mismatched: コンパイルオプションが異なっていた
+                refreshed: mtime は異なるが内容が同じで、ヘッダを更新した
+                foreign: バイトコードが別の Python のもので、srccode からコンパイルした
+                stores: 保存した
+            """
+            with self._counts_lock:
+                return dict(self.__dict__.get("counts") or {})
+
+        def reset_stats(self):
+            with self._counts_lock:
+                self.__dict__.pop("counts", None)
+
+        def _dump(self, path, template):
+            """ template のキャッシュデータのバイト列を返します。"""
             data = template.get_cache_data()
-            data["__cache_timestamp__"] = os.path.getmtime(path)
-            return self._store(path, data)
+            srccode = marshal.dumps(data["srccode"])
+            bytecode = marshal.dumps(data["bytecode"]) if data.get("bytecode") else ""
+            depends = []
+            for dep in data.get("depends") or []:
+                stat = os.stat(dep)
+                depends.append((dep, stat.st_mtime, stat.st_size))
+            depends = marshal.dumps(depends) if depends else ""
+            stat = os.stat(path)
+            header = self.header.pack(self.signature, self.version, imp.get_magic(), stat.st_mtime, stat.st_size,
+                                      self.digest(path), len(srccode), len(bytecode), len(depends), template.get_compile_options())
+            return header + srccode + bytecode + depends
     
-        def unset(self, path):
-            return self._delete(path)
+        def unset(self, path, options=0):
+            return self._delete(self.cachekey(path, options))
+
+        def cachekey(self, path, options):
+            """ path のテンプレートを、コンパイルオプション options でコンパイルしたもののキー。
+            オプションが無い時は path、ある時は "path.inline" のように、オプション名を付けたものです。
+            """
+            return ".".join([path] + [name for i, name in enumerate(self.option_names) if options & (1 << i)])
+
+        def digest(self, path):
+            """ テンプレートファイルの内容の SHA-1 を返します。"""
+            with open(path, "rb") as f:
+                return hashlib.sha1(f.read()).digest()
     
         def _load(self, path):
             raise NotImplementedError("%s#_load(): not implemented yet." % self.__class__.__name__)
     
-        def _store(self, path, template):
+        def _store(self, path, dump):
             raise NotImplementedError("%s#_store(): not implemented yet." % self.__class__.__name__)
     
         def _delete(self, path):
             raise NotImplementedError("%s#_delete(): not implemented yet." % self.__class__.__name__)
+
+        def _load_multi(self, paths):
+            return dict((path, self._load(path)) for path in paths)
+
+        def _store_multi(self, dumps):
+            for path, dump in dumps.iteritems():
+                self._store(path, dump)
         
         def cachename(self, key):
             return "%s.cache" % key
 
 
     class FileCacheStorage(CacheStorage):
-        """ marshal を用いて、２次キャッシュをファイルに保存する CacheStorage 実装クラス。
+        """ ２次キャッシュをファイルに保存する CacheStorage 実装クラス。
+        読み込みは open と read のみで、存在確認の stat は行いません。
         """
         def _load(self, path):
             path = self.cachename(path)
-            if logger: logger.info("Load cache file (file=%s)" % repr(path))
-            if not os.path.isfile(path):
+            if logger: logger.info("Load cache file (file=%r)", path)
+            try:
+                with open(path, "rb") as f:
+                    return f.read()
+            except IOError:
                 return None
-            with open(path, "rb") as f:
-                dump = f.read()
-            return marshal.loads(dump)
         
-        def _store(self, path, data):
+        def _store(self, path, dump):
             path = self.cachename(path)
-            if logger: logger.info("Store cache file (file=%s)" % repr(path))
-            dump = marshal.dumps(data)
+            if logger: logger.info("Store cache file (file=%r)", path)
             import random
             _tmp_ = "%s%s"  % (path, str(random.random())[1:])
             with open(_tmp_, 'wb') as f:
@@ -644,8 +3030,208 @@ def cache():
         
         def _delete(self, path):
             path = self.cachename(path)
-            if os.path.isfile(path):
+            try:
                 os.unlink(path)
+            except OSError:
+                pass
+
+
+    class SharedCacheStorage(CacheStorage):
+        """ ２次キャッシュを、ひとつのログファイルに追記し、mmap で読み込む CacheStorage 実装クラス。
+        pre-fork のワーカープロセス間で共有する為のものです。あるプロセスがコンパイルして保存したテンプレートは、
+        他のプロセスからも、キャッシュファイルを開かずに読み込めます。
+        ログファイルは、ヘッダ（最後のレコードの終端の位置）と、(キー, キャッシュデータ) のレコードの並びです。
+            * 書き込みは flock で排他し、レコードを追記した後に、ヘッダの終端の位置を更新します
+            * 読み込みは、mmap したヘッダの終端の位置が進んでいる時だけ、新しいレコードを読んで索引に加えます。
+              索引にあるキーの読み込みでは、システムコールを行いません
+            * 同じキーのレコードは、最後のものが有効です。削除は、キャッシュデータが空のレコードで記録します
+            * ログファイルが maxsize を超えると、有効なレコードだけのファイルに置き換えます（vacuum）。
+              有効なレコードが maxsize の半分を超える時は、古いレコードから捨てます。
+              置き換えられたファイルには印が付き、各プロセスは次の読み書きで新しいファイルを開き直します
+        fcntl を使うので、Unix でのみ使用できます。
+        """
+        loghead = struct.Struct("<4sH?xQ")
+        record = struct.Struct("<II")
+
+        def __init__(self, filename, maxsize=64 * 1024 * 1024, builder=Template):
+            """
+            args:
+                filename: ログファイルのパス。同じホストのプロセス間で同じものを指定します
+                maxsize: ログファイルの大きさの上限（バイト数）。0 の時、vacuum しません
+            """
+            CacheStorage.__init__(self, builder)
+            self.filename = filename
+            self.maxsize = maxsize
+            self._state = (None, {})
+            self._fd = None
+            self._lock = threading.Lock()
+
+        def __getstate__(self):
+            """ 別のプロセスに渡す時は、mmap と索引を除きます。"""
+            state = dict(self.__dict__, _state=(None, {}), _fd=None)
+            del state["_lock"]
+            return state
+
+        def __setstate__(self, state):
+            self.__dict__.update(state)
+            self._lock = threading.Lock()
+
+        def _load(self, path):
+            m, index = self._sync()
+            entry = index.get(self._key(path))
+            if entry is None:
+                return None
+            pos, size = entry
+            if pos + size > len(m): #他のスレッドが、索引を更新した後で mmap し直した
+                m, latest = self._state
+                if latest is not index:
+                    return None
+            return m[pos:pos + size]
+
+        def _store(self, path, dump):
+            self._append(self._key(path), dump)
+
+        def _delete(self, path):
+            self._append(self._key(path), "")
+
+        def _key(self, path):
+            return path.encode("utf-8") if isinstance(path, unicode) else path
+
+        def _sync(self):
+            """ ログファイルの新しいレコードを索引に加え、(mmap, 索引) を返します。"""
+            m, index = state = self._state
+            if m is not None:
+                signature, version, stale, end = self.loghead.unpack_from(m)
+                if not stale and end == index.get(None):
+                    return state
+            import fcntl
+            with self._lock:
+                m, index = self._state
+                if m is None or self.loghead.unpack_from(m)[2]:
+                    if self._fd is not None:
+                        os.close(self._fd)
+                        self._fd = None
+                    fd = self._open()
+                    try:
+                        m, index = mmap.mmap(fd, 0, access=mmap.ACCESS_READ), {None: self.loghead.size}
+                    except:
+                        os.close(fd)
+                        raise
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    self._fd = fd #ファイルが大きくなった時に、同じファイルを mmap し直す為に開いておく
+                    if logger: logger.info("Map shared cache (file=%r, size=%d)", self.filename, len(m))
+                end = self.loghead.unpack_from(m)[3]
+                if end > len(m):
+                    m = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+                self._state = (m, index)
+                self._scan(m, index, end)
+                return self._state
+
+        def _scan(self, m, index, end):
+            """ 索引の位置（index[None]）から end までのレコードを読み、index に加えます。"""
+            pos = index[None]
+            while pos < end:
+                keylen, size = self.record.unpack_from(m, pos)
+                pos += self.record.size
+                key = m[pos:pos + keylen]
+                pos += keylen
+                if size:
+                    index[key] = (pos, size)
+                else:
+                    index.pop(key, None)
+                pos += size
+            index[None] = pos
+
+        def _open(self):
+            """ ログファイルを開いて flock で排他ロックし、ファイルディスクリプタを返します。
+            ファイルが無い時は作成し、置き換えられていた時は、新しいファイルを開き直します。
+            ファイルディスクリプタを閉じると、ロックも解除されます。
+            """
+            import fcntl
+            while True:
+                fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    head = os.read(fd, self.loghead.size)
+                    if not head:
+                        self._write(fd, 0, self.loghead.pack(self.signature, self.version, False, self.loghead.size))
+                        return fd
+                    signature, version, stale, end = self.loghead.unpack(head)
+                    if signature != self.signature:
+                        raise ValueError("%s is not an eepy shared cache" % repr(self.filename))
+                    if version != self.version:
+                        if logger: logger.info("Shared cache format is unknown (file=%r)", self.filename)
+                        self._replace([])
+                    elif not stale:
+                        return fd
+                except:
+                    os.close(fd)
+                    raise
+                os.close(fd)
+
+        def _replace(self, records):
+            """ records のレコードだけのログファイルを作成し、ログファイルを置き換えます。
+            mmap している他のプロセスの為に、元のファイルは変更しません。
+            """
+            import random
+            _tmp_ = "%s%s" % (self.filename, str(random.random())[1:])
+            with open(_tmp_, "wb") as f:
+                f.write(self.loghead.pack(self.signature, self.version, False, 0))
+                for record in records:
+                    f.write(record)
+                end = f.tell()
+                f.seek(0)
+                f.write(self.loghead.pack(self.signature, self.version, False, end))
+            os.rename(_tmp_, self.filename)
+            return end
+
+        def _write(self, fd, pos, data):
+            os.lseek(fd, pos, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+
+        def _append(self, key, dump):
+            """ レコードをログファイルに追記し、ヘッダの終端の位置を更新します。"""
+            with self._lock:
+                fd = self._open()
+                try:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    end = self.loghead.unpack(os.read(fd, self.loghead.size))[3]
+                    self._write(fd, end, self.record.pack(len(key), len(dump)) + key + dump)
+                    end += self.record.size + len(key) + len(dump)
+                    self._write(fd, 0, self.loghead.pack(self.signature, self.version, False, end))
+                finally:
+                    os.close(fd)
+            if logger: logger.info("Store shared cache (file=%r, key=%r, size=%d)", self.filename, key, len(dump))
+            if self.maxsize and end > self.maxsize:
+                self.vacuum()
+
+        def vacuum(self):
+            """ 有効なレコードだけのログファイルを作成し、置き換えます。
+            有効なレコードが maxsize の半分を超える時は、最後のレコードを残して、収まるまで古いレコードから捨てます。
+            """
+            with self._lock:
+                fd = self._open()
+                try:
+                    m = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                    index = {None: self.loghead.size}
+                    self._scan(m, index, self.loghead.unpack_from(m)[3])
+                    del index[None]
+                    records = sorted(index.iteritems(), key=lambda item: item[1])
+                    live = sum(self.record.size + len(key) + size for key, (pos, size) in records)
+                    evicted = 0
+                    while self.maxsize and live > self.maxsize // 2 and evicted < len(records) - 1:
+                        key, (pos, size) = records[evicted]
+                        live -= self.record.size + len(key) + size
+                        evicted += 1
+                    if evicted and logger:
+                        logger.info("Evict shared cache (file=%r, records=%d)", self.filename, evicted)
+                    end = self._replace(self.record.pack(len(key), size) + key + m[pos:pos + size]
+                                        for key, (pos, size) in records[evicted:])
+                    self._write(fd, 0, self.loghead.pack(self.signature, self.version, True, self.loghead.unpack_from(m)[3]))
+                    if logger: logger.info("Vacuum shared cache (file=%r, size=%d)", self.filename, end)
+                finally:
+                    os.close(fd)
 
 
     class GaeMemcacheCacheStorage(CacheStorage):
@@ -658,22 +3244,269 @@ def cache():
         def _load(self, key):
             from google.appengine.api import memcache
             key = self.cachename(key)
-            if logger: logger.info("Load memcache (key=%s)" % repr(key))
+            if logger: logger.info("Load memcache (key=%r)", key)
             return memcache.get(key)
         
-        def _store(self, key, data):
-            if "bytecode" in data:
-                data.pop("bytecode")
+        def _store(self, key, dump):
             from google.appengine.api import memcache
             key = self.cachename(key)
-            if logger: logger.info("Store memcache (key=%s)" % repr(key))
-            res = memcache.set(key, data, self.lifetime)
-            if not res and logger: logger.info("Failed to store memcache (key=%s)" % repr(key))
+            if logger: logger.info("Store memcache (key=%r)", key)
+            res = memcache.set(key, dump, self.lifetime)
+            if not res and logger: logger.info("Failed to store memcache (key=%r)", key)
         
         def _delete(self, key):
             from google.appengine.api import memcache
             memcache.delete(self.cachename(key))
-    
+
+        def _load_multi(self, keys):
+            from google.appengine.api import memcache
+            names = dict((self.cachename(key), key) for key in keys)
+            if logger: logger.info("Load memcache (keys=%d)", len(names))
+            return dict((names[name], dump) for name, dump in memcache.get_multi(names.keys()).iteritems())
+
+        def _store_multi(self, dumps):
+            from google.appengine.api import memcache
+            if logger: logger.info("Store memcache (keys=%d)", len(dumps))
+            failed = memcache.set_multi(dict((self.cachename(key), dump) for key, dump in dumps.iteritems()), self.lifetime)
+            if failed and logger: logger.info("Failed to store memcache (keys=%r)", failed)
+
+
+    class MemcachedCacheStorage(CacheStorage):
+        """ memcached のテキストプロトコルで、memcached サーバを２次キャッシュに利用する CacheStorage 実装クラス。
+        接続はプールして再利用します。get_multi と set_multi は、まとめて１回の往復で読み書きします。
+        キャッシュデータには、バイトコードを作成した Python のマジックナンバーが含まれるので、
+        異なる Python のプロセスが同じサーバを使っても、バイトコードは同じ Python の時だけ使われます。
+        通信のエラーやタイムアウトは、キャッシュが無いものとして扱います。
+        """
+
+        def __init__(self, server="127.0.0.1:11211", lifetime=0, timeout=1.0, poolsize=8, prefix="eepy:", builder=Template):
+            """
+            args:
+                server: サーバのアドレス。"host:port" または (host, port)
+                lifetime: キャッシュの有効期間（秒）。0 の時、無期限
+                timeout: 接続と通信のタイムアウト（秒）
+                poolsize: プールしておく接続の最大数
+                prefix: キーの接頭辞
+            """
+            CacheStorage.__init__(self, builder)
+            if isinstance(server, basestring):
+                host, port = server.rsplit(":", 1)
+                server = (host, int(port))
+            self.server = server
+            self.lifetime = lifetime
+            self.timeout = timeout
+            self.poolsize = poolsize
+            self.prefix = prefix
+            self._pool = []
+            self._lock = threading.Lock()
+
+        def __getstate__(self):
+            """ 別のプロセスに渡す時は、接続を除きます。"""
+            state = dict(self.__dict__, _pool=[])
+            del state["_lock"]
+            return state
+
+        def __setstate__(self, state):
+            self.__dict__.update(state)
+            self._lock = threading.Lock()
+
+        def _load(self, key):
+            return self._load_multi([key]).get(key)
+
+        def _store(self, key, dump):
+            self._store_multi({key: dump})
+
+        def _delete(self, key):
+            self._command("delete %s\r\n" % self.cachename(key), 1)
+
+        def _load_multi(self, keys):
+            names = dict((self.cachename(key), key) for key in keys)
+            if not names:
+                return {}
+            if logger: logger.info("Load memcached (keys=%d)", len(names))
+            def get(sock, f):
+                dumps = {}
+                sock.sendall("get %s\r\n" % " ".join(names))
+                while True:
+                    line = f.readline()
+                    if line == "END\r\n":
+                        return dumps
+                    if not line.startswith("VALUE "):
+                        raise IOError("unexpected reply %r" % line)
+                    name, flags, size = line.split()[1:4]
+                    dump = f.read(int(size) + 2)
+                    if len(dump) != int(size) + 2:
+                        raise IOError("connection closed")
+                    if name in names:
+                        dumps[names[name]] = dump[:-2]
+            return self._call(get) or {}
+
+        def _store_multi(self, dumps):
+            if not dumps:
+                return
+            if logger: logger.info("Store memcached (keys=%d)", len(dumps))
+            self._command("".join("set %s 0 %d %d\r\n%s\r\n" % (self.cachename(key), self.lifetime, len(dump), dump)
+                                  for key, dump in dumps.iteritems()), len(dumps))
+
+        def _command(self, request, replies):
+            """ request を送信し、replies 行の応答を読みます。保存できなかった応答はログに残します。"""
+            def command(sock, f):
+                sock.sendall(request)
+                for i in xrange(replies):
+                    line = f.readline()
+                    if not line:
+                        raise IOError("connection closed")
+                    if line not in ("STORED\r\n", "DELETED\r\n", "NOT_FOUND\r\n") and logger:
+                        logger.info("Failed to store memcached (reply=%r)", line.strip())
+                return True
+            return self._call(command)
+
+        def _call(self, func):
+            """ プールの接続で func(ソケット, 読み込み用のファイル) を呼び出し、その結果を返します。
+            接続はプールに戻します。通信のエラーやタイムアウトの時は、接続を閉じて None を返します。
+            """
+            import socket
+            with self._lock:
+                conn = self._pool.pop() if self._pool else None
+            try:
+                if conn is None:
+                    sock = socket.create_connection(self.server, self.timeout)
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    conn = (sock, sock.makefile("rb"))
+                result = func(*conn)
+            except (socket.error, IOError), e:
+                for c in conn or ():
+                    c.close()
+                if logger: logger.info("Failed to access memcached (server=%r, error=%r)", self.server, e)
+                return None
+            with self._lock:
+                if len(self._pool) < self.poolsize:
+                    self._pool.append(conn)
+                    conn = None
+            for c in conn or ():
+                c.close()
+            return result
+
+        def cachename(self, key):
+            if isinstance(key, unicode):
+                key = key.encode("utf-8")
+            return self.prefix + hashlib.sha1(key).hexdigest()
+
+
+    class FragmentStorage(object):
+        """ cached ヘルパで保存する、テンプレートの一部の出力（フラグメント）のキャッシュの為の抽象クラス。
+        キーは、テンプレートのファイル名と cached に指定したキーの組です。
+        フラグメントは、有効期限と出力を marshal したバイト列で保存され、期限切れのものは読み込んだ時に削除されます。
+        サブクラスは、CacheStorage と同様に、バイト列を保存する _load, _store, _delete を実装します。
+        """
+        def get(self, key):
+            dump = self._load(key)
+            if not dump:
+                return None
+            expires, value = marshal.loads(dump)
+            if expires and expires < time.time():
+                if logger: logger.info("Fragment is expired (key=%r)", key)
+                self._delete(key)
+                return None
+            return value
+
+        def set(self, key, value, ttl=None):
+            self._store(key, marshal.dumps((time.time() + ttl if ttl else 0, value)))
+
+        def unset(self, key):
+            self._delete(key)
+
+        def _load(self, key):
+            raise NotImplementedError("%s#_load(): not implemented yet." % self.__class__.__name__)
+
+        def _store(self, key, dump):
+            raise NotImplementedError("%s#_store(): not implemented yet." % self.__class__.__name__)
+
+        def _delete(self, key):
+            raise NotImplementedError("%s#_delete(): not implemented yet." % self.__class__.__name__)
+
+        def cachename(self, key):
+            return "%s.fragment" % hashlib.sha1(repr(key)).hexdigest()
+
+
+    class MemoryFragmentStorage(FragmentStorage):
+        """ フラグメントをメモリに保存する FragmentStorage 実装クラス。
+        エントリ数が maxentries を超えると、最も長く使われていないものから追い出します（LRU）。
+        """
+        def __init__(self, maxentries=1000):
+            self.maxentries = maxentries
+            self.entries = collections.OrderedDict()
+            self._lock = threading.Lock()
+
+        def __getstate__(self):
+            """ 別のプロセスに渡す時は、上限の設定だけを渡します。"""
+            state = dict(self.__dict__, entries=collections.OrderedDict())
+            del state["_lock"]
+            return state
+
+        def __setstate__(self, state):
+            self.__dict__.update(state)
+            self._lock = threading.Lock()
+
+        def _load(self, key):
+            with self._lock:
+                dump = self.entries.pop(key, None)
+                if dump is not None:
+                    self.entries[key] = dump
+            return dump
+
+        def _store(self, key, dump):
+            with self._lock:
+                self.entries.pop(key, None)
+                self.entries[key] = dump
+                while self.maxentries and len(self.entries) > self.maxentries:
+                    self.entries.popitem(last=False)
+
+        def _delete(self, key):
+            with self._lock:
+                self.entries.pop(key, None)
+
+        def clear(self):
+            with self._lock:
+                self.entries.clear()
+
+
+    class FileFragmentStorage(FragmentStorage):
+        """ フラグメントを directory のファイルに保存する FragmentStorage 実装クラス。
+        複数のプロセスで共有できます。エントリ数の上限はありません。
+        """
+        def __init__(self, directory):
+            self.directory = directory
+
+        def _load(self, key):
+            try:
+                with open(self.cachename(key), "rb") as f:
+                    return f.read()
+            except IOError:
+                return None
+
+        def _store(self, key, dump):
+            path = self.cachename(key)
+            if logger: logger.info("Store fragment file (file=%r)", path)
+            import random
+            _tmp_ = "%s%s"  % (path, str(random.random())[1:])
+            with open(_tmp_, "wb") as f:
+                f.write(dump)
+            os.rename(_tmp_, path)
+
+        def _delete(self, key):
+            try:
+                os.unlink(self.cachename(key))
+            except OSError:
+                pass
+
+        def cachename(self, key):
+            return os.path.join(self.directory, FragmentStorage.cachename(self, key))
+
+
+    fragments = MemoryFragmentStorage()
+    """ Renderer を使わない時の、cached ヘルパの保存先 """
+
     return locals()
 
 
@@ -681,21 +3514,36 @@ def cache():
 def helper():
     """ コア ヘルパを収めたモジュール
     """
-    import contextlib
+
+    def context(_locals=None):
+        """ レンダリング中のテンプレートの Context を取得する。
+        テンプレートのコードは、Context を __context として含む locals をグローバルとして実行されている為、
+        呼び出し元のフレームの f_globals から取得します。
+        コンポーネントの中では、引数の __context を、コンポーネントのフレームの f_locals から取得します。
+        args:
+            _locals: 通常使わない。locals が既に取得されている時、その locals の Context を返す。
+        """
+        if _locals is None:
+            frame = sys._getframe(1)
+            while frame and "__context" not in frame.f_globals:
+                if frame.f_code.co_name == "__component" and frame.f_code.co_filename == "<eepy>":
+                    return frame.f_locals["__context"]
+                frame = frame.f_back
+            if not frame:
+                raise RuntimeError("context(): not in rendering")
+            _locals = frame.f_globals
+        return _locals["__context"]
+
 
     def buffer_frame_locals(locals = None):
         """ __buffer を含む local コンテキストを取得する。
         所得したコンテキストを用いて、レンダリングのフローを変えたり、
         __buffer に内容を追加するヘルパを書くことができます。
-        詳しくは、helper.capture などの実装を参考にしてください。
+        テンプレートのローカル変数も含みますが、代入はテンプレート変数にだけ反映されます。
+        __buffer を新しいリストに差し替えると、元のリストに戻すまでの出力はそのリストに追加されます。
+        新しく書くヘルパでは、context() で Context を取得して利用してください。
         """
-        if locals is None:
-            for i in xrange(2, 99):
-                locals = sys._getframe(i).f_locals
-                if "__buffer" in locals:
-                    return locals
-        else:
-            return locals
+        return _FrameLocals(context(locals))
 
 
     def include(path, capture_as=None, **vars):
@@ -706,38 +3554,40 @@ def helper():
             capture_as が指定されている場合、指定された名前で locals に保存します。未指定の時、concat
             **vars: include 先に渡す追加のテンプレート変数
         """
-        locals = buffer_frame_locals().copy()
-        locals.update(vars)
-        if "renderer" in locals:
-            result = locals["renderer"].render(path, locals)
-        else:
-            result = Template(path).render(locals)
-        if capture_as:
-            locals[capture_as] = result
-        else:
-            concat(result, locals)
+        context().include(path, capture_as, **vars)
+
+
+    def component(path, *params):
+        """ 子テンプレートを、params を引数とする関数（コンポーネント）として返す。
+        呼び出すと、渡した引数だけで子テンプレートをレンダリングし、出力を追加します。
+        include と違い、テンプレート変数のコピーや、テンプレートの検索は呼び出しごとには行われません。
+        コンポーネントは Renderer ごとに一度だけコンパイルされ、Renderer の vars（ヘルパなど）を参照できます。
+        呼び出し元のテンプレート変数は参照できないので、必要なものは引数で渡します。
+        ひとつのテンプレートの中だけで使う時は、テンプレート内で def した関数も同じように使えます。
+        args:
+            path: 子テンプレートの path
+            *params: 引数名。デフォルト値を持つ引数は "name=value" の形式
+        ex:
+            <%- row = component("row.html", "name", "value", "cls=None") -%>
+            <%- for name, value in items: -%>
+            <%- row(name, value) -%>
+            <%- end -%>
+        """
+        return context().component(path, *params)
 
 
     def extends(path, **vars):
         """ path で指定されたテンプレートを親テンプレートとし、ブロックに基づき拡張した結果を返す。
         ブロックは block ヘルパで定義します。
         親テンプレートには、現在のテンプレート処理直後の locals を引数 vars で上書きしたテンプレート変数が渡されます。
+        render_iter の時は、親テンプレートもストリームでレンダリングされます。
         args:
             path: 親テンプレートの path
             **vars: extends 先に渡す追加のテンプレート変数
         """
-        def do_extends(result, locals):
-            locals.update(vars)
-            if "renderer" in locals:
-                return locals["renderer"].render(path, locals)
-            else:
-                return Template(path).render(locals)
+        context().extends(path, **vars)
 
-        locals = buffer_frame_locals()
-        locals["__after_render"].insert(0, do_extends)
 
-
-    @contextlib.contextmanager
     def block(blockname="content"):
         """ with 句で囲んだ範囲をブロックとして登録する。
         既に保存されたブロックがある時、ブロックの内容を保存されたブロックで置き換えます。
@@ -746,27 +3596,9 @@ def helper():
         args:
             blockname: ブロックの名前
         """
-        locals = buffer_frame_locals()
-        locals.setdefault("__blocks", {})
+        return context().block(blockname)
 
-        #既に保存されたブロックがあれば、保存している内容を出力し、ここでのキャプチャ結果は破棄
-        if blockname in locals["__blocks"]:
-            buffer, locals["__buffer"] = locals["__buffer"], list()
-            yield
-            locals["__buffer"] = buffer
-            locals["__buffer"].append(locals["__blocks"][blockname]) #仕様：利用後も削除せずに残しておく
-        
-        #保存されたブロックが無ければ、キャプチャ結果をブロックとして保存し、出力もする
-        else:
-            buffer, locals["__buffer"] = locals["__buffer"], list()
-            yield
-            captured = u"".join(locals["__buffer"])
-            locals["__buffer"] = buffer
-            locals["__buffer"].append(captured)
-            locals["__blocks"][blockname] = captured
 
-
-    @contextlib.contextmanager
     def capture(name_or_callback, _locals=None):
         """ with 句で囲んだ範囲をキャプチャし __buffer に格納するか、コールバック関数に処理を委ねる
         args:
@@ -774,19 +3606,26 @@ def helper():
                         コールバック関数の呼び出し形式：callback(captured, locals)
             _locals: 通常使わない。呼び出し元で _locals が既に取得されている時、処理高速化の為に _locals を引き渡す。
         """
-        locals = buffer_frame_locals(_locals)
-        buffer, locals["__buffer"] = locals["__buffer"], list()
-        yield
-        captured = u"".join(locals["__buffer"])
-        locals["__buffer"] = buffer
-        if isinstance(name_or_callback, types.FunctionType):
-            name_or_callback(captured, locals)
-        else:
-            if isinstance(name_or_callback, tuple):
-                container, name = name_or_callback
-            else:
-                container, name = locals, name_or_callback
-            container[name] = captured
+        return context(_locals).capture(name_or_callback)
+
+
+    def cached(key, ttl=None):
+        """ with 句で囲んだ範囲の出力を、テンプレートのファイル名と key をキーとしてキャッシュする。
+        キャッシュがある時は、範囲のコードを実行せずに、キャッシュされた出力を出力します。
+        保存先は、Renderer の fragments、Renderer を使わない時は cache.fragments です。
+        "<%- with cached(key): -%>" のように単一行のコードパートで記述した時、コンパイル時に for 文に置き換えられます。
+        その為、範囲の中では（範囲の中のループを除いて）break と continue は使えず、コンパイル時に SyntaxError になります。
+        複数行のコードパートの中では、"for _ in cached(key):" と記述してください。
+        args:
+            key: キャッシュのキー。repr が値を一意に表すもの（文字列や数値、そのタプルなど）
+            ttl: 有効期限の秒数。未指定の時、期限なし
+        ex:
+            <%- with cached(("menu", user.role), ttl=300): -%>
+                <%- for item in load_menu(user.role): -%> ... <%- end -%>
+            <%- end -%>
+        """
+        c = context()
+        return c.cached(c.locals["__template"].filename, key, ttl)
 
 
     def captured_as(name):
@@ -800,16 +3639,7 @@ def helper():
                 ... default content ...
                 <%- end -%>
         """
-        locals = buffer_frame_locals()
-        if isinstance(name, tuple):
-            container, name = name
-        else:
-            container = locals
-        if name in container:
-            concat(container[name], locals)
-            return True
-        else:
-            return False
+        return context().captured_as(name)
 
 
     def concat(text, _locals=None):
@@ -817,8 +3647,18 @@ def helper():
         args:
             _locals: 通常使わない。呼び出し元で _locals が既に取得されている時、処理高速化の為に _locals を引き渡す。
         """
-        _locals = buffer_frame_locals(_locals)
-        _locals["__buffer"].append(tostr(text))
+        context(_locals).append(tostr(text))
+
+
+    def flush():
+        """ render_iter でのフラッシュポイントを示す。
+        "<%- flush() -%>" のように単一行のコードパートで記述した時、コンパイル時に yield に置き換えられます。
+        複数行のコードパートや、テンプレート内で定義した関数の中から呼び出した時は、何もしません。
+        ex:
+            </head>
+            <%- flush() -%>
+        """
+        pass
 
 
     def cycle(*values):
@@ -841,12 +3681,122 @@ def helper():
         return _cycle(values).next
 
 
+    class Deferred(object):
+        """ 別のスレッドで計算される値。defer で作成します。
+        テンプレートでは通常の値と同じように使え、最初に使われた時に計算の完了を待ちます。
+        render_async では、<%= で出力しても計算の完了を待たずにレンダリングを続けます。
+        計算結果がリストなどの時は、for でそのまま繰り返せます。
+        """
+        __slots__ = ("_done", "_value", "_error")
+
+        def __init__(self, func, *args, **kwargs):
+            self._done = threading.Event()
+            self._error = None
+            thread = threading.Thread(target=self._run, args=(func, args, kwargs))
+            thread.daemon = True
+            thread.start()
+
+        def _run(self, func, args, kwargs):
+            try:
+                self._value = func(*args, **kwargs)
+            except:
+                self._error = sys.exc_info()
+            finally:
+                self._done.set()
+
+        def done(self):
+            """ 計算が完了している時 True を返す。"""
+            return self._done.is_set()
+
+        def result(self, timeout=None):
+            """ 計算の完了を待ち、結果を返す。計算で例外が発生した時は、その例外を送出します。
+            args:
+                timeout: 待つ秒数。未指定の時、完了するまで待つ
+            """
+            if not self._done.wait(timeout):
+                raise RuntimeError("Deferred value is not ready")
+            if self._error:
+                raise self._error[0], self._error[1], self._error[2]
+            return self._value
+
+        def __getattr__(self, name):
+            return getattr(self.result(), name)
+
+        def __getitem__(self, key):
+            return self.result()[key]
+
+        def __iter__(self):
+            return iter(self.result())
+
+        def __len__(self):
+            return len(self.result())
+
+        def __contains__(self, value):
+            return value in self.result()
+
+        def __nonzero__(self):
+            return bool(self.result())
+
+        def __unicode__(self):
+            return tostr(self.result())
+
+        def __str__(self):
+            return str(self.result())
+
+
+    def defer(func, *args, **kwargs):
+        """ func(*args, **kwargs) を別のスレッドで計算し始め、その値を表す Deferred を返す。
+        独立した値を defer でテンプレート変数に渡すと、それぞれの計算は並行して行われます。
+        ex:
+            vars = {"news": defer(fetch_news), "weather": defer(fetch_weather, city)}
+            r.render_async("index.html", vars).result()
+        """
+        return Deferred(func, *args, **kwargs)
+
+
+    class Markup(unicode):
+        """ エスケープ済みなど、そのまま出力して良い文字列を表す unicode。
+        escape_xml や、<%= のフィルタは Markup をそのまま通過させます。
+        ex:
+            <%= Markup(u"<b>bold</b>") %>    --->    <b>bold</b>
+        """
+        __slots__ = ()
+
+
+    def markup_safe(filter):
+        """ filter を、Markup をそのまま通過させるフィルタにして返す。
+        filter.markup_safe が真の時は、filter をそのまま返します。
+        args:
+            filter: 対象のフィルタ
+        """
+        if getattr(filter, "markup_safe", False):
+            return filter
+        def safe_filter(text):
+            if isinstance(text, Markup):
+                return text
+            return filter(text)
+        safe_filter.markup_safe = True
+        return safe_filter
+
+
+    _search_xml_special = re.compile(ur"[&<>'\"]").search
+
+
     def escape_xml(text):
         """ xml 文字列中の特殊文字をエスケープして返す。
+        Markup の時と、特殊文字を含まない時は、text をコピーせずにそのまま返します。
         args:
             text: 対象文字列
         """
-        return tostr(text).replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;").replace(u"'", u"&#39;").replace(u'"', u"&quot;")
+        if text.__class__ is not unicode:
+            if isinstance(text, Markup):
+                return text
+            text = tostr(text)
+        if _search_xml_special(text) is None:
+            return text
+        return text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;").replace(u"'", u"&#39;").replace(u'"', u"&quot;")
+    escape_xml.markup_safe = True
+    escape_xml.tostr_safe = True
 
 
     def tostr(val, encoding=sys.getdefaultencoding(), errors="ignore"): #TODO: 名前を touni とかにする？
@@ -868,3 +3818,35 @@ def helper():
 
     return locals()
 
+
+
+def main(argv=None):
+    """ コマンドラインのエントリポイント。
+    
+        python -m eepy compile BASE -o OUTPUT [-e ENCODING] [-x EXT] [--fastlocals] [--inline] [--minify] [--strip-comments]
+    
+    BASE 以下のテンプレートをコンパイルし、Renderer(bundle=OUTPUT) で読み込めるバンドルファイルを作成します。
+    バンドルは、同じ fastlocals, inline, minify を指定した Renderer でだけ読み込めます。
+    """
+    import optparse
+    parser = optparse.OptionParser(usage="%prog compile BASE -o OUTPUT [options]")
+    parser.add_option("-o", "--output", help="output bundle file")
+    parser.add_option("-e", "--encoding", default=sys.getdefaultencoding(), help="encoding of template files")
+    parser.add_option("-x", "--ext", action="append", help="compile only files with this extension (repeatable); "
+                                                               "by default all files except .cache and .bundle files")
+    parser.add_option("--fastlocals", action="store_true", default=False, help="compile with fastlocals mode")
+    parser.add_option("--inline", action="store_true", default=False, help="inline literal include() calls")
+    parser.add_option("--minify", action="store_true", default=False, help="collapse whitespace in HTML text parts")
+    parser.add_option("--strip-comments", action="store_true", default=False, help="also strip HTML comments (implies --minify)")
+    options, args = parser.parse_args(argv)
+    if len(args) != 2 or args[0] != "compile" or not options.output:
+        parser.error("usage: compile BASE -o OUTPUT")
+    
+    minify = "comments" if options.strip_comments else options.minify
+    r = Renderer(base=args[1], encoding=options.encoding, fastlocals=options.fastlocals, inline=options.inline, minify=minify)
+    for name in r.save_bundle(options.output, r.walk(options.ext)):
+        print name
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+""" eepy のテスト。
+
+    $ python -m unittest discover tests
+"""
+import os, shutil, tempfile, codecs, unittest
+
+import eepy
+
+
+class TemplateDirTest(unittest.TestCase):
+    """ テンプレートを置く一時ディレクトリを準備するテストの基底クラス """
+
+    templates = {}
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp(prefix="eepy-test-")
+        for name, source in self.templates.iteritems():
+            with codecs.open(os.path.join(self.base, name), "w", "utf8") as f:
+                f.write(source)
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def renderer(self, **kwargs):
+        return eepy.Renderer(base=self.base, vars=eepy.helper.__dict__, **kwargs)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+""" render_async と helper.Deferred のテスト。"""
+import threading, unittest
+
+import eepy
+from tests import TemplateDirTest
+
+
+class DeferredTest(unittest.TestCase):
+    """ 別のスレッドで計算される値 """
+
+    def test_result(self):
+        d = eepy.helper.defer(lambda a, b=0: [a, b], 1, b=2)
+        self.assertEqual(d.result(), [1, 2])
+        self.assertTrue(d.done())
+        self.assertEqual((len(d), d[1], list(d), 2 in d, bool(d)), (2, 2, [1, 2], True, True))
+
+    def test_error(self):
+        d = eepy.helper.defer(lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, d.result)
+        self.assertRaises(ZeroDivisionError, d.result)
+
+    def test_not_ready(self):
+        ready = threading.Event()
+        d = eepy.helper.defer(ready.wait)
+        self.assertRaises(RuntimeError, d.result, 0.01)
+        ready.set()
+        self.assertTrue(d.result(5))
+
+
+class RenderAsyncTest(TemplateDirTest):
+    """ 出力待ちの値を含むテンプレートのレンダリング """
+
+    templates = {
+        "page.html": u'<% extends("layout.html", title=u"T") %><% with block("body"): %>'
+                     u'<% for i in range(3): %><% include("widget.html", n=i) %><% end %><% end %>',
+        "layout.html": u"<title><%= title %></title><% with block('body'): pass %><%= tail %>",
+        "widget.html": u"<w><%= defer(lambda: u'<%d>' % n) %>|<% for x in items: %><%= x %>,<% end %></w>",
+    }
+
+    def vars(self):
+        return {"tail": eepy.helper.defer(lambda: u"<end>"), "items": eepy.helper.defer(lambda: [1, 2])}
+
+    def test_same_as_render(self):
+        for options in ({}, {"inline": True}):
+            r = self.renderer(filter=eepy.helper.escape_xml, **options)
+            expected = r.render("page.html", self.vars())
+            self.assertEqual(r.render_async("page.html", self.vars()).result(5), expected)
+            self.assertTrue(u"<w>&lt;2&gt;|1,2,</w>" in expected and expected.endswith(u"&lt;end&gt;"))
+
+    def test_does_not_wait(self):
+        #render では、release の前に value を待ち続ける
+        ready = threading.Event()
+        vars = dict(eepy.helper.__dict__, value=eepy.helper.defer(lambda: u"ok" if ready.wait(5) else u"timeout"), release=ready.set)
+        t = eepy.Template(u"[<%= value %>]<% release() %>")
+        self.assertEqual(t.render_async(vars).result(5), u"[ok]")
+
+    def test_error(self):
+        t = eepy.Template(u"<%= x %>")
+        self.assertRaises(ZeroDivisionError, t.render_async({"x": eepy.helper.defer(lambda: 1 / 0)}).result, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+""" benchmarks のテスト。"""
+import os, json, shutil, tempfile, unittest, StringIO, sys
+
+import benchmarks
+
+
+class WorkloadTest(unittest.TestCase):
+    """ 登録されたワークロードが、レンダリングできること """
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="eepy-test-")
+        for filename in os.listdir(benchmarks.TEMPLATES):
+            shutil.copy(os.path.join(benchmarks.TEMPLATES, filename), self.workdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_workloads(self):
+        self.assertTrue(benchmarks.WORKLOADS)
+        for name, workload in benchmarks.WORKLOADS.iteritems():
+            compile, render = workload(self.workdir)
+            if compile:
+                compile()
+            #filecache_* の render は、出力を返さない
+            first = render()
+            self.assertEqual(render(), first, name)
+            if first is not None:
+                self.assertTrue(first, name)
+        self.assertTrue(any(name.endswith(".cache") for name in os.listdir(self.workdir)))
+
+
+class MeasureTest(unittest.TestCase):
+    """ 計測結果と、その比較 """
+
+    def test_measure(self):
+        result = benchmarks.measure("times_table", 5)
+        self.assertEqual(result.keys(), ["compile", "render", "throughput", "iterations", "peak_memory_kb"])
+        self.assertEqual(result["compile"].keys(), ["min", "median"])
+        self.assertEqual(result["render"].keys(), ["p50", "p90", "p99", "max"])
+        self.assertTrue(result["render"]["p50"] <= result["render"]["p99"] <= result["render"]["max"])
+        self.assertEqual(result["iterations"], 5)
+
+    def test_run(self):
+        report = benchmarks.run(["times_table"], 3)
+        self.assertEqual(report.keys(), ["eepy", "python", "platform", "revision", "results"])
+        self.assertEqual(report["results"].keys(), ["times_table"])
+        self.assertEqual(report["results"]["times_table"]["iterations"], 3)
+        self.assertRaises(KeyError, benchmarks.run, ["unknown"], 1)
+
+    def test_compare(self):
+        def report(compile, p50, p99, memory):
+            return {"results": {"a": {"compile": compile and {"median": compile},
+                                      "render": {"p50": p50, "p99": p99}, "peak_memory_kb": memory}}}
+        lines = benchmarks.compare(report(1.0, 2.0, 4.0, 100), report(None, 1.0, 8.0, 200))
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1].split(), ["a", "-", "0.50x", "2.00x", "2.00x"])
+        self.assertEqual(benchmarks.compare(report(1.0, 1.0, 1.0, 1), {"results": {}}), lines[:1])
+
+    def test_main_compare(self):
+        base = {"results": {"a": {"compile": None, "render": {"p50": 1.0, "p99": 1.0}, "peak_memory_kb": None}}}
+        paths = []
+        for i in range(2):
+            fd, path = tempfile.mkstemp(suffix=".json")
+            with os.fdopen(fd, "w") as f:
+                json.dump(base, f)
+            paths.append(path)
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            benchmarks.main(["--compare"] + paths)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+            for path in paths:
+                os.remove(path)
+        self.assertEqual(output.splitlines()[1].split(), ["a", "-", "1.00x", "1.00x", "-"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+""" ２次キャッシュとバンドルのテスト。"""
+import os, errno, unittest
+
+import eepy
+from tests import TemplateDirTest
+
+
+class CompileOptionsTest(TemplateDirTest):
+    """ コンパイルオプションの異なる Renderer での、２次キャッシュとバンドルの共有 """
+
+    templates = {
+        "page.html": u"<p>  x  </p>\n\n  <% include('child.html') %>",
+        "child.html": u"<b>  b  </b>",
+    }
+
+    plain = u"<p>  x  </p>\n\n  <b>  b  </b>"
+    minified = u"<p> x </p>\n<b> b </b>"
+
+    def test_file_cache(self):
+        cache = eepy.cache.FileCacheStorage()
+        self.assertEqual(self.renderer(cache=cache, minify=True).render("page.html"), self.minified)
+        self.assertEqual(self.renderer(cache=cache).render("page.html"), self.plain)
+        self.assertEqual(self.renderer(cache=cache, minify=True).render("page.html"), self.minified)
+        self.assertEqual(self.renderer(cache=cache).render("page.html"), self.plain)
+        self.assertEqual(cache.stats()["hits"], 4)
+
+    def test_inline(self):
+        cache = eepy.cache.FileCacheStorage()
+        path = os.path.join(self.base, "page.html")
+        self.renderer(cache=cache).render("page.html")
+        self.assertEqual(self.renderer(cache=cache, inline=True)._build(path).depends, [os.path.join(self.base, "child.html")])
+        self.assertTrue(cache.get(path, eepy._compile_options(False, True, False)).inline)
+
+    def test_header(self):
+        cache = eepy.cache.FileCacheStorage()
+        path = os.path.join(self.base, "page.html")
+        self.renderer(cache=cache, minify=True).render("page.html")
+        with open(cache.cachename(cache.cachekey(path, 4)), "rb") as f:
+            dump = f.read()
+        self.assertEqual(cache._restore(path, dump, path, 0), None)
+        self.assertEqual(cache.stats()["mismatched"], 1)
+
+    def test_bundle(self):
+        bundle = os.path.join(self.base, "templates.bundle")
+        self.renderer(minify=True).save_bundle(bundle, ["page.html", "child.html"])
+        self.assertRaises(ValueError, self.renderer, bundle=bundle)
+        self.assertEqual(self.renderer(minify=True, bundle=bundle).render("page.html"), self.minified)
+
+
+
+class RefreshTest(TemplateDirTest):
+    """ mtime だけが変わったテンプレートの、キャッシュのヘッダの更新 """
+
+    templates = {"page.html": u"<p>x</p>"}
+
+    def test_read_only(self):
+        cache = eepy.cache.FileCacheStorage()
+        self.renderer(cache=cache).render("page.html")
+        os.utime(os.path.join(self.base, "page.html"), (0, 0))
+        def _store(key, dump):
+            raise IOError(errno.EROFS, "Read-only file system")
+        cache._store = _store
+        self.assertEqual(self.renderer(cache=cache).render("page.html"), u"<p>x</p>")
+        self.assertEqual(cache.stats()["refreshed"], 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
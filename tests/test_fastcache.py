@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+""" FastCache のテスト。"""
+import os, pickle, unittest
+
+import eepy
+from tests import TemplateDirTest
+
+
+class FastCacheTest(unittest.TestCase):
+    """ 上限を超えた時の LRU での追い出しと、pin """
+
+    def test_maxentries(self):
+        fc = eepy.FastCache(maxentries=2)
+        fc["a"], fc["b"] = 1, 2
+        self.assertEqual(fc.get("a"), 1)
+        fc["c"] = 3
+        self.assertEqual(sorted(fc.entries), ["a", "c"])
+        self.assertEqual(fc.evictions, 1)
+        self.assertRaises(KeyError, fc.__getitem__, "b")
+
+    def test_maxbytes(self):
+        fc = eepy.FastCache(maxbytes=10, sizeof=len)
+        fc["a"], fc["b"] = "xxxx", "yyyy"
+        fc["a"] = "xxxxx"
+        self.assertEqual((len(fc), fc.size), (2, 9))
+        fc["c"] = "zz"
+        self.assertEqual((sorted(fc.entries), fc.size), (["a", "c"], 7))
+        fc["d"] = "w" * 20
+        self.assertEqual((len(fc), fc.size), (0, 0))
+
+    def test_pin(self):
+        fc = eepy.FastCache(maxentries=2)
+        fc.pin("layout")
+        fc["layout"], fc["a"], fc["b"] = 0, 1, 2
+        self.assertEqual(sorted(fc.entries), ["b", "layout"])
+        fc.clear()
+        fc["layout"], fc["a"] = 0, 1
+        self.assertEqual(sorted(fc.entries), ["a", "layout"])
+        fc.unpin("layout")
+        fc["b"] = 2
+        self.assertEqual(sorted(fc.entries), ["a", "b"])
+
+    def test_pickle(self):
+        fc = eepy.FastCache(maxentries=3)
+        fc["a"] = 1
+        copied = pickle.loads(pickle.dumps(fc))
+        self.assertEqual((copied.maxentries, len(copied)), (3, 0))
+        copied["b"] = 2
+        self.assertEqual(copied.get("b"), 2)
+
+
+class RendererFastCacheTest(TemplateDirTest):
+    """ オンメモリキャッシュから追い出されたテンプレートの、２次キャッシュからの復元 """
+
+    templates = {"a.html": u"a<%= x %>", "b.html": u"b<%= x %>", "layout.html": u"l"}
+
+    def test_restore(self):
+        storage = eepy.cache.FileCacheStorage()
+        r = self.renderer(cache=storage, fastcache=eepy.FastCache(maxentries=2))
+        r.pin("layout.html")
+        for i in range(3):
+            self.assertEqual((r.render("a.html", {"x": i}), r.render("b.html", {"x": i}), r.render("layout.html")),
+                             (u"a%d" % i, u"b%d" % i, u"l"))
+        self.assertEqual(storage.stats()["stores"], 3)
+        self.assertEqual(storage.stats()["hits"], 4)
+        self.assertTrue(os.path.join(self.base, "layout.html") in r.fastcache)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+""" helper のテスト。"""
+import unittest
+
+import eepy
+from tests import TemplateDirTest
+
+helper = eepy.helper
+
+
+class EscapeTest(unittest.TestCase):
+    """ escape_xml と Markup """
+
+    def test_escape(self):
+        self.assertEqual(helper.escape_xml(u"<a href='x'>\"&\"</a>"), u"&lt;a href=&#39;x&#39;&gt;&quot;&amp;&quot;&lt;/a&gt;")
+        self.assertEqual(helper.escape_xml(1), u"1")
+        self.assertEqual(helper.escape_xml(None), u"")
+        self.assertEqual(helper.escape_xml("<b>"), u"&lt;b&gt;")
+
+    def test_fast_path(self):
+        text = u"plain text " * 10
+        self.assertTrue(helper.escape_xml(text) is text)
+        markup = helper.Markup(u"<b>bold</b>")
+        self.assertTrue(helper.escape_xml(markup) is markup)
+
+    def test_markup_safe(self):
+        upper = helper.markup_safe(lambda text: text.upper())
+        self.assertEqual((upper(u"a"), upper(helper.Markup(u"a"))), (u"A", u"a"))
+        self.assertTrue(helper.markup_safe(upper) is upper)
+        self.assertTrue(helper.markup_safe(helper.escape_xml) is helper.escape_xml)
+
+
+class EscapeRenderTest(TemplateDirTest):
+    """ escape_xml をフィルタにした時の、ヘルパの出力の埋め込み """
+
+    templates = {
+        "page.html": u'<%= u"<p>" %><% include("child.html") %><% with capture("c"): %><i><%= u"&" %></i><% end %><%= c %>',
+        "child.html": u"<b><%= name %></b>",
+    }
+
+    def test_not_escaped_twice(self):
+        for options in ({}, {"inline": True}):
+            r = self.renderer(filter=helper.escape_xml, **options)
+            self.assertEqual(r.render("page.html", {"name": u"<x>"}), u"&lt;p&gt;<b>&lt;x&gt;</b><i>&amp;</i>")
+            self.assertEqual(r.render("page.html", {"name": helper.Markup(u"<x>")}), u"&lt;p&gt;<b><x></b><i>&amp;</i>")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+""" cache.MemcachedCacheStorage と Renderer.warm のテスト。
+memcached のテキストプロトコルの get, set, delete だけを実装した、プロセス内のサーバを使います。
+"""
+import os, threading, socket, SocketServer, time, unittest
+
+import eepy
+from tests import TemplateDirTest
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.handlers.append((self.connection, threading.current_thread()))
+
+    def handle(self):
+        store, calls = self.server.store, self.server.calls
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.split()
+            calls.append(command[0])
+            if command[0] == "get":
+                values = ["VALUE %s 0 %d\r\n%s\r\n" % (key, len(store[key]), store[key]) for key in command[1:] if key in store]
+                self.wfile.write("".join(values) + "END\r\n")
+            elif command[0] == "set":
+                store[command[1]] = self.rfile.read(int(command[4]) + 2)[:-2]
+                self.wfile.write("STORED\r\n")
+            elif command[0] == "delete":
+                self.wfile.write("DELETED\r\n" if store.pop(command[1], None) is not None else "NOT_FOUND\r\n")
+            else:
+                self.wfile.write("ERROR\r\n")
+
+
+class _Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler):
+        SocketServer.TCPServer.__init__(self, address, handler)
+        self.store, self.calls, self.handlers, self.lock = {}, [], [], threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ サーバを止め、プールされたままの接続を閉じて、全てのスレッドの終了を待つ """
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+        with self.lock:
+            handlers, self.handlers = self.handlers, []
+        for connection, thread in handlers:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            thread.join()
+
+
+class MemcachedTest(TemplateDirTest):
+
+    templates = dict(("t%d.html" % i, u"<p>%d <%%= x %%></p>" % i) for i in range(10))
+
+    def setUp(self):
+        TemplateDirTest.setUp(self)
+        self.server = _Server(("127.0.0.1", 0), _Handler)
+        self.address = "127.0.0.1:%d" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.stop()
+        TemplateDirTest.tearDown(self)
+
+    def storage(self, **kwargs):
+        return eepy.cache.MemcachedCacheStorage(self.address, timeout=0.5, **kwargs)
+
+    def test_warm(self):
+        calls = self.server.calls
+        cache = self.storage()
+        self.assertEqual(len(self.renderer(cache=cache).warm()), 10)
+        self.assertEqual((calls.count("get"), calls.count("set")), (1, 10))
+        self.assertEqual(cache.stats(), {"misses": 10, "stores": 10})
+        
+        del calls[:]
+        cache = self.storage()
+        r = self.renderer(cache=cache)
+        self.assertEqual(len(r.warm()), 10)
+        self.assertEqual(calls, ["get"])
+        self.assertEqual(cache.stats(), {"hits": 10})
+        self.assertEqual(r.render("t3.html", {"x": 9}), u"<p>3 9</p>")
+        self.assertEqual(r.stats()["counts"]["cache.builds"], 10)
+
+    def test_get_multi(self):
+        cache = self.storage()
+        paths = [os.path.join(self.base, "t%d.html" % i) for i in range(3)]
+        cache.set(paths[0], eepy.Template(u"<%= x %>"))
+        self.assertEqual(cache.get_multi(paths).keys(), [paths[0]])
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 2, "stores": 1})
+
+    def test_unset(self):
+        cache = self.storage()
+        path = os.path.join(self.base, "t1.html")
+        self.renderer(cache=cache).render("t1.html", {"x": 1})
+        self.assertTrue(cache.get(path).bytecode)
+        cache.unset(path)
+        self.assertEqual(cache.get(path), None)
+
+    def test_server_down(self):
+        self.server.stop()
+        cache = self.storage()
+        start = time.time()
+        self.assertEqual(cache.get(os.path.join(self.base, "t1.html")), None)
+        self.assertEqual(self.renderer(cache=cache).render("t1.html", {"x": 1}), u"<p>1 1</p>")
+        self.assertTrue(time.time() - start < 2)
+
+
+class FileCacheWarmTest(TemplateDirTest):
+    """ テンプレートの隣に .cache ファイルがある時の warm """
+
+    templates = MemcachedTest.templates
+
+    def test_warm_twice(self):
+        self.assertEqual(len(self.renderer(cache=eepy.cache.FileCacheStorage()).warm()), 10)
+        cache = eepy.cache.FileCacheStorage()
+        self.assertEqual(len(self.renderer(cache=cache).warm()), 10)
+        self.assertEqual(cache.stats(), {"hits": 10})
+
+    def test_compile_once(self):
+        compiled, compile = [], eepy.Template.compile
+        def counting(t):
+            compiled.append(t.filename)
+            return compile(t)
+        eepy.Template.compile = counting
+        try:
+            paths = self.renderer(cache=eepy.cache.FileCacheStorage(), compact=True).warm()
+        finally:
+            eepy.Template.compile = compile
+        self.assertEqual(sorted(compiled), sorted(paths))
+        r = self.renderer(cache=eepy.cache.FileCacheStorage(), compact=True)
+        r.warm()
+        self.assertEqual(r.render("t3.html", {"x": 9}), u"<p>3 9</p>")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+""" Profiler のテスト。"""
+import os, StringIO, unittest
+
+import eepy
+from tests import TemplateDirTest
+
+
+class ProfilerTest(TemplateDirTest):
+    """ レンダリングの入れ子と、テンプレートの行ごとの計測 """
+
+    templates = {
+        "page.html": u'<% extends("layout.html") %><% with block(): %>x<% include("row.html") %><% end %>',
+        "layout.html": u"<html><% block() %></html>",
+        "row.html": u"<td></td>",
+        "list.html": u'<% cell = component("cell.html", "i") %>\n<% for i in range(3): %>\n<% include("row.html") %>\n<% cell(i) %>\n<% end %>',
+        "cell.html": u"<td>\n<%= i %>\n</td>",
+    }
+
+    def profile(self, render, **options):
+        r, profiler = self.renderer(**options), eepy.Profiler()
+        with profiler:
+            render(r)
+        return profiler
+
+    def tree(self, node):
+        """ 入れ子を [(種類, ファイル名, 呼び出し回数, [子]), ...] にして返す """
+        result = []
+        for child in node["children"].itervalues():
+            kind, path = child["label"].split(u" ", 1)
+            result.append((kind, os.path.basename(path), child["calls"], self.tree(child)))
+        return result
+
+    def assertTimes(self, node):
+        """ 入れ子の所要時間が、子の所要時間の合計以上であること """
+        for child in node["children"].itervalues():
+            self.assertTrue(child["time"] > 0, child["label"])
+            self.assertTimes(child)
+        if node["children"]:
+            self.assertTrue(node["time"] >= sum(child["time"] for child in node["children"].itervalues()), node["label"])
+
+    def hits(self, profiler):
+        """ 行ごとの実行回数を {(ファイル名, 行番号): 回数} で返す """
+        return dict(((os.path.basename(filename), line), hits) for filename, line, time, hits in profiler.stats())
+
+    def test_nesting(self):
+        profiler = self.profile(lambda r: r.render("list.html"))
+        self.assertEqual(self.tree(profiler.root),
+                         [("render", "list.html", 1, [("include", "row.html", 3, []), ("component", "cell.html", 3, [])])])
+        for child in profiler.root["children"].itervalues():
+            self.assertTimes(child)
+        profiler = self.profile(lambda r: r.render("page.html"))
+        self.assertTimes(profiler.root["children"].values()[0])
+        self.assertTrue(u"include %s" % os.path.join(self.base, "row.html") in profiler.format_trace())
+
+    def test_lines(self):
+        for options in ({}, {"inline": True}):
+            #ループ内の行は、生成されたコードの行数の３倍実行される
+            hits = self.hits(self.profile(lambda r: r.render("list.html"), **options))
+            for location in (("list.html", 3), ("list.html", 4), ("row.html", 1), ("cell.html", 2)):
+                self.assertTrue(hits[location] >= 3 and hits[location] % 3 == 0, (location, hits[location]))
+            self.assertTrue(hits[("list.html", 1)] < hits[("list.html", 3)])
+            self.assertEqual(set(filename for filename, line in hits), set(["list.html", "row.html", "cell.html"]))
+
+    def test_collapsed(self):
+        out = StringIO.StringIO()
+        self.profile(lambda r: r.render("list.html")).write_collapsed(out)
+        stacks = [line.rsplit(" ", 1)[0].split(";") for line in out.getvalue().splitlines()]
+        self.assertTrue(stacks)
+        self.assertTrue(all(stack[0].startswith("render ") for stack in stacks))
+
+    def test_render_to(self):
+        expected = [("render", "page.html", 1, [("include", "row.html", 1, []), ("extends", "layout.html", 1, [])])]
+        renders = (lambda r: r.render("page.html"),
+                   lambda r: u"".join(r.render_iter("page.html")),
+                   lambda r: r.render_to(StringIO.StringIO(), "page.html"))
+        for render in renders:
+            self.assertEqual(self.tree(self.profile(render).root), expected)
+        profiler = self.profile(renders[2], inline=True)
+        self.assertEqual(self.tree(profiler.root), [("render", "page.html", 1, [])])
+        self.assertTrue(any(filename.endswith("row.html") for filename, line, time, hits in profiler.stats()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+""" Renderer のテスト。"""
+import os, threading, unittest
+
+import eepy
+from tests import TemplateDirTest
+
+
+class IncludeTest(TemplateDirTest):
+    """ include の子テンプレートからの、呼び出し元の変数の参照。inline の展開でも、実行時の include と同じ結果になること """
+
+    templates = {
+        "conditional.html": u'<% if flag: name = "x" %><% include("child.html") %>',
+        "later.html": u'<% include("child.html") %><% name = "later" %><%= name %>',
+        "nested.html": u'<% include("middle.html") %><% if flag: name = "x" %>',
+        "middle.html": u'<% include("child.html") %>',
+        "child.html": u"[<%= name %>]",
+        "leak.html": u'<% include("capture.html") %>[<%= q %>]',
+        "shadow.html": u'<% x = u"0" %><% include("capture.html") %><%= x %>',
+        "capture.html": u'<% with capture("q"): %>C<% end %><% with capture("x"): %><%= q %><% end %><%= x %>',
+    }
+
+    options = {}
+
+    def render(self, path, vars):
+        return self.renderer(**self.options).render(path, vars)
+
+    def test_conditional_assign(self):
+        self.assertEqual(self.render("conditional.html", {"flag": False, "name": u"v"}), u"[v]")
+        self.assertEqual(self.render("conditional.html", {"flag": True, "name": u"v"}), u"[x]")
+
+    def test_assign_after_include(self):
+        self.assertEqual(self.render("later.html", {"name": u"v"}), u"[v]later")
+        self.assertEqual(self.render("nested.html", {"flag": True, "name": u"v"}), u"[v]")
+
+    def test_undefined(self):
+        self.assertRaises(NameError, self.render, "conditional.html", {"flag": False})
+
+    def test_capture_in_child(self):
+        self.assertRaises(NameError, self.render, "leak.html", {})
+        self.assertEqual(self.render("shadow.html", {}), u"C0")
+
+
+class InlineIncludeTest(IncludeTest):
+
+    options = {"inline": True}
+
+
+class InlineFastlocalsIncludeTest(IncludeTest):
+
+    options = {"inline": True, "fastlocals": True}
+
+
+class ExtendsTest(TemplateDirTest):
+    """ extends のキーワード引数。inline で親テンプレートを展開しても、実行時の extends と同じ結果になること """
+
+    templates = {
+        "later.html": u'<% t = u"first" %><% extends("layout.html", title=t) %><% t = u"second" %>',
+        "counter.html": u'<% it = iter(range(2)) %><% extends("pair.html", a=next(it)) %><% b = next(it) %>',
+        "layout.html": u"<%= title %>",
+        "pair.html": u"<%= a %>|<%= b %>",
+    }
+
+    def test_kwargs_order(self):
+        for name, expected in (("later.html", u"first"), ("counter.html", u"0|1")):
+            self.assertEqual(self.renderer().render(name), expected)
+            self.assertEqual(self.renderer(inline=True).render(name), expected)
+            self.assertEqual(self.renderer(inline=True, fastlocals=True).render(name), expected)
+
+
+class ComponentTest(TemplateDirTest):
+    """ コンポーネントの中の include と capture。呼び出し元ではなく、コンポーネントの変数を参照すること """
+
+    templates = {
+        "page.html": u'<% name = u"caller" %><% row = component("row.html", "name") %><% for n in (u"a", u"b"): %><% row(n) %><% end %>',
+        "captured.html": u'<% row = component("row.html", "name") %><% row(u"z") %><%= captured_as("x") %>',
+        "private.html": u'<% secret = 1 %><% component("leak.html")() %>',
+        "row.html": u'<tr><% include("cell.html") %><% with capture("x"): %>[<%= name %>]<% end %><% captured_as("x") %></tr>',
+        "cell.html": u"<td><%= name %></td>",
+        "leak.html": u'<% include("secret.html") %>',
+        "secret.html": u"<%= secret %>",
+    }
+
+    def test_include(self):
+        for options in ({}, {"inline": True}):
+            r = self.renderer(**options)
+            self.assertEqual(r.render("page.html"), u"<tr><td>a</td>[a]</tr><tr><td>b</td>[b]</tr>")
+            self.assertEqual(u"".join(r.render_iter("page.html")), u"<tr><td>a</td>[a]</tr><tr><td>b</td>[b]</tr>")
+            self.assertRaises(NameError, r.render, "private.html")
+
+    def test_capture(self):
+        self.assertEqual(self.renderer().render("captured.html"), u"<tr><td>z</td>[z]</tr>False")
+
+
+class FragmentsTest(TemplateDirTest):
+    """ cached ヘルパのフラグメントの、Renderer ごとの保存先 """
+
+    templates = {"page.html": u"<% with cached('k'): %><%= name %><% end %>"}
+
+    def test_renderers(self):
+        upper = self.renderer(filter=lambda s: s.upper())
+        plain = self.renderer()
+        self.assertEqual(upper.render("page.html", {"name": u"a"}), u"A")
+        self.assertEqual(plain.render("page.html", {"name": u"a"}), u"a")
+        self.assertEqual(upper.render("page.html", {"name": u"b"}), u"A")
+        self.assertTrue(upper.fragments is not plain.fragments)
+
+    def test_shared(self):
+        fragments = eepy.cache.MemoryFragmentStorage()
+        self.assertEqual(self.renderer(fragments=fragments).render("page.html", {"name": u"a"}), u"a")
+        self.assertEqual(self.renderer(fragments=fragments).render("page.html", {"name": u"b"}), u"a")
+
+
+class RenderManyTest(TemplateDirTest):
+    """ render_many の、ワーカープロセスのプールでのレンダリング """
+
+    templates = {
+        "page.html": u'<h1><%= title %></h1><% include("row.html") %>',
+        "row.html": u"<p><%= body %></p>",
+    }
+
+    def varslist(self):
+        return [{"title": u"<%d>" % i, "body": eepy.helper.Markup(u"<b>%d</b>" % i)} for i in range(40)]
+
+    def test_ordered(self):
+        r = self.renderer(filter=eepy.helper.escape_xml)
+        serial = [r.render("page.html", vars) for vars in self.varslist()]
+        self.assertEqual(list(r.render_many("page.html", self.varslist(), workers=2, chunksize=4)), serial)
+        self.assertEqual(serial[3], u"<h1>&lt;3&gt;</h1><p><b>3</b></p>")
+
+    def test_unordered(self):
+        r = self.renderer()
+        results = dict(r.render_many("page.html", iter(self.varslist()), workers=2, chunksize=4, ordered=False))
+        self.assertEqual([results[i] for i in range(40)], [r.render("page.html", vars) for vars in self.varslist()])
+
+    def test_empty(self):
+        self.assertEqual(list(self.renderer().render_many("page.html", [])), [])
+
+    def test_close(self):
+        results = self.renderer().render_many("page.html", self.varslist(), workers=2)
+        self.assertEqual(next(results), u"<h1><0></h1><p><b>0</b></p>")
+        self.assertEqual(next(results), u"<h1><1></h1><p><b>1</b></p>")
+        results.close()
+
+
+class CheckTest(TemplateDirTest):
+    """ check_interval と invalidate による、変更されたテンプレートと、それを展開したテンプレートの取り除き """
+
+    templates = {
+        "page.html": u'<% extends("base.html") %><% with block(): %>P<% include("row.html") %><% end %>',
+        "base.html": u"B1[<% with block(): pass %>]",
+        "row.html": u"R1",
+        "list.html": u'<% component("row.html")() %>',
+        "other.html": u"O",
+    }
+
+    def write(self, name, source):
+        """ mtime を進めてテンプレートファイルを書き換える """
+        path = os.path.join(self.base, name)
+        mtime = os.stat(path).st_mtime + 10
+        with open(path, "w") as f:
+            f.write(source)
+        os.utime(path, (mtime, mtime))
+
+    def test_check_interval(self):
+        for options in ({}, {"inline": True}):
+            r = self.renderer(check_interval=0, **options)
+            self.assertEqual((r.render("page.html"), r.render("list.html")), (u"B1[PR1]", u"R1"))
+            self.write("row.html", "R2")
+            self.assertEqual((r.render("page.html"), r.render("list.html")), (u"B1[PR2]", u"R2"))
+            self.write("base.html", "B2[<% with block(): pass %>]")
+            self.assertEqual(r.render("page.html"), u"B2[PR2]")
+            self.write("row.html", "R1")
+            self.write("base.html", "B1[<% with block(): pass %>]")
+
+    def test_invalidate(self):
+        r = self.renderer(check_interval=60, inline=True)
+        r.render("page.html")
+        r.render("other.html")
+        self.write("row.html", "R2")
+        self.assertEqual(r.render("page.html"), u"B1[PR1]")
+        self.assertEqual(sorted(os.path.basename(path) for path in r.invalidate("row.html")), ["page.html"])
+        self.assertEqual(r.render("page.html"), u"B1[PR2]")
+        self.assertTrue(os.path.join(self.base, "other.html") in r.fastcache)
+
+    def test_check(self):
+        r = self.renderer()
+        r.render("page.html")
+        r.render("other.html")
+        self.assertEqual(r.check(), [])
+        self.write("other.html", "O2")
+        self.assertEqual(r.check(), [os.path.join(self.base, "other.html")])
+        self.assertEqual(r.render("other.html"), u"O2")
+
+
+class StatsTest(TemplateDirTest):
+    """ stats の、キャッシュとレンダリングの統計 """
+
+    templates = {
+        "a.html": u"A<%= x %>",
+        "b.html": u"B<% include('a.html') %>",
+        "error.html": u"<%= 1 / 0 %>",
+    }
+
+    def path(self, name):
+        return os.path.join(self.base, name)
+
+    def test_renders(self):
+        r = self.renderer(cache=eepy.cache.FileCacheStorage())
+        for i in range(3):
+            r.render("b.html", {"x": i})
+            u"".join(r.render_iter("a.html", {"x": i}))
+        self.assertRaises(ZeroDivisionError, r.render, "error.html")
+        stats = r.stats()
+        a, b, error = [stats["templates"][self.path(name)] for name in ("a.html", "b.html", "error.html")]
+        self.assertEqual((a["renders"], b["renders"], error["renders"], error["errors"]), (6, 3, 1, 1))
+        self.assertEqual(sum(a["histogram"]), 6)
+        self.assertEqual(len(a["histogram"]), len(stats["buckets"]) + 1)
+        self.assertTrue(a["max"] <= a["time"])
+        self.assertEqual(a["builds"], {"compile": 1})
+        self.assertEqual(stats["counts"]["compile.builds"], 3)
+        self.assertEqual(stats["counts"]["fastcache.hits"] + stats["counts"]["fastcache.misses"], 10)
+        self.assertEqual(stats["cache"]["stores"], 3)
+
+    def test_cache_builds(self):
+        storage = eepy.cache.FileCacheStorage()
+        self.renderer(cache=storage).render("a.html", {"x": 1})
+        r = self.renderer(cache=storage)
+        r.render("a.html", {"x": 1})
+        stats = r.stats()
+        self.assertEqual((stats["counts"]["cache.builds"], stats["counts"].get("compile.builds", 0)), (1, 0))
+        self.assertEqual(stats["cache"]["hits"], 1)
+        r.reset_stats()
+        stats = r.stats()
+        self.assertEqual((stats["templates"], stats["counts"]["fastcache.hits"], stats["cache"].get("hits", 0)), ({}, 0, 0))
+
+    def test_threads(self):
+        r = self.renderer()
+        def work():
+            for i in range(200):
+                r.render("b.html", {"x": i})
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = r.stats()
+        self.assertEqual(stats["templates"][self.path("b.html")]["renders"], 800)
+        self.assertEqual(stats["templates"][self.path("a.html")]["renders"], 800)
+        self.assertEqual(stats["counts"]["fastcache.hits"] + stats["counts"]["fastcache.misses"], 1600)
+
+
+class WalkTest(TemplateDirTest):
+    """ walk と、walk したテンプレートのバンドル """
+
+    templates = {
+        "page.html": u"<p><%= name %></p>",
+        "ascii.txt": u"text",
+    }
+
+    def setUp(self):
+        TemplateDirTest.setUp(self)
+        os.mkdir(os.path.join(self.base, "sub"))
+        with open(os.path.join(self.base, "sub", "row.html"), "w") as f:
+            f.write("<td></td>")
+        r = self.renderer(cache=eepy.cache.FileCacheStorage())
+        for name in ("page.html", "sub/row.html"):
+            r.render(name, {"name": u"x"})
+        with open(os.path.join(self.base, "page.html.cache.123"), "wb") as f:
+            f.write("\xff")
+        with open(os.path.join(self.base, "old.bundle.tmp"), "wb") as f:
+            f.write("\xff")
+
+    def test_walk(self):
+        r = self.renderer()
+        self.assertEqual(sorted(r.walk()), ["ascii.txt", "page.html", "sub/row.html"])
+        self.assertEqual(sorted(r.walk([".html"])), ["page.html", "sub/row.html"])
+
+    def test_bundle(self):
+        bundle = os.path.join(self.base, "templates.bundle")
+        self.assertEqual(self.renderer().save_bundle(bundle), ["ascii.txt", "page.html", "sub/row.html"])
+        self.assertEqual(self.renderer().save_bundle(bundle), ["ascii.txt", "page.html", "sub/row.html"])
+        self.assertEqual(self.renderer(bundle=bundle).render("page.html", {"name": u"y"}), u"<p>y</p>")
+
+
+class RenderToTest(TemplateDirTest):
+    """ render_to の、ヘルパの出力を含めた bufsize ごとの書き込み """
+
+    templates = {
+        "concat.html": u"<% for i in range(2000): %><% concat(i) %><% end %>",
+        "include.html": u"<% for i in range(2000): %><% include('row.html') %><% end %>",
+        "block.html": u"<% for i in range(2000): %><% with block('b%d' % i): %>x<% end %><% end %>",
+        "row.html": u"<td><%= i %></td>",
+    }
+
+    def assertWrites(self, name, **kwargs):
+        r, writes = self.renderer(**kwargs), []
+        r.render_to(writes.append, name, bufsize=100)
+        self.assertEqual("".join(writes), r.render(name).encode("utf-8"))
+        self.assertTrue(len(writes) >= 20, (name, len(writes)))
+
+    def test_helpers(self):
+        for name in ("concat.html", "include.html", "block.html"):
+            self.assertWrites(name)
+            self.assertWrites(name, inline=True)
+
+
+class CompactTest(TemplateDirTest):
+    """ Renderer(compact=True) の、オンメモリキャッシュと２次キャッシュのテンプレート """
+
+    templates = {
+        "page.html": u'<% extends("layout.html") %><% with block(): %><% for i in range(2): %><% include("row.html") %><% end %><% end %>',
+        "layout.html": u"<table><% with block(): pass %></table>",
+        "row.html": u"<tr><%= i %></tr>",
+    }
+
+    def test_render(self):
+        expected = self.renderer().render("page.html")
+        for options in ({}, {"inline": True}, {"cache": eepy.cache.FileCacheStorage()}):
+            r = self.renderer(compact=True, **options)
+            self.assertEqual(r.render("page.html"), expected)
+            self.assertEqual(r.render("page.html"), expected)
+            for t, size in r.fastcache.entries.itervalues():
+                self.assertEqual((t.template, type(t._srccode)), (None, str))
+        #２次キャッシュから復元したテンプレート
+        r = self.renderer(compact=True, cache=eepy.cache.FileCacheStorage())
+        self.assertEqual(r.render("page.html"), expected)
+        self.assertEqual(r.stats()["templates"][os.path.join(self.base, "page.html")]["builds"], {"cache": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
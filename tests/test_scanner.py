@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+""" コードパートの検索（Template._search_code_part）のテスト。
+以前の正規表現による検索をオラクルとし、同じ位置、コード、モードのコードパートが見つかることを確かめます。
+"""
+import os, re, random, time, unittest
+
+import eepy
+
+
+#Template._search_code_part に置き換える前の正規表現
+_regexp_search_code_part = re.compile(ur"""("""
+                                    r"""(?P<print_expr><%=(?P<raw_mode>(r )?))"""
+                                    r"""|(^[ \t]*<%\-)"""
+                                    r"""|(<%(?!%)(?:\-?))"""
+                                r""")(?P<code>("([^\\"]|\\.)*"|'([^\\']|\\.)*'|(?:(?!(%>)).))*"""
+                                r""")((\-%>\s*?[\n])|([^%]%>))"""
+                                , re.M|re.S)
+
+
+def regexp_code_parts(s):
+    parts, pos = [], 0
+    while True:
+        m = _regexp_search_code_part.search(s, pos)
+        if not m:
+            return parts
+        parts.append((m.start(), m.end(), m.group("code"), bool(m.group("print_expr")), bool(m.group("raw_mode"))))
+        pos = m.end()
+
+
+def scanner_code_parts(s):
+    t, memo = eepy.Template(u""), {}
+    parts, pos = [], 0
+    while True:
+        part = t._search_code_part(s, pos, memo)
+        if not part:
+            return parts
+        parts.append(part)
+        pos = part[1]
+
+
+class ScannerTest(unittest.TestCase):
+
+    cases = 3000
+
+    def assertSameParts(self, s):
+        self.assertEqual(scanner_code_parts(s), regexp_code_parts(s), repr(s))
+
+    def test_samples(self):
+        templates = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "templates")
+        for name in os.listdir(templates):
+            with open(os.path.join(templates, name)) as f:
+                self.assertSameParts(f.read().decode("utf-8"))
+        self.assertSameParts(eepy.__doc__.decode("utf-8"))
+
+    def test_edge_cases(self):
+        for s in [u"<%= x %>", u"<%=r x %>", u"<%- x -%>\n", u"  <%- x -%>  \n", u"<%- x -%> y\n", u"<%% x %%>",
+                  u"<% '%>' %>", u'<% "a\\"%>" %>', u"<% x '%>", u"<%%>", u"<% x %%>", u"<%-x-%>", u"<% it's %>",
+                  u"a\n\t<%- if x: -%>\n<%= y %>\n<%- end -%>\n"]:
+            self.assertSameParts(s)
+
+    def test_random(self):
+        rand = random.Random(12)
+        alphabet = [u"<%", u"<%=", u"<%=r ", u"<%-", u"-%>", u"%>", u"<%%", u"%%>", u" ", u"\n", u"\t", u"a", u"x = 1",
+                    u'"', u"'", u'"s %> t"', u"'q'", u"\\", u"=", u"-", u"%", u"r", u"if x:", u"end"]
+        for i in xrange(self.cases):
+            self.assertSameParts(u"".join(rand.choice(alphabet) for _ in xrange(rand.randint(1, 60))))
+
+    def test_structured(self):
+        rand = random.Random(34)
+        def text():
+            return u"".join(rand.choice([u"a", u" ", u"\n", u"'", u'"', u"don't", u"<%%", u"%%>", u"-", u"%", u"=", u"\t", u"r"])
+                            for _ in xrange(rand.randint(0, 8)))
+        def part():
+            code = u"".join(rand.choice([u" x", u" = ", u'"s %> t"', u"'q'", u'"a\\"b"', u" if y:", u" end", u" (1)", u" % 2", u"-", u" "])
+                            for _ in xrange(rand.randint(1, 5)))
+            return (rand.choice([u"<%", u"<%-", u"<%=", u"<%=r ", u"\n  <%-", u"\n<%-"]) + code +
+                    rand.choice([u"%>", u"-%>", u" %>", u" -%>", u" -%>\n", u" -%>  \n", u" -%> x\n"]))
+        for i in xrange(self.cases):
+            self.assertSameParts(u"".join(rand.choice([text, part])() for _ in xrange(rand.randint(1, 8))))
+
+    def test_unclosed_quotes(self):
+        #閉じられないコードパートでも、バックトラックで止まらずに終わること
+        s = u"<% " + u"'\"" * 3000 + u" x"
+        start = time.time()
+        self.assertEqual(scanner_code_parts(s), [])
+        self.assertTrue(time.time() - start < 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
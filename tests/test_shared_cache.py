@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+""" SharedCacheStorage のテスト。"""
+import os, codecs, unittest
+
+import eepy
+from tests import TemplateDirTest
+
+
+class SharedCacheStorageTest(TemplateDirTest):
+    """ flock で排他して追記し、mmap で読み込むログファイル """
+
+    def setUp(self):
+        TemplateDirTest.setUp(self)
+        self.logfile = os.path.join(self.base, "shared.cache")
+
+    def store(self, storage, name, text):
+        """ name のテンプレートファイルを作成し、コンパイルして storage に保存する """
+        path = os.path.join(self.base, name)
+        with codecs.open(path, "w", "utf8") as f:
+            f.write(text)
+        t = eepy.Template(text, filename=path)
+        t.compile()
+        storage.set(path, t)
+        return path
+
+    def render(self, storage, name):
+        t = storage.get(os.path.join(self.base, name))
+        return t and t.render()
+
+    def test_reopen_after_vacuum(self):
+        writer = eepy.cache.SharedCacheStorage(self.logfile)
+        reader = eepy.cache.SharedCacheStorage(self.logfile)
+        self.store(writer, "a.html", u"a")
+        self.store(writer, "b.html", u"b")
+        self.assertEqual(self.render(reader, "a.html"), u"a")
+        writer.unset(os.path.join(self.base, "b.html"))
+        writer.vacuum()
+        self.assertEqual(self.render(reader, "a.html"), u"a")
+        self.assertEqual(self.render(reader, "b.html"), None)
+        self.store(reader, "c.html", u"c")
+        self.assertEqual(self.render(writer, "c.html"), u"c")
+        self.assertEqual(self.render(eepy.cache.SharedCacheStorage(self.logfile), "a.html"), u"a")
+
+    def test_bounded(self):
+        storage = eepy.cache.SharedCacheStorage(self.logfile, maxsize=60000)
+        text = u"x" * 2000
+        for i in range(100):
+            self.store(storage, "t%d.html" % i, text + unicode(i))
+            self.assertTrue(os.path.getsize(self.logfile) <= 60000, (i, os.path.getsize(self.logfile)))
+            self.assertEqual(self.render(storage, "t%d.html" % i), text + unicode(i))
+        self.assertEqual(self.render(storage, "t0.html"), None)
+        self.assertEqual(self.render(eepy.cache.SharedCacheStorage(self.logfile), "t99.html"), text + u"99")
+
+    @unittest.skipUnless(hasattr(os, "fork"), "requires fork")
+    def test_concurrent_writers(self):
+        pids = []
+        for w in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    storage = eepy.cache.SharedCacheStorage(self.logfile, maxsize=0)
+                    for i in range(10):
+                        self.store(storage, "w%d-%d.html" % (w, i), u"w%d-%d" % (w, i))
+                except:
+                    os._exit(1)
+                os._exit(0)
+            pids.append(pid)
+        self.assertEqual([os.waitpid(pid, 0)[1] for pid in pids], [0] * 4)
+        storage = eepy.cache.SharedCacheStorage(self.logfile)
+        self.assertEqual([self.render(storage, "w%d-%d.html" % (w, i)) for w in range(4) for i in range(10)],
+                         [u"w%d-%d" % (w, i) for w in range(4) for i in range(10)])
+
+
+if __name__ == "__main__":
+    unittest.main()
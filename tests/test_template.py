@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+""" Template のコンパイルとレンダリングのテスト。"""
+import contextlib
+import marshal
+import pickle
+import unittest
+
+import eepy
+
+
+class VarsTest(unittest.TestCase):
+    """ テンプレートで代入する変数の、テンプレート変数の参照 """
+
+    options = {}
+
+    def render(self, template, vars={}):
+        return eepy.Template(template, **self.options).render(vars)
+
+    def test_reassign(self):
+        self.assertEqual(self.render(u"<% title = title.upper() %><%= title %>", {"title": u"ab"}), u"AB")
+        self.assertEqual(self.render(u"<% items = sorted(items) %><%= items %>", {"items": [3, 1]}), u"[1, 3]")
+
+    def test_conditional_assign(self):
+        template = u'<% if not title: title = u"d" %><%= title %>'
+        self.assertEqual(self.render(template, {"title": u"t"}), u"t")
+        self.assertEqual(self.render(template, {"title": u""}), u"d")
+
+    def test_assign_after_read(self):
+        self.assertEqual(self.render(u"<%= n %><% for n in range(2): %><%= n %><% end %>", {"n": 9}), u"901")
+
+    def test_unbound(self):
+        self.assertRaises(NameError, self.render, u"<%= n %><% n = 1 %>")
+
+    def test_capture_assigned(self):
+        vars = dict(eepy.helper.__dict__)
+        self.assertEqual(self.render(u'<% title = u"d" %><% with capture("title"): %>X<% end %><%= title %>', vars), u"X")
+        self.assertEqual(self.render(u'<% with capture("t"): %>X<% end %><% t = t + u"!" %><%= t %>', vars), u"X!")
+        self.assertEqual(self.render(u'<% t = u"a" %><% captured_as("t") %>', vars), u"a")
+
+    def test_locals(self):
+        self.assertEqual(self.render(u'<% a = 1 %><%= sorted(k for k in locals() if k in ("a", "v")) %>', {"v": 0}), u"['a', 'v']")
+        self.assertEqual(self.render(u'<% locals()["b"] = 2 %><%= b %>'), u"2")
+
+
+class FastlocalsVarsTest(VarsTest):
+    """ fastlocals の時の、テンプレートで代入する変数の、テンプレート変数の参照 """
+
+    options = {"fastlocals": True}
+
+    def test_capture_with_bound_names(self):
+        vars = dict(eepy.helper.__dict__, n=1, t=u"v", body=u"b")
+        template = u'<% n = n + 1 %><% with capture("t"): %><%= n %><%= t %><% end %><%= t %><% t = t + u"!" %><%= t %>'
+        self.assertEqual(self.render(template, vars), u"2v2v!")
+        template = u'<%= body %><% with capture("body"): %>[<%= n %>]<% end %><%= body %><% captured_as("body") %>'
+        self.assertEqual(self.render(template, vars), u"b[1][1]")
+
+
+class FlushTest(unittest.TestCase):
+    """ フラッシュポイント """
+
+    def test_chunks(self):
+        t = eepy.Template(u"a<%- flush() -%>b<% for i in range(2): %><% flush() %>c<% end %>")
+        self.assertEqual(list(t.render_iter()), [u"a", u"b", u"c", u"c"])
+
+    def test_in_function(self):
+        template = u"<% def f(): %>x<%- flush() -%>y<% end %><% f() %><% f() %>z"
+        self.assertEqual(eepy.Template(template).render(), u"xyxyz")
+        self.assertEqual(u"".join(eepy.Template(template).render_iter()), u"xyxyz")
+
+
+class OptimizeTest(unittest.TestCase):
+    """ 出力のコードの最適化と minify """
+
+    def appends(self, template):
+        t = eepy.Template(template)
+        t.compile()
+        return [line.strip() for line in t.srccode.splitlines() if line.strip().startswith(u"__append(")]
+
+    def test_merge_and_fold(self):
+        template = u'a<%=r u"b" %>c<%=r 1 %><%=r None %><%= u"<" %><%=r u"x" + y %>'
+        self.assertEqual(self.appends(template), [u'__append(u"""abc1""")', u'__append(__filter(u"""<"""))', u'__append(u"x" + y)'])
+        self.assertEqual(eepy.Template(template).render({"y": u"Y"}, eepy.helper.escape_xml), u"abc1&lt;xY")
+        self.assertEqual(eepy.Template(template).render({"y": u"Y"}), u"abc1<xY")
+
+    def test_values(self):
+        template = u"<%= 1.5 %>|<%= None %>|<%= x %>|<%=r x %>|<%= u'\\\\\"' %>"
+        self.assertEqual(eepy.Template(template).render({"x": 2}), u'1.5||2|2|\\"')
+        self.assertEqual(eepy.Template(template).render({"x": None}, lambda s: u"[%s]" % s), u'[1.5]|[]|[]||[\\"]')
+
+    def test_minify(self):
+        template = u"<p>  a \n\n  b</p><!-- c --><!--[if IE]>i<![endif]--><pre>  <%= x %>  \n\n</pre>"
+        self.assertEqual(eepy.Template(template, minify=True).render({"x": u"  x"}),
+                         u"<p> a\nb</p><!-- c --><!--[if IE]>i<![endif]--><pre>    x  \n\n</pre>")
+        self.assertEqual(eepy.Template(template, minify="comments").render({"x": u"x"}),
+                         u"<p> a\nb</p><!--[if IE]>i<![endif]--><pre>  x  \n\n</pre>")
+
+
+class CompactTest(unittest.TestCase):
+    """ compact の時の、テンプレートの破棄と srccode の圧縮 """
+
+    template = u"<% for i in range(3): %><%= i %>,<% end %><%= name %>"
+
+    def compiled(self, **options):
+        t = eepy.Template(self.template, **options)
+        t.compile()
+        return t
+
+    def test_compact(self):
+        t, plain = self.compiled(compact=True), self.compiled()
+        self.assertEqual((t.template, type(t._srccode)), (None, str))
+        self.assertEqual(t.srccode, plain.srccode)
+        self.assertEqual(t.render({"name": u"x"}), plain.render({"name": u"x"}))
+        self.assertEqual(t.render({"name": u"y"}), u"0,1,2,y")
+
+    def test_error(self):
+        t = self.compiled(compact=True)
+        try:
+            t.render()
+        except NameError, e:
+            self.assertTrue(u"__append(__filter(name))" in e.message.decode("utf-8"), e.message)
+        else:
+            self.fail("NameError not raised")
+
+    def test_pickle(self):
+        #bytecode は pickle できないので、圧縮された srccode から再コンパイルされる
+        t = self.compiled(compact=True)
+        t.bytecode = None
+        t = pickle.loads(pickle.dumps(t, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual((t.template, type(t._srccode)), (None, str))
+        self.assertEqual(t.render({"name": u"z"}), u"0,1,2,z")
+        self.assertEqual(type(t._srccode), str)
+
+    def test_cache_data(self):
+        data = marshal.loads(marshal.dumps(self.compiled(compact=True).get_cache_data()))
+        self.assertEqual(data["srccode"], self.compiled().srccode)
+        t = eepy.Template(compact=True, **data)
+        self.assertEqual(t.render({"name": u"w"}), u"0,1,2,w")
+        self.assertEqual((t.template, type(t._srccode)), (None, str))
+
+
+class BufferFrameLocalsTest(unittest.TestCase):
+    """ buffer_frame_locals を使う、以前の形式のヘルパ """
+
+    def render(self, template, iter=False):
+        @contextlib.contextmanager
+        def wrap(head, tail, convert=unicode):
+            locals = eepy.helper.buffer_frame_locals()
+            buffer, locals["__buffer"] = locals["__buffer"], []
+            yield
+            captured = u"".join(locals["__buffer"])
+            locals["__buffer"] = buffer
+            buffer.append(head + convert(captured) + tail)
+
+        def upper():
+            return wrap(u"", u"", unicode.upper)
+
+        def local_upper(name):
+            return eepy.helper.buffer_frame_locals()[name].upper()
+
+        t = eepy.Template(template)
+        vars = dict(eepy.helper.__dict__, wrap=wrap, upper=upper, local_upper=local_upper)
+        return list(t.render_iter(vars)) if iter else t.render(vars)
+
+    def test_capture(self):
+        self.assertEqual(self.render(u'a<% with upper(): %>b<%= u"c" %><% end %>d<% n = u"n" %><%= local_upper("n") %>'), u"aBCdN")
+
+    def test_nested(self):
+        template = u'<% with upper(): %>a<% with wrap(u"[", u"]"): %>b<% end %>c<% end %>'
+        self.assertEqual(self.render(template), u"A[B]C")
+
+    def test_flush(self):
+        template = u'a<% flush() %><% with upper(): %>b<% flush() %>c<% end %><% flush() %>d'
+        self.assertEqual(self.render(template, iter=True), [u"a", u"BC", u"d"])
+
+
+class CachedTest(unittest.TestCase):
+    """ with cached(...) の範囲 """
+
+    def setUp(self):
+        self.fragments = eepy.cache.fragments = eepy.cache.MemoryFragmentStorage()
+
+    def render(self, template):
+        return eepy.Template(template, filename="cached.html").render(eepy.helper.__dict__)
+
+    def test_cached(self):
+        template = u"<% for i in range(3): %><% with cached(i): %>[<%= i %>]<% end %>;<% end %>"
+        self.assertEqual(self.render(template), u"[0];[1];[2];")
+        self.assertEqual(self.fragments.get(("cached.html", 1)), u"[1]")
+
+    def test_jump(self):
+        for jump in (u"continue", u"break"):
+            template = u"<% for i in range(4): %><% with cached(i): %><% if i == 1: JUMP %>[<%= i %>]<% end %>;<% end %>".replace(u"JUMP", jump)
+            self.assertRaises(SyntaxError, self.render, template)
+        template = u"<% for i in range(4): %>\n<% with cached(i): %>\n<% try: %>\n<% x = i %>\n<% except: %>\n<% break %>\n<% end %>\n<% end %><% end %>"
+        self.assertRaises(SyntaxError, self.render, template)
+
+    def test_inner_loop(self):
+        template = u"<% with cached('loop'): %><% for j in range(3): %><% if j == 1: continue %><%= j %><% end %><% end %>"
+        self.assertEqual(self.render(template), u"02")
+
+    def test_string_templates(self):
+        render = lambda template: eepy.Template(template).render(eepy.helper.__dict__)
+        self.assertEqual(render(u"<% with cached('k'): %>a<% end %>"), u"a")
+        self.assertEqual(render(u"<% with cached('k'): %>b<% end %>"), u"b")
+        self.assertEqual(render(u"<% with cached('k'): %>a<% end %>"), u"a")
+
+
+if __name__ == "__main__":
+    unittest.main()